@@ -0,0 +1,108 @@
+"""Micro-benchmark: legacy DOM-based extract_links vs the streaming MultistatusParser.
+
+Run from the repository root:
+
+    python benchmarks/bench_extract_links.py [--sizes 1000 10000 100000] [--with-logging]
+"""
+import argparse, gc, logging, os, sys, time, tracemalloc
+from xml.etree import ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import MultistatusParser, LISTING_CHUNK_SIZE
+
+
+def make_multistatus(count, prefix='/remote.php/dav/files/user/Фильмы/'):
+    parts = ['<?xml version="1.0"?>\n<d:multistatus xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">']
+    parts.append(f'<d:response><d:href>{prefix}</d:href><d:propstat><d:prop><d:resourcetype><d:collection/></d:resourcetype>'
+                 '<d:getetag>"root"</d:getetag><d:getlastmodified>Tue, 01 Oct 2024 10:00:00 GMT</d:getlastmodified>'
+                 '</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>')
+    for i in range(count):
+        if i % 10 == 0:
+            props = '<d:resourcetype><d:collection/></d:resourcetype>'
+            href = f'{prefix}%D0%A1%D0%B5%D0%B7%D0%BE%D0%BD%20{i}/'
+        else:
+            props = f'<d:resourcetype/><d:getcontentlength>{1000000 + i}</d:getcontentlength>'
+            href = f'{prefix}%D0%A1%D0%B5%D1%80%D0%B8%D1%8F%20{i}.mkv'
+        parts.append(f'<d:response><d:href>{href}</d:href><d:propstat><d:prop>{props}<d:getetag>"{i:016x}"</d:getetag>'
+                     '<d:getlastmodified>Tue, 01 Oct 2024 10:00:00 GMT</d:getlastmodified></d:prop>'
+                     '<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>')
+    parts.append('</d:multistatus>')
+    return ''.join(parts).encode('utf-8')
+
+
+def legacy_extract_links(content):
+    # The pre-streaming implementation, kept verbatim for comparison
+    tree = ET.ElementTree(ET.fromstring(content))
+    root = tree.getroot()
+    namespaces = {'d': 'DAV:'}
+    items = []
+
+    logging.debug("Анализ XML-ответа:")
+    logging.debug(ET.tostring(root, encoding='unicode'))
+
+    for response in root.findall('d:response', namespaces):
+        href = response.find('d:href', namespaces).text
+        if not href.endswith('/'):
+            href = href.split('/')[-1]
+        else:
+            href = href.split('/')[-2] + '/'
+        items.append(href)
+        logging.debug(f"Найдена ссылка: {href}")
+    return items
+
+
+def streaming_extract(content):
+    parser = MultistatusParser()
+    entries = []
+    first_entry_at = None
+    start = time.perf_counter()
+    for offset in range(0, len(content), LISTING_CHUNK_SIZE):
+        entries += parser.feed(content[offset:offset + LISTING_CHUNK_SIZE])
+        if first_entry_at is None and entries:
+            first_entry_at = time.perf_counter() - start
+    entries += parser.finish()
+    return entries, first_entry_at
+
+
+def measure(func, content, repeats):
+    best = None
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        result = func(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    gc.collect()
+    tracemalloc.start()
+    func(content)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--with-logging', action='store_true', help='keep the DEBUG logging the app runs with')
+    args = parser.parse_args()
+
+    logging.getLogger().handlers.clear()
+    if args.with_logging:
+        logging.basicConfig(level=logging.DEBUG, stream=open(os.devnull, 'w'), force=True)
+    else:
+        logging.disable(logging.CRITICAL)
+
+    print(f"{'entries':>8} {'bytes':>11} {'legacy s':>9} {'legacy MiB':>10} {'stream s':>9} {'stream MiB':>10} {'1st entry ms':>12} {'speedup':>7}")
+    for size in args.sizes:
+        content = make_multistatus(size)
+        legacy_time, legacy_peak, legacy_items = measure(legacy_extract_links, content, args.repeats)
+        stream_time, stream_peak, (entries, first_entry_at) = measure(streaming_extract, content, args.repeats)
+        assert len(entries) == len(legacy_items)
+        print(f"{size:>8} {len(content):>11} {legacy_time:>9.3f} {legacy_peak / 2**20:>10.1f} {stream_time:>9.3f} "
+              f"{stream_peak / 2**20:>10.1f} {first_entry_at * 1000:>12.2f} {legacy_time / stream_time:>6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
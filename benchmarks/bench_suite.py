@@ -0,0 +1,374 @@
+"""Reproducible end-to-end benchmark suite against the local WebDAV stand-in.
+
+Each scenario runs in its own child process under ``QT_QPA_PLATFORM=offscreen`` and drives the same
+pieces the app wires together in ``populate_file_tree``: WebDavSession, ListingService, the
+streaming MultistatusParser, FileTreeModel behind FileSortProxyModel in a QTreeView, and the
+StreamProxy. The startup scenario launches the app itself against stored credentials, once with an
+empty cache and then with the snapshot of the previous run. The filter scenario types into the tree
+filter over about 200k loaded entries, one keystroke at a time. Latency percentiles and the peak RSS of
+every scenario are written as JSON, so two runs can be compared.
+
+Run from the repository root:
+
+    python benchmarks/bench_suite.py [--scenarios flat-1k deep stream] [--latency 20] [--bandwidth 4096]
+    python benchmarks/bench_suite.py --output new.json --compare old.json
+"""
+import argparse, json, logging, os, platform, subprocess, sys, tempfile, time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Windows has no getrusage, peak RSS is reported as null there
+    resource = None
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+TREES = {
+    'flat-10': dict(width=0, depth=0, files=10),
+    'flat-1k': dict(width=0, depth=0, files=1000),
+    'flat-10k': dict(width=0, depth=0, files=10000),
+    'flat-100k': dict(width=0, depth=0, files=100000),
+    'wide': dict(width=2000, depth=1, files=0),
+    'deep': dict(width=2, depth=12, files=5),
+}
+SCENARIOS = list(TREES) + ['stream', 'startup', 'filter']
+FILTER_TREE = dict(width=20, depth=2, files=480)
+FILTER_QUERIES = ('серия 00123', 'ФАЙЛ 0042', 'папка 7')
+STARTUP_TREE = dict(width=10, depth=2, files=1000)
+STARTUP_SCRIPT = '''
+import os, sys, time
+sys.path.insert(0, sys.argv[1])
+import main
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QApplication
+main.logging.disable(main.logging.CRITICAL)
+main.app = app = QApplication(sys.argv[:1])
+player = main.NextcloudVideoPlayer()
+player.show()
+QTimer.singleShot(0, player.start)
+timings = {}
+QTimer.singleShot(0, lambda: timings.setdefault('window', time.perf_counter() - main.STARTUP_STARTED))
+def logged_in():
+    timings['validated'] = time.perf_counter() - main.STARTUP_STARTED
+    print(main.json.dumps(timings), flush=True)
+    os._exit(0)
+player.loggedIn.connect(logged_in)
+app.exec_()
+'''
+PERCENTILES = (50, 90, 95, 99)
+WAIT_TIMEOUT = 300
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    summary = {'n': len(ordered), 'mean_ms': sum(ordered) / len(ordered) * 1000, 'max_ms': ordered[-1] * 1000}
+    for percentile in PERCENTILES:
+        # Nearest rank, so small sample counts report a value that was actually measured
+        rank = max(0, -(-percentile * len(ordered) // 100) - 1)
+        summary[f'p{percentile}_ms'] = ordered[rank] * 1000
+    return summary
+
+
+def peak_rss(children=False):
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Runner:
+
+    def __init__(self, args):
+        from PyQt5.QtWidgets import QApplication
+        self.args = args
+        self.app = QApplication.instance() or QApplication([])
+        self.samples = {}
+
+    def record(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def wait_for(self, done):
+        from PyQt5.QtCore import QEventLoop, QTimer
+        # The heartbeat wakes the blocking processEvents so the timeout is checked even without events
+        heartbeat = QTimer()
+        heartbeat.start(50)
+        deadline = time.perf_counter() + WAIT_TIMEOUT
+        while not done():
+            if time.perf_counter() > deadline:
+                raise TimeoutError('scenario did not finish in time')
+            self.app.processEvents(QEventLoop.AllEvents | QEventLoop.WaitForMoreEvents)
+        heartbeat.stop()
+
+    def session(self, server):
+        from main import WebDavSession
+        session = WebDavSession()
+        session.set_credentials(server.username, 'password')
+        return session
+
+    def dav_url(self, server, path=''):
+        from urllib.parse import quote
+        return server.server_url + 'remote.php/dav/files/' + server.username + '/' + quote(path)
+
+    def tree_view(self):
+        from PyQt5.QtWidgets import QTreeView
+        from main import FileTreeModel, FileSortProxyModel
+        model = FileTreeModel()
+        proxy = FileSortProxyModel()
+        proxy.setSourceModel(model)
+        view = QTreeView()
+        view.setModel(proxy)
+        view.setUniformRowHeights(True)
+        view.setSortingEnabled(True)
+        view.resize(800, 600)
+        view.show()
+        return model, proxy, view
+
+    def run_tree(self, name):
+        from main import LoginDialog, ListingService, MultistatusParser, FileNode, parse_multistatus, PROPFIND_BODY
+        from webdav_standin import StandInServer, SyntheticTree
+        tree = SyntheticTree(**TREES[name])
+        with StandInServer(tree, latency=self.args.latency / 1000, bandwidth=self.args.bandwidth * 1024 or None) as server:
+            for _ in range(self.args.repeats):
+                # Login always starts from a fresh session, like the first request after startup
+                dialog = LoginDialog(self.session(server))
+                started = time.perf_counter()
+                assert dialog.check_credentials(server.server_url, server.username, 'password')
+                self.record('login', time.perf_counter() - started)
+                dialog.deleteLater()
+
+            session = self.session(server)
+            body = session.propfind(self.dav_url(server), data=PROPFIND_BODY).content
+            for _ in range(self.args.repeats):
+                started = time.perf_counter()
+                entries = parse_multistatus(body)
+                self.record('parse', time.perf_counter() - started)
+            children = entries[1:]
+
+            for _ in range(self.args.repeats):
+                model, proxy, view = self.tree_view()
+                started = time.perf_counter()
+                model.append_entries(model.root, children)
+                # Scrolling to the end pulls every remaining batch through fetchMore
+                while model.canFetchMore(model.index_for_node(model.root)):
+                    model.fetchMore(model.index_for_node(model.root))
+                self.app.processEvents()
+                self.record('tree.populate', time.perf_counter() - started)
+                assert proxy.rowCount() == len(children)
+                view.close()
+
+            service = ListingService(session)
+            for _ in range(self.args.repeats):
+                model, proxy, view = self.tree_view()
+                state = {}
+                service.listingBatch.connect(lambda path, batch: (state.setdefault('first', time.perf_counter()),
+                                                                  model.append_entries(model.node_for_path(path), batch)))
+                service.listingReady.connect(lambda path, entry: state.setdefault('ready', time.perf_counter()))
+                service.listingFailed.connect(lambda path, message: state.setdefault('failed', message))
+                model.set_state(model.root, FileNode.LOADING)
+                started = time.perf_counter()
+                service.request(self.dav_url(server), '')
+                self.wait_for(lambda: 'ready' in state or 'failed' in state)
+                assert 'failed' not in state, state.get('failed')
+                if 'first' in state:
+                    self.record('listing.first_batch', state['first'] - started)
+                self.record('listing.ready', state['ready'] - started)
+                service.listingBatch.disconnect()
+                service.listingReady.disconnect()
+                service.listingFailed.disconnect()
+                view.close()
+
+            if tree.depth > 1:
+                for _ in range(self.args.repeats):
+                    path = ''
+                    while tree.is_folder(path + 'Папка 0/'):
+                        path += 'Папка 0/'
+                        started = time.perf_counter()
+                        response = session.propfind(self.dav_url(server, path), data=PROPFIND_BODY, stream=True)
+                        parser = MultistatusParser()
+                        for chunk in response.iter_content(64 * 1024):
+                            parser.feed(chunk)
+                        parser.finish()
+                        self.record('navigate.level', time.perf_counter() - started)
+            service.pool.waitForDone()
+        return {'entries': len(children)}
+
+    def run_stream(self):
+        import requests
+        from main import ChunkCache, StreamProxy
+        from webdav_standin import StandInServer, SyntheticTree
+        size = self.args.stream_size * 1024 * 1024
+        tree = SyntheticTree(width=0, depth=0, files=2, video_ratio=1, file_size=size)
+        path = tree.videos()[0]
+        mebibyte = 1024 * 1024
+        with StandInServer(tree, latency=self.args.latency / 1000, bandwidth=self.args.bandwidth * 1024 or None) as server, \
+                tempfile.TemporaryDirectory() as directory:
+            for repeat in range(self.args.repeats):
+                # A fresh cache per repeat, so every cold read really goes to the server
+                proxy = StreamProxy(self.session(server), ChunkCache(os.path.join(directory, str(repeat)), size * 2))
+                proxy.base_url = self.dav_url(server)
+                url = proxy.url_for(path)
+                for label, offset in (('start', 0), ('seek', size // 2), ('cached', 0)):
+                    started = time.perf_counter()
+                    received = 0
+                    first = None
+                    with requests.get(url, headers={'Range': f'bytes={offset}-{offset + mebibyte - 1}'}, stream=True) as response:
+                        assert response.status_code == 206, response.status_code
+                        for chunk in response.iter_content(64 * 1024):
+                            if first is None:
+                                first = time.perf_counter()
+                            received += len(chunk)
+                    assert received == mebibyte, received
+                    self.record(f'stream.{label}.first_byte', first - started)
+                    self.record(f'stream.{label}.first_mib', time.perf_counter() - started)
+                proxy.stop()
+        return {'file_size': size}
+
+    def run_startup(self):
+        from webdav_standin import StandInServer, SyntheticTree
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with StandInServer(SyntheticTree(**STARTUP_TREE), latency=self.args.latency / 1000,
+                           bandwidth=self.args.bandwidth * 1024 or None) as server, tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'config.json'), 'w') as config_file:
+                json.dump({'server_url': server.server_url, 'username': server.username, 'password': 'password'}, config_file)
+            for repeat in range(self.args.repeats + 1):
+                # The app keeps its config and cache next to the working directory, the first run starts without a snapshot
+                completed = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, package], cwd=directory,
+                                           capture_output=True, text=True, timeout=WAIT_TIMEOUT)
+                if completed.returncode != 0:
+                    raise RuntimeError(completed.stderr)
+                timings = json.loads(completed.stdout.strip().splitlines()[-1])
+                label = 'cold' if repeat == 0 else 'snapshot'
+                for name, seconds in timings.items():
+                    self.record(f'startup.{label}.{name}', seconds)
+        return {'entries': len(SyntheticTree(**STARTUP_TREE).children(''))}
+
+    def run_filter(self):
+        from main import DavEntry, FileNode
+        from webdav_standin import SyntheticTree
+        tree = SyntheticTree(**FILTER_TREE)
+        model, proxy, view = self.tree_view()
+        stack = ['']
+        while stack:
+            # Listings go straight into the model, the scenario measures the filter and not the network
+            path = stack.pop()
+            node = model.node_for_path(path)
+            children = tree.children(path)
+            model.append_entries(node, [DavEntry(name, is_collection, 0, '', 0, '') for name, is_collection in children])
+            model.set_state(node, FileNode.LOADED)
+            stack.extend(path + name + '/' for name, is_collection in children if is_collection)
+        entries = sum(len(node.entries) for node in model.folders.values())
+        for _ in range(self.args.repeats):
+            for query in FILTER_QUERIES:
+                # Typed forward and erased again, every prefix is one keystroke
+                for text in [query[:i] for i in range(1, len(query) + 1)] + [query[:i] for i in range(len(query) - 1, -1, -1)]:
+                    started = time.perf_counter()
+                    model.set_filter(text)
+                    filtered = time.perf_counter()
+                    # Painting the rows costs about as much as an ordinary repaint of the view, it is reported apart
+                    self.app.processEvents()
+                    self.record('filter.keystroke', filtered - started)
+                    self.record('filter.repaint', time.perf_counter() - filtered)
+        view.close()
+        return {'entries': entries}
+
+
+def run_child(args):
+    logging.disable(logging.CRITICAL)
+    runner = Runner(args)
+    started = time.perf_counter()
+    if args.child == 'stream':
+        info = runner.run_stream()
+    elif args.child == 'startup':
+        info = runner.run_startup()
+    elif args.child == 'filter':
+        info = runner.run_filter()
+    else:
+        info = runner.run_tree(args.child)
+    result = {
+        'wall_s': time.perf_counter() - started,
+        # The app runs in its own processes for startup, so their high-water mark is the one that matters
+        'peak_rss': peak_rss(children=args.child == 'startup'),
+        'info': info,
+        'metrics': {name: summarize(samples) for name, samples in runner.samples.items()},
+    }
+    print(json.dumps(result))
+
+
+def run_scenario(name, args):
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, '--repeats', str(args.repeats),
+               '--latency', str(args.latency), '--bandwidth', str(args.bandwidth), '--stream-size', str(args.stream_size)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"scenario {name} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print(f"\n{'scenario':<10} {'metric':<26} {'old p50':>9} {'new p50':>9} {'old p95':>9} {'new p95':>9} {'p50 ratio':>9}")
+    for name, scenario in results['scenarios'].items():
+        old_scenario = baseline['scenarios'].get(name)
+        if not old_scenario:
+            continue
+        for metric, summary in scenario['metrics'].items():
+            old = old_scenario['metrics'].get(metric)
+            if not old:
+                continue
+            ratio = summary['p50_ms'] / old['p50_ms'] if old['p50_ms'] else float('nan')
+            print(f"{name:<10} {metric:<26} {old['p50_ms']:>9.2f} {summary['p50_ms']:>9.2f} "
+                  f"{old['p95_ms']:>9.2f} {summary['p95_ms']:>9.2f} {ratio:>8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0, help='added before every response, ms')
+    parser.add_argument('--bandwidth', type=int, default=0, help='shared server bandwidth, KiB/s (0 = unlimited)')
+    parser.add_argument('--stream-size', type=int, default=64, help='size of the streamed file, MiB')
+    parser.add_argument('--output', help='results file (default: benchmarks/results/<time>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args)
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'repeats': args.repeats, 'latency_ms': args.latency, 'bandwidth_kib': args.bandwidth,
+                     'stream_size_mib': args.stream_size},
+        'scenarios': {},
+    }
+    print(f"{'scenario':<10} {'metric':<26} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'peak RSS MiB':>13}")
+    for name in args.scenarios:
+        scenario = results['scenarios'][name] = run_scenario(name, args)
+        rss = f"{scenario['peak_rss'] / 2**20:.1f}" if scenario['peak_rss'] else '-'
+        for metric, summary in scenario['metrics'].items():
+            print(f"{name:<10} {metric:<26} {summary['p50_ms']:>9.2f} {summary['p95_ms']:>9.2f} {summary['max_ms']:>9.2f} {rss:>13}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Offline check and benchmark of the paged WebDAV SEARCH video listing against the stand-in server.
+
+Run from the repository root:
+
+    python benchmarks/bench_video_search.py [--width 20] [--depth 2] [--files 40] [--page-size 500]
+"""
+import argparse, logging, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import WebDavSession, SearchNotSupported, search_videos
+from webdav_standin import StandInServer, SyntheticTree
+
+
+def collect(server, page_size):
+    session = WebDavSession()
+    session.set_credentials(server.username, 'password')
+    pages = 0
+    paths = []
+    started = time.perf_counter()
+    for page in search_videos(session, server.server_url, server.username, page_size):
+        pages += 1
+        paths.extend(path for path, entry in page)
+    return paths, pages, time.perf_counter() - started, session.stats.snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--files', type=int, default=40)
+    parser.add_argument('--page-size', type=int, nargs='+', default=[100, 500, 2000])
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    tree = SyntheticTree(width=args.width, depth=args.depth, files=args.files)
+    expected = tree.videos()
+    print(f"Synthetic library: {len(expected)} videos")
+    with StandInServer(tree) as server:
+        for page_size in args.page_size:
+            paths, pages, elapsed, stats = collect(server, page_size)
+            assert len(paths) == len(set(paths)), "duplicate entries across pages"
+            assert sorted(paths) == expected, "paged result differs from the library"
+            print(f"page size {page_size:>5}: {pages:>4} pages, {elapsed:.3f} s, {len(paths) / elapsed:,.0f} videos/s, "
+                  f"connections new/reused {stats['new_connections']}/{stats['reused_connections']}")
+
+    with StandInServer(tree, search_supported=False) as server:
+        try:
+            collect(server, 100)
+        except SearchNotSupported as e:
+            print(f"SEARCH disabled: SearchNotSupported({e}) raised as expected, the app falls back to the library index")
+        else:
+            raise AssertionError("SearchNotSupported was not raised")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""A small Nextcloud-compatible WebDAV stand-in for offline benchmarks.
+
+It serves a deterministic synthetic tree under ``/remote.php/dav/files/<user>/`` and answers
+PROPFIND (Depth 0/1), DASL SEARCH with limit/firstresult paging, ranged GET/HEAD requests and
+``/index.php/core/preview`` thumbnails. Nothing is stored: listings, etags, file ids and file bytes
+are all derived from the path.
+
+``latency`` (seconds) is added before every response, ``bandwidth`` (bytes/s) caps the body bytes
+of all connections together, like a shared link would.
+
+    with StandInServer(SyntheticTree(width=20, depth=3, files=50), latency=0.05) as server:
+        print(server.server_url, server.username)
+"""
+import hashlib, struct, threading, time, zlib
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import quote, unquote, urlparse, parse_qs
+from xml.etree import ElementTree as ET
+
+VIDEO_TYPES = {'.mkv': 'video/x-matroska', '.mp4': 'video/mp4', '.avi': 'video/x-msvideo'}
+OTHER_TYPES = {'.srt': 'application/x-subrip', '.jpg': 'image/jpeg', '.pdf': 'application/pdf'}
+SEARCH_NS = '{https://github.com/icewind1991/SearchDAV/ns}'
+THROTTLE_SLICE = 16 * 1024
+
+
+class SyntheticTree:
+    """Every folder has ``width`` subfolders (down to ``depth``) and ``files`` files, of which
+    ``video_ratio`` are videos. ``version`` can be bumped per path to change etags of a subtree."""
+
+    def __init__(self, width=10, depth=2, files=20, video_ratio=0.5, file_size=8 * 1024 * 1024, mtime=1727776800):
+        self.width = width
+        self.depth = depth
+        self.files = files
+        self.video_ratio = video_ratio
+        self.file_size = file_size
+        self.mtime = mtime
+        self.versions = {}
+        self.video_list = None
+
+    def bump(self, path):
+        self.versions[path] = self.versions.get(path, 0) + 1
+        self.video_list = None
+
+    def etag(self, path):
+        version = sum(value for changed, value in self.versions.items() if changed.startswith(path))
+        return hashlib.md5(f'{path}:{version}'.encode('utf-8')).hexdigest()
+
+    def fileid(self, path):
+        return int(hashlib.md5(path.encode('utf-8')).hexdigest()[:8], 16)
+
+    def preview(self, fileid, width, height):
+        """A solid-colour PNG, so clients have real image bytes to decode."""
+        colour = struct.pack('>I', fileid)[1:]
+        rows = b''.join(b'\x00' + colour * width for _ in range(height))
+
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+        return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+                + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+    def is_folder(self, path):
+        if path == '':
+            return True
+        parts = path.rstrip('/').split('/')
+        return path.endswith('/') and len(parts) <= self.depth and all(part.startswith('Папка ') for part in parts)
+
+    def is_file(self, path):
+        folder, _, name = path.rpartition('/')
+        folder = folder + '/' if folder else ''
+        return self.is_folder(folder) and any(entry[0] == name for entry in self.children(folder) if not entry[1])
+
+    def children(self, path):
+        level = path.count('/')
+        entries = []
+        if level < self.depth:
+            for i in range(self.width):
+                entries.append((f'Папка {i}', True))
+        videos = int(self.files * self.video_ratio)
+        for i in range(self.files):
+            if i < videos:
+                ext = list(VIDEO_TYPES)[i % len(VIDEO_TYPES)]
+                entries.append((f'Серия {i:05d}{ext}', False))
+            else:
+                ext = list(OTHER_TYPES)[i % len(OTHER_TYPES)]
+                entries.append((f'Файл {i:05d}{ext}', False))
+        return entries
+
+    def content_type(self, name):
+        ext = name[name.rfind('.'):]
+        return VIDEO_TYPES.get(ext) or OTHER_TYPES.get(ext) or 'application/octet-stream'
+
+    def videos(self):
+        if self.video_list is None:
+            found = []
+            stack = ['']
+            while stack:
+                folder = stack.pop()
+                for name, is_collection in self.children(folder):
+                    if is_collection:
+                        stack.append(folder + name + '/')
+                    elif self.content_type(name).startswith('video/'):
+                        found.append(folder + name)
+            self.video_list = sorted(found)
+        return self.video_list
+
+    def read(self, path, start, end):
+        # Repeating 4 KiB block derived from the path, so every byte is reproducible
+        block = hashlib.sha256(path.encode('utf-8')).digest() * 128
+        offset = start % len(block)
+        length = end - start + 1
+        repeated = block * (length // len(block) + 2)
+        return repeated[offset:offset + length]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def tree(self):
+        return self.server.tree
+
+    def dav_path(self):
+        path = unquote(urlparse(self.path).path)
+        prefix = self.server.files_prefix
+        if not path.startswith(prefix.rstrip('/')):
+            return None
+        return path[len(prefix):]
+
+    def authorized(self):
+        if self.headers.get('Authorization', '').startswith('Basic '):
+            return True
+        self.send_simple(401, b'')
+        return False
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_response(self, code, message=None):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        super().send_response(code, message)
+
+    def send_simple(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.write_body(body)
+
+    def write_body(self, body):
+        if not self.server.bandwidth:
+            self.wfile.write(body)
+            return
+        view = memoryview(body)
+        for offset in range(0, len(view), THROTTLE_SLICE):
+            piece = view[offset:offset + THROTTLE_SLICE]
+            self.server.throttle(len(piece))
+            self.wfile.write(piece)
+
+    def response_xml(self, path, is_collection):
+        href = quote(self.server.files_prefix + path)
+        mtime = formatdate(self.tree.mtime, usegmt=True)
+        if is_collection:
+            props = f'<d:resourcetype><d:collection/></d:resourcetype><d:getetag>"{self.tree.etag(path)}"</d:getetag>'
+        else:
+            name = path.rsplit('/', 1)[-1]
+            props = (f'<d:resourcetype/><d:getcontentlength>{self.tree.file_size}</d:getcontentlength>'
+                     f'<d:getetag>"{self.tree.etag(path)}"</d:getetag>'
+                     f'<d:getcontenttype>{self.tree.content_type(name)}</d:getcontenttype>')
+        return (f'<d:response><d:href>{href}</d:href><d:propstat><d:prop>{props}'
+                f'<oc:fileid>{self.tree.fileid(path)}</oc:fileid>'
+                f'<d:getlastmodified>{mtime}</d:getlastmodified></d:prop>'
+                f'<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>')
+
+    def send_multistatus(self, responses):
+        body = ('<?xml version="1.0" encoding="utf-8"?>\n<d:multistatus xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">'
+                + ''.join(responses) + '</d:multistatus>').encode('utf-8')
+        self.send_simple(207, body, 'application/xml; charset=utf-8')
+
+    def do_PROPFIND(self):
+        self.read_body()
+        if not self.authorized():
+            return
+        path = self.dav_path()
+        if path is None:
+            return self.send_simple(404, b'')
+        if self.tree.is_folder(path if path.endswith('/') or path == '' else path + '/'):
+            path = path if path.endswith('/') or path == '' else path + '/'
+            responses = [self.response_xml(path, True)]
+            if self.headers.get('Depth', '1') != '0':
+                for name, is_collection in self.tree.children(path):
+                    responses.append(self.response_xml(path + name + ('/' if is_collection else ''), is_collection))
+            return self.send_multistatus(responses)
+        if self.tree.is_file(path):
+            return self.send_multistatus([self.response_xml(path, False)])
+        self.send_simple(404, b'')
+
+    def do_SEARCH(self):
+        body = self.read_body()
+        if not self.authorized():
+            return
+        if not self.server.search_supported or unquote(urlparse(self.path).path).rstrip('/') != '/remote.php/dav':
+            return self.send_simple(501, b'')
+        query = ET.fromstring(body)
+        literal = query.find('.//{DAV:}literal')
+        if literal is None or literal.text != 'video/%':
+            return self.send_simple(422, b'')
+        nresults = query.find('.//{DAV:}nresults')
+        first = query.find(f'.//{SEARCH_NS}firstresult')
+        limit = int(nresults.text) if nresults is not None else None
+        offset = int(first.text) if first is not None else 0
+        videos = self.tree.videos()
+        page = videos[offset:offset + limit] if limit else videos[offset:]
+        self.send_multistatus([self.response_xml(path, False) for path in page])
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        url = urlparse(self.path)
+        if url.path == '/index.php/core/preview':
+            return self.send_preview(parse_qs(url.query))
+        path = self.dav_path()
+        if path is None or not self.tree.is_file(path):
+            return self.send_simple(404, b'')
+        size = self.tree.file_size
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[6:].split(',')[0].partition('-')
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', self.tree.content_type(path))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', f'"{self.tree.etag(path)}"')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        chunk = 256 * 1024
+        try:
+            for offset in range(start, end + 1, chunk):
+                self.write_body(self.tree.read(path, offset, min(end, offset + chunk - 1)))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+    def send_preview(self, query):
+        try:
+            fileid = int(query['fileId'][0])
+            width = min(int(query.get('x', ['64'])[0]), 1024)
+            height = min(int(query.get('y', ['64'])[0]), 1024)
+        except (KeyError, ValueError):
+            return self.send_simple(400, b'')
+        self.send_simple(200, self.tree.preview(fileid, width, height), 'image/png')
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, tree=None, username='user', search_supported=True, handler=StandInHandler, latency=0.0, bandwidth=None):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.tree = tree or SyntheticTree()
+        self.username = username
+        self.search_supported = search_supported
+        self.files_prefix = f'/remote.php/dav/files/{username}/'
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_lock = threading.Lock()
+        self.link_free_at = 0.0
+        self.thread = None
+
+    def throttle(self, size):
+        # Every slice books the next free slot on the shared link, so parallel requests split the bandwidth
+        with self.throttle_lock:
+            now = time.monotonic()
+            start = max(now, self.link_free_at)
+            self.link_free_at = start + size / self.bandwidth
+            delay = self.link_free_at - now
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def server_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='webdav-standin', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
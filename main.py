@@ -1,39 +1,3037 @@
-import sys, requests, logging, json, os, vlc
+import time
+STARTUP_STARTED = time.perf_counter()
+
+import sys, requests, logging, json, os, threading, calendar, sqlite3, hashlib, secrets, ctypes, shutil, io, cProfile, pstats, functools, re, heapq, unicodedata
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
 from datetime import datetime
-from urllib.parse import quote
-from PyQt5.QtCore import pyqtSignal, Qt, QTimer
-from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QWidget, QLabel, QTreeWidget, QTreeWidgetItem, QLineEdit,
-                             QDialog, QDialogButtonBox, QTextEdit, QAction, QDockWidget, QMessageBox, QPushButton, QFileDialog,
-                             QSlider,QHBoxLayout, QComboBox)
+from itertools import accumulate, chain
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from queue import SimpleQueue
+from email.utils import parsedate_tz, mktime_tz
+from urllib.parse import quote, unquote, urlparse
+from xml.sax.saxutils import escape as xml_escape
+from xml.etree import ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from PyQt5.QtCore import (pyqtSignal, Qt, QTimer, QObject, QRunnable, QThreadPool, QAbstractItemModel, QModelIndex,
+                          QSortFilterProxyModel, QPoint, QSize, QEvent, QBuffer, QIODevice)
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QFontDatabase
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QWidget, QLabel, QTreeView, QLineEdit,
+                             QDialog, QDialogButtonBox, QPlainTextEdit, QAction, QDockWidget, QMessageBox, QPushButton, QFileDialog,
+                             QSlider,QHBoxLayout, QComboBox, QListWidget, QListWidgetItem, QInputDialog, QMenu, QStyle, QCheckBox)
+
+vlc = None  # imported by import_vlc() on first use
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+
+CONFIG_FILE = 'config.json'
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), 'cache')
+LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), 'logs', 'nextcloud-video-player.log')
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+LOG_VIEW_MAX_LINES = 5000
+LOG_VIEW_MAX_CHARS = 2 * 1024 * 1024
+LOG_VIEW_LEVELS = {'': logging.DEBUG, 'urllib3': logging.INFO}
+LOG_FLUSH_INTERVAL = 250
+METRICS_RESERVOIR = 1024
+METRICS_EVENTS = 10000
+METRICS_REFRESH_INTERVAL = 1000
+PROFILE_REPORT_LINES = 30
+LISTING_CACHE_FILE = os.path.join(CACHE_DIR, 'listings.sqlite3')
+LISTING_CACHE_MAX_BYTES = 64 * 1024 * 1024
+METADATA_CACHE_FILE = os.path.join(CACHE_DIR, 'metadata.sqlite3')
+METADATA_PROBE_THREADS = 2
+METADATA_PROBE_TIMEOUT = 15 * 1000
+# Probes only read container headers and indexes, from this many chunks at either end of the file
+METADATA_PROBE_CHUNKS = 2
+METADATA_FLUSH_INTERVAL = 250
+STREAM_CACHE_DIR = os.path.join(CACHE_DIR, 'stream')
+STREAM_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_READAHEAD_CHUNKS = 8
+STREAM_READAHEAD_THREADS = 2
+THUMBNAIL_CACHE_DIR = os.path.join(CACHE_DIR, 'thumbnails')
+THUMBNAIL_DISK_MAX_BYTES = 256 * 1024 * 1024
+THUMBNAIL_MEMORY_BYTES = 64 * 1024 * 1024
+THUMBNAIL_WIDTH = 96
+THUMBNAIL_HEIGHT = 54
+THUMBNAIL_THREADS = 4
+THUMBNAIL_SCHEDULE_DELAY = 50
+SIDECAR_CACHE_DIR = os.path.join(CACHE_DIR, 'sidecars')
+SIDECAR_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SIDECAR_THREADS = 4
+SIDECAR_MAX_FILES = 16
+SIDECAR_PRIORITY = 4  # libvlc_media_slave_t priority of files added by the user
+PREVIEW_CACHE_DIR = os.path.join(CACHE_DIR, 'previews')
+PREVIEW_CACHE_MAX_BYTES = 128 * 1024 * 1024
+PREVIEW_MAX_FRAMES = 100
+PREVIEW_MIN_INTERVAL = 10 * 1000
+PREVIEW_COLUMNS = 10
+PREVIEW_TILE_WIDTH = 160
+PREVIEW_TILE_HEIGHT = 90
+PREVIEW_START_DELAY = 10 * 1000
+PREVIEW_FRAME_TIMEOUT = 5.0
+PREVIEW_STEP_DELAY = 0.5
+PREVIEW_MAX_RATE = 1024 * 1024
+DOWNLOAD_DIR = os.path.join(os.path.expanduser('~'), 'Nextcloud Videos')
+DOWNLOAD_SEGMENT_SIZE = 8 * 1024 * 1024
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_MAX_CONNECTIONS = 16
+DOWNLOAD_FILES_PARALLEL = 2
+PLAYER_REPAINT_INTERVAL = 100
+PLAYER_TRACKS_DELAY = 200
+PLAYLIST_PREBUFFER_MS = 60 * 1000
+PLAYLIST_PARSE_TIMEOUT = 10 * 1000
+NETWORK_EWMA_ALPHA = 0.3
+NETWORK_RTT_WINDOW = 16
+NETWORK_CACHING_DEFAULT = 1000
+NETWORK_CACHING_MIN = 300
+NETWORK_CACHING_MAX = 10000
+NETWORK_ASSUMED_DURATION = 45 * 60
+FILE_CACHING = 300
+STALL_GRACE_AFTER_SEEK = 2.0
+REQUEST_TIMEOUT = (5, 30)  # (connect, read) seconds
+LISTING_THREADS = 4
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+LISTING_CHUNK_SIZE = 64 * 1024
+TREE_FETCH_BATCH = 500
+CRAWL_CONCURRENCY = 4
+EXPAND_ALL_DEPTH = 32
+PREFETCH_DEPTH = 1
+PREFETCH_MAX_DEPTH = 5
+PREFETCH_BUDGET = 20
+PREFETCH_MAX_BUDGET = 500
+PREFETCH_THREADS = 2
+PREFETCH_TTL = 120
+PREFETCH_MAX_FOLDERS = 1000
+PREFETCH_SLOW_RESPONSE = 1.0
+PREFETCH_MIN_DELAY = 0.5
+PREFETCH_MAX_DELAY = 30.0
+FILTER_FETCH_BATCH = 50
+FILTER_SAMPLE_CHARS = 64 * 1024
+FILTER_EXPAND_STEP = 1
+FILTER_EXPAND_MAX = 200
+SEARCH_LIMIT = 200
+# Bumped whenever fold_text changes, the stored folded names are then rebuilt
+LIBRARY_FOLD_VERSION = 1
+VIDEO_SEARCH_PAGE = 500
+TREE_COLUMNS = ('Файлы', 'Длительность', 'Разрешение', 'Видео', 'Аудио', 'Субтитры')
+SORT_ROLE = Qt.UserRole + 1
+VIDEO_EXTENSIONS = ('.mkv', '.mp4', '.avi', '.mov', '.m4v', '.webm', '.wmv', '.flv', '.ts', '.m2ts', '.mpg', '.mpeg', '.ogv', '.3gp')
+SUBTITLE_EXTENSIONS = ('.srt', '.ass', '.ssa', '.vtt')
+AUDIO_EXTENSIONS = ('.mka', '.ac3', '.eac3', '.dts', '.aac', '.m4a', '.mp3', '.flac', '.ogg', '.opus', '.wav')
+
+PROPFIND_BODY = b'''<?xml version="1.0" encoding="utf-8"?>
+<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">
+  <d:prop><d:resourcetype/><d:getcontentlength/><d:getetag/><d:getlastmodified/><oc:fileid/></d:prop>
+</d:propfind>'''
+
+VIDEO_SEARCH_BODY = '''<?xml version="1.0" encoding="UTF-8"?>
+<d:searchrequest xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns" xmlns:ns="https://github.com/icewind1991/SearchDAV/ns">
+  <d:basicsearch>
+    <d:select><d:prop><d:resourcetype/><d:getcontentlength/><d:getetag/><d:getlastmodified/><oc:fileid/></d:prop></d:select>
+    <d:from><d:scope><d:href>{scope}</d:href><d:depth>infinity</d:depth></d:scope></d:from>
+    <d:where><d:like><d:prop><d:getcontenttype/></d:prop><d:literal>video/%</d:literal></d:like></d:where>
+    <d:orderby><d:order><d:prop><d:displayname/></d:prop><d:ascending/></d:order></d:orderby>
+    <d:limit><d:nresults>{limit}</d:nresults><ns:firstresult>{offset}</ns:firstresult></d:limit>
+  </d:basicsearch>
+</d:searchrequest>'''
+
+DavEntry = namedtuple('DavEntry', ['name', 'is_collection', 'size', 'etag', 'mtime', 'href', 'fileid'], defaults=(None,))
+
+
+
+class LogSink(logging.Handler):
+
+
+    def __init__(self, max_lines=LOG_VIEW_MAX_LINES, max_chars=LOG_VIEW_MAX_CHARS, levels=None):
+        super().__init__()
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self.buffer_lock = threading.Lock()
+        self.lines = deque()  # ring buffer of formatted records, oldest first
+        self.total_chars = 0
+        self.pending = deque(maxlen=max_lines)  # records the widget has not shown yet
+        self.set_levels(LOG_VIEW_LEVELS if levels is None else levels)
+
+
+    def set_levels(self, levels):
+        with self.buffer_lock:
+            self.levels = dict(levels)
+            self.level_cache = {}
+
+
+    def level_for(self, name):
+        level = self.level_cache.get(name)
+        if level is None:
+            # The most specific configured logger wins: "urllib3" also covers "urllib3.connectionpool"
+            prefixes = [prefix for prefix in self.levels if not prefix or name == prefix or name.startswith(prefix + '.')]
+            level = self.levels[max(prefixes, key=len)] if prefixes else logging.NOTSET
+            self.level_cache[name] = level
+        return level
+
+
+    def emit(self, record):
+        if record.levelno < self.level_for(record.name):
+            return
+        try:
+            message = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.buffer_lock:
+            self.lines.append(message)
+            self.total_chars += len(message) + 1
+            while len(self.lines) > 1 and (len(self.lines) > self.max_lines or self.total_chars > self.max_chars):
+                self.total_chars -= len(self.lines.popleft()) + 1
+            self.pending.append(message)
+
+
+    def take_pending(self):
+        with self.buffer_lock:
+            lines = list(self.pending)
+            self.pending.clear()
+        return lines
+
+
+    def snapshot(self):
+        with self.buffer_lock:
+            self.pending.clear()
+            return list(self.lines)
+
+
+
+class LogFile:
+
+
+    def __init__(self, filename=LOG_FILE):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.file_handler = RotatingFileHandler(filename, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS,
+                                                encoding='utf-8', delay=True)
+        self.file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        # Callers only enqueue the record, formatting and disk writes happen on the listener thread
+        self.queue = SimpleQueue()
+        self.handler = QueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+
+
+    def flush(self):
+        # Stopping the listener drains the queue, so an export contains every record logged so far
+        self.listener.stop()
+        self.file_handler.flush()
+        self.listener.start()
+
+
+    def files(self):
+        base = self.file_handler.baseFilename
+        names = [f'{base}.{number}' for number in range(LOG_FILE_BACKUPS, 0, -1)] + [base]
+        return [name for name in names if os.path.exists(name)]
+
+
+    def export(self, filename):
+        self.flush()
+        with open(filename, 'wb') as output:
+            for name in self.files():
+                with open(name, 'rb') as part:
+                    shutil.copyfileobj(part, output)
+
+
+    def close(self):
+        self.listener.stop()
+        self.file_handler.close()
+
+
+
+class BasicAuthWithUnicode(requests.auth.AuthBase):
+
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+    def __call__(self, r):
+        import base64
+        auth_str = f'{self.username}:{self.password}'
+        b64_auth_str = base64.b64encode(auth_str.encode('utf-8')).decode('utf-8')
+        r.headers['Authorization'] = f'Basic {b64_auth_str}'
+        return r
+
+
+
+class NullSpan:
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        return False
+
+
+
+class Span:
+    __slots__ = ('metrics', 'name', 'started')
+
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+
+class Metrics:
+    NULL_SPAN = NullSpan()
+
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.counters = {}
+        self.spans = {}  # name -> [count, total seconds, max seconds, recent durations]
+        self.events = deque(maxlen=METRICS_EVENTS)
+        self.sources = {}
+
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def span(self, name):
+        # Disabled tracing costs one attribute check and hands out a shared do-nothing object
+        return Span(self, name) if self.enabled else self.NULL_SPAN
+
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = [0, 0.0, 0.0, deque(maxlen=METRICS_RESERVOIR)]
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+            span[3].append(seconds)
+            self.events.append((time.time(), name, seconds, threading.current_thread().name))
+
+
+    def add_source(self, name, snapshot):
+        self.sources[name] = snapshot
+
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.spans.clear()
+            self.events.clear()
+
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            spans = {name: (count, total, maximum, sorted(recent)) for name, (count, total, maximum, recent) in self.spans.items()}
+        for source, snapshot in self.sources.items():
+            for key, value in snapshot().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    counters[f'{source}.{key}'] = value
+        summaries = {}
+        for name, (count, total, maximum, recent) in spans.items():
+            summaries[name] = {'count': count, 'total_s': total, 'max_ms': maximum * 1000,
+                               'p50_ms': recent[len(recent) // 2] * 1000,
+                               'p95_ms': recent[min(len(recent) - 1, len(recent) * 95 // 100)] * 1000}
+        return {'counters': counters, 'spans': summaries}
+
+
+    def to_jsonl(self):
+        snapshot = self.snapshot()
+        now = time.time()
+        lines = [json.dumps({'type': 'counter', 'time': now, 'name': name, 'value': value})
+                 for name, value in sorted(snapshot['counters'].items())]
+        lines += [json.dumps(dict(summary, type='span', time=now, name=name)) for name, summary in sorted(snapshot['spans'].items())]
+        with self.lock:
+            events = list(self.events)
+        lines += [json.dumps({'type': 'event', 'time': started, 'name': name, 'duration_ms': seconds * 1000, 'thread': thread})
+                  for started, name, seconds, thread in events]
+        return '\n'.join(lines) + '\n'
+
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = self.metric_name(name)
+            lines += [f'# TYPE {metric} gauge', f'{metric} {value}']
+        for name, summary in sorted(snapshot['spans'].items()):
+            metric = self.metric_name(name) + '_seconds'
+            lines += [f'# TYPE {metric} summary',
+                      f'{metric}{{quantile="0.5"}} {summary["p50_ms"] / 1000}',
+                      f'{metric}{{quantile="0.95"}} {summary["p95_ms"] / 1000}',
+                      f'{metric}_sum {summary["total_s"]}',
+                      f'{metric}_count {summary["count"]}']
+        return '\n'.join(lines) + '\n'
+
+
+    def metric_name(self, name):
+        return 'nextcloud_video_player_' + ''.join(char if char.isalnum() else '_' for char in name)
+
+
+metrics = Metrics()
+
+
+
+class ConnectionStats:
+
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.checkouts = 0
+        self.new_connections = 0
+
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+
+    def count_checkout(self, new):
+        with self.lock:
+            self.checkouts += 1
+            if new:
+                self.new_connections += 1
+
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused_connections': self.checkouts - self.new_connections,
+            }
+
+
+
+class NetworkEstimator:
+
+
+    def __init__(self, alpha=NETWORK_EWMA_ALPHA):
+        self.lock = threading.Lock()
+        self.alpha = alpha
+        self.rtt = None
+        self.rtt_samples = deque(maxlen=NETWORK_RTT_WINDOW)
+        self.throughput = None
+        self.stall_score = 0.0
+        self.playbacks = 0
+        self.stalls = 0
+        self.startup_ms = 0
+
+
+    def smooth(self, current, sample):
+        return sample if current is None else current + self.alpha * (sample - current)
+
+
+    def observe_rtt(self, seconds):
+        # The minimum of recent samples, a server that is slow to answer one request does not look like a slow link
+        with self.lock:
+            self.rtt_samples.append(seconds)
+            self.rtt = min(self.rtt_samples)
+
+
+    def observe_transfer(self, size, seconds):
+        # Tiny bodies say more about latency than about bandwidth
+        if seconds <= 0 or size < 64 * 1024:
+            return
+        with self.lock:
+            self.throughput = self.smooth(self.throughput, size / seconds)
+
+
+    def record_playback(self, startup_ms, stalls):
+        with self.lock:
+            self.playbacks += 1
+            self.stalls += stalls
+            self.startup_ms += startup_ms or 0
+            self.stall_score = self.smooth(self.stall_score, min(stalls, 4))
+
+
+    def caching_for(self, size=None, duration_ms=None):
+        with self.lock:
+            rtt, throughput, stall_score = self.rtt, self.throughput, self.stall_score
+        if rtt is None and throughput is None:
+            return NETWORK_CACHING_DEFAULT
+        caching = NETWORK_CACHING_MIN + 4000 * (rtt or 0)
+        if throughput and size:
+            bitrate = size / (duration_ms / 1000 if duration_ms else NETWORK_ASSUMED_DURATION)
+            load = bitrate / throughput
+            # Once the video needs more than half of the link, jitter has to be absorbed by a longer buffer
+            if load > 0.5:
+                caching += (load - 0.5) * 8000
+        # Stalls in recent playbacks mean the estimate was too optimistic
+        caching *= 1 + 0.5 * stall_score
+        return int(min(NETWORK_CACHING_MAX, max(NETWORK_CACHING_MIN, caching)))
+
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'rtt_ms': int(self.rtt * 1000) if self.rtt is not None else None,
+                'throughput': int(self.throughput) if self.throughput is not None else None,
+                'playbacks': self.playbacks,
+                'stalls': self.stalls,
+                'average_startup_ms': self.startup_ms // self.playbacks if self.playbacks else None,
+            }
+
+
+
+class TimedHTTPConnection(HTTPConnection):
+
+
+    def connect(self):
+        # Covers name resolution and the TCP handshake, and the TLS handshake for the HTTPS subclass
+        with metrics.span('http.connect'):
+            super().connect()
+
+
+
+class TimedHTTPSConnection(TimedHTTPConnection, HTTPSConnection):
+    pass
+
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats = self.stats
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = TimedHTTPConnection
+
+
+            def _get_conn(self, timeout=None):
+                conn = super()._get_conn(timeout)
+                stats.count_checkout(getattr(conn, 'sock', None) is None)
+                return conn
+
+        class CountingHTTPSConnectionPool(CountingHTTPConnectionPool, HTTPSConnectionPool):
+            ConnectionCls = TimedHTTPSConnection
+
+        self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+
+
+class WebDavSession(requests.Session):
+
+
+    def __init__(self):
+        super().__init__()
+        self.stats = ConnectionStats()
+        self.estimator = NetworkEstimator()
+        retries = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, status_forcelist=(502, 503, 504),
+                        allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS', 'PROPFIND']), raise_on_status=False)
+        adapter = CountingHTTPAdapter(self.stats, pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.headers['Connection'] = 'keep-alive'
+
+
+    def set_credentials(self, username, password):
+        self.auth = BasicAuthWithUnicode(username, password)
+
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        self.stats.count_request()
+        response = super().request(method, url, **kwargs)
+        metrics.observe(f'http.{method}', response.elapsed.total_seconds())
+        if method == 'HEAD' or (method == 'PROPFIND' and (kwargs.get('headers') or {}).get('Depth') == '0'):
+            # elapsed stops at the response headers, which makes it a usable round trip sample, except for listings
+            # where most of it is the server building the response
+            self.estimator.observe_rtt(response.elapsed.total_seconds())
+        return response
+
+
+    def propfind(self, url, depth="1", **kwargs):
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers['Depth'] = depth
+        return self.request("PROPFIND", url, headers=headers, **kwargs)
+
+
+
+class MultistatusParser:
+    RESPONSE = '{DAV:}response'
+    HREF = '{DAV:}href'
+    COLLECTION = '{DAV:}collection'
+    CONTENTLENGTH = '{DAV:}getcontentlength'
+    ETAG = '{DAV:}getetag'
+    LASTMODIFIED = '{DAV:}getlastmodified'
+    FILEID = '{http://owncloud.org/ns}fileid'
+    MONTHS = {name: number for number, name in enumerate(
+        ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+
+
+    def __init__(self):
+        # expat calls straight into this object, no element tree is ever built
+        self.parser = ET.XMLParser(target=self)
+        self.entries = []
+        self.text = []
+        self.reset_entry()
+
+
+    def reset_entry(self):
+        self.href = None
+        self.is_collection = False
+        self.size = 0
+        self.etag = None
+        self.mtime = 0
+        self.fileid = None
+
+
+    def feed(self, data):
+        self.parser.feed(data)
+        return self.take_entries()
+
+
+    def finish(self):
+        self.parser.close()
+        return self.take_entries()
+
+
+    def take_entries(self):
+        entries, self.entries = self.entries, []
+        return entries
+
+
+    def start(self, tag, attrib):
+        if tag == self.COLLECTION:
+            self.is_collection = True
+        self.text.clear()
+
+
+    def data(self, data):
+        self.text.append(data)
+
+
+    def end(self, tag):
+        if tag == self.HREF:
+            self.href = unquote(''.join(self.text).strip())
+        elif tag == self.CONTENTLENGTH:
+            text = ''.join(self.text).strip()
+            if text:
+                self.size = int(text)
+        elif tag == self.ETAG:
+            self.etag = ''.join(self.text).strip().strip('"') or None
+        elif tag == self.LASTMODIFIED:
+            self.mtime = self.parse_http_date(''.join(self.text).strip())
+        elif tag == self.FILEID:
+            self.fileid = ''.join(self.text).strip() or None
+        elif tag == self.RESPONSE:
+            if self.href is not None:
+                name = self.href.rstrip('/').rsplit('/', 1)[-1]
+                self.entries.append(DavEntry(name, self.is_collection or self.href.endswith('/'),
+                                             self.size, self.etag, self.mtime, self.href, self.fileid))
+            self.reset_entry()
+        self.text.clear()
+
+
+    def close(self):
+        pass
+
+
+    def parse_http_date(self, text):
+        # Fast path for the RFC 1123 form Nextcloud always sends: "Tue, 01 Oct 2024 10:00:00 GMT"
+        try:
+            _, day, month, year, clock, _ = text.split()
+            hours, minutes, seconds = clock.split(':')
+            return calendar.timegm((int(year), self.MONTHS[month], int(day), int(hours), int(minutes), int(seconds)))
+        except (ValueError, KeyError):
+            parsed = parsedate_tz(text)
+            return mktime_tz(parsed) if parsed else 0
+
+
+
+def parse_multistatus(content):
+    parser = MultistatusParser()
+    metrics.count('bytes.listing', len(content))
+    with metrics.span('xml.parse'):
+        return parser.feed(content) + parser.finish()
+
+
+
+def propfind_folder(session, url, depth="1", **kwargs):
+    response = session.propfind(url, depth=depth, data=PROPFIND_BODY, **kwargs)
+    if response.status_code != 207:
+        raise requests.exceptions.HTTPError(f"{response.status_code} {response.reason}", response=response)
+    entries = parse_multistatus(response.content)
+    if not entries:
+        raise ValueError(f"Пустой ответ PROPFIND: {url}")
+    return entries[0], entries[1:]
+
+
+
+def check_login(session, server_url, username, password):
+    """Returns the root listing on success, so the caller does not have to ask for it again."""
+    full_url = server_url + "remote.php/dav/files/" + quote(username, safe='') + "/"
+    try:
+        listing = propfind_folder(session, full_url, auth=BasicAuthWithUnicode(username, password))
+        logging.debug(f"Учётные данные подтверждены, в корне {len(listing[1])} элементов")
+        return listing
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error(f"Запрос не выполнен: {e}")
+        return None
+
+
+
+class ListingCache:
+
+
+    def __init__(self, filename=LISTING_CACHE_FILE, max_bytes=LISTING_CACHE_MAX_BYTES):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS listings (
+                               server TEXT, username TEXT, path TEXT, etag TEXT, children TEXT,
+                               size INTEGER, accessed REAL, PRIMARY KEY (server, username, path))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS listings_accessed ON listings (accessed)')
+        self.db.commit()
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM listings').fetchone()[0]
+
+
+    def get(self, server, username, path):
+        with self.lock:
+            row = self.db.execute('SELECT etag, children FROM listings WHERE server = ? AND username = ? AND path = ?',
+                                  (server, username, path)).fetchone()
+            children = json.loads(row[1]) if row else None
+            # Listings cached before file ids were requested are fetched again once
+            if row is None or children and len(children[0]) < len(DavEntry._fields):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE listings SET accessed = ? WHERE server = ? AND username = ? AND path = ?',
+                            (time.time(), server, username, path))
+            self.db.commit()
+        return row[0], [DavEntry(*child) for child in children]
+
+
+    def put(self, server, username, path, etag, entries):
+        children = json.dumps([list(entry) for entry in entries], ensure_ascii=False)
+        size = len(children.encode('utf-8'))
+        with self.lock:
+            old = self.db.execute('SELECT size FROM listings WHERE server = ? AND username = ? AND path = ?',
+                                  (server, username, path)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (server, username, path, etag, children, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            self.evict()
+            self.db.commit()
+
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.db.execute('SELECT rowid, size FROM listings ORDER BY accessed LIMIT 32').fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for rowid, size in rows:
+                self.db.execute('DELETE FROM listings WHERE rowid = ?', (rowid,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+
+    def stats(self):
+        with self.lock:
+            count = self.db.execute('SELECT COUNT(*) FROM listings').fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'entries': count, 'bytes': self.total_bytes}
+
+
+
+class ListingSignals(QObject):
+    batch = pyqtSignal(str, int, object)
+    stale = pyqtSignal(str, int)
+    finished = pyqtSignal(str, int, object)
+    failed = pyqtSignal(str, int, str)
+
+
+
+class ListingJob(QRunnable):
+
+
+    def __init__(self, signals, session, url, path, generation, cancel_event, cache=None, cache_key=None, etag=None):
+        super().__init__()
+        self.signals = signals
+        self.session = session
+        self.url = url
+        self.path = path
+        self.generation = generation
+        self.cancel_event = cancel_event
+        self.cache = cache
+        self.cache_key = cache_key
+        self.etag = etag
+
+
+    def run(self):
+        if self.cancel_event.is_set():
+            return
+        try:
+            if self.etag is not None:
+                folder_entry = self.revalidate()
+                if folder_entry is not None:
+                    self.signals.finished.emit(self.path, self.generation, folder_entry)
+                    return
+                if self.cancel_event.is_set():
+                    return
+                self.signals.stale.emit(self.path, self.generation)
+            self.fetch_listing()
+        except requests.exceptions.RequestException as e:
+            if not self.cancel_event.is_set():
+                self.signals.failed.emit(self.path, self.generation, str(e))
+        except Exception as e:
+            logging.error(f"Ошибка обработки списка файлов: {e}")
+            self.signals.failed.emit(self.path, self.generation, str(e))
+
+
+    def revalidate(self):
+        # Nextcloud changes a folder's etag whenever anything below it changes, so Depth: 0 is enough
+        response = self.session.propfind(self.url, depth="0", data=PROPFIND_BODY)
+        if response.status_code != 207:
+            raise requests.exceptions.HTTPError(f"{response.status_code} {response.reason}")
+        entries = parse_multistatus(response.content)
+        if entries and entries[0].etag == self.etag:
+            logging.debug(f"Кэш списка файлов актуален: {self.path}")
+            return entries[0]
+        logging.debug(f"Кэш списка файлов устарел: {self.path}")
+        return None
+
+
+    def fetch_listing(self):
+        response = self.session.propfind(self.url, data=PROPFIND_BODY, stream=True)
+        with response:
+            if response.status_code != 207:
+                self.signals.failed.emit(self.path, self.generation, f"{response.status_code} {response.reason}")
+                return
+            folder_href = unquote(urlparse(self.url).path).rstrip('/')
+            folder_entry = None
+            listing = []
+            parser = MultistatusParser()
+            chunks = response.iter_content(LISTING_CHUNK_SIZE)
+            while True:
+                chunk = next(chunks, None)
+                if self.cancel_event.is_set():
+                    logging.debug(f"Запрос списка файлов отменён: {self.path}")
+                    return
+                with metrics.span('xml.parse'):
+                    entries = parser.feed(chunk) if chunk is not None else parser.finish()
+                if chunk is not None:
+                    metrics.count('bytes.listing', len(chunk))
+                children = []
+                for entry in entries:
+                    if entry.href.rstrip('/') == folder_href:
+                        folder_entry = entry
+                    else:
+                        children.append(entry)
+                if children:
+                    listing.extend(children)
+                    self.signals.batch.emit(self.path, self.generation, children)
+                if chunk is None:
+                    break
+        if self.cache is not None and folder_entry is not None and folder_entry.etag:
+            self.cache.put(*self.cache_key, self.path, folder_entry.etag, listing)
+        self.signals.finished.emit(self.path, self.generation, folder_entry)
+
+
+
+class ListingService(QObject):
+    listingStale = pyqtSignal(str)
+    listingBatch = pyqtSignal(str, object)
+    listingReady = pyqtSignal(str, object)
+    listingFailed = pyqtSignal(str, str)
+
+
+    def __init__(self, session, cache=None, parent=None):
+        super().__init__(parent)
+        self.session = session
+        self.cache = cache
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(LISTING_THREADS)
+        self.signals = ListingSignals(self)
+        self.signals.stale.connect(self.on_job_stale, Qt.QueuedConnection)
+        self.signals.batch.connect(self.on_job_batch, Qt.QueuedConnection)
+        self.signals.finished.connect(self.on_job_finished, Qt.QueuedConnection)
+        self.signals.failed.connect(self.on_job_failed, Qt.QueuedConnection)
+        self.jobs = {}
+        self.generation = 0
+
+
+    def request(self, url, path, cache_key=None, etag=None):
+        self.cancel(path)
+        self.generation += 1
+        cancel_event = threading.Event()
+        job = ListingJob(self.signals, self.session, url, path, self.generation, cancel_event,
+                         self.cache if cache_key else None, cache_key, etag)
+        self.jobs[path] = (self.generation, cancel_event)
+        self.pool.start(job)
+
+
+    def is_loading(self, path):
+        return path in self.jobs
+
+
+    def cancel(self, path):
+        job = self.jobs.pop(path, None)
+        if job:
+            job[1].set()
+
+
+    def pending_under(self, path):
+        return [p for p in self.jobs if p.startswith(path)]
+
+
+    def cancel_under(self, path):
+        for pending in self.pending_under(path):
+            self.cancel(pending)
+
+
+    def cancel_all(self):
+        self.cancel_under("")
+
+
+    def take_job(self, path, generation):
+        job = self.jobs.get(path)
+        if job is None or job[0] != generation:
+            return False
+        del self.jobs[path]
+        return True
+
+
+    def on_job_stale(self, path, generation):
+        job = self.jobs.get(path)
+        if job and job[0] == generation:
+            self.listingStale.emit(path)
+
+
+    def on_job_batch(self, path, generation, entries):
+        job = self.jobs.get(path)
+        if job and job[0] == generation:
+            self.listingBatch.emit(path, entries)
+
+
+    def on_job_finished(self, path, generation, folder_entry):
+        if self.take_job(path, generation):
+            self.listingReady.emit(path, folder_entry)
+
+
+    def on_job_failed(self, path, generation, message):
+        if self.take_job(path, generation):
+            self.listingFailed.emit(path, message)
+
+
+
+LATIN_MARKS = re.compile('(?<=[a-z])[\u0300-\u036f]+')
+
+
+def fold_text(text):
+    # "Ёлки" and "елки", "Café" and "cafe" fold to the same string, while "й" stays a letter of its own
+    text = text.casefold().replace('ё', 'е')
+    if text.isascii():
+        return text
+    return unicodedata.normalize('NFC', LATIN_MARKS.sub('', unicodedata.normalize('NFD', text)))
+
+
+
+class FolderText:
+    """Folded names (and probed metadata) of one folder's entries. The search joins them into a single string,
+    so a query is a few str.find calls over the folder instead of a Python loop over every entry."""
+
+
+    def __init__(self):
+        self.names = []
+        self.texts = []
+        self.blob = None  # rebuilt by the next search after a change
+        self.starts = []  # offset of every entry in blob
+        self.positions = None  # name -> position, built on the first metadata update
+
+
+    def add(self, names, texts):
+        # Every text keeps its newline, so the folder string is a plain concatenation
+        self.names.extend(names)
+        self.texts.extend(text + '\n' for text in texts)
+        self.blob = None
+        self.positions = None
+
+
+    def replace(self, name, text):
+        if self.positions is None:
+            self.positions = {entry_name: position for position, entry_name in enumerate(self.names)}
+        position = self.positions.get(name)
+        if position is not None and self.texts[position] != text + '\n':
+            self.texts[position] = text + '\n'
+            self.blob = None
+
+
+    def join(self, start):
+        texts = self.texts[start:] if start else self.texts
+        return ''.join(texts), list(accumulate(map(len, texts[:-1]), initial=0))
+
+
+    def build(self):
+        if self.blob is None:
+            self.blob, self.starts = self.join(0)
+
+
+    def contains(self, words):
+        return next(self.matches(words), None) is not None
+
+
+    def matches(self, words, start=0):
+        """Positions of the entries containing every word, in order. The first word is searched for and the others are
+        checked on its hits only. Words never hold whitespace, so a hit can't straddle two entries."""
+        if start:
+            # Entries appended while a filter is shown are searched on their own instead of rebuilding the folder
+            blob, starts = self.join(start)
+        else:
+            self.build()
+            blob, starts = self.blob, self.starts
+        texts = self.texts
+        key = words[0]
+        offset = 0
+        while True:
+            offset = blob.find(key, offset)
+            if offset < 0:
+                return
+            index = bisect_right(starts, offset) - 1
+            if all(word in texts[start + index] for word in words):
+                yield start + index
+            if index + 1 >= len(starts):
+                return
+            offset = starts[index + 1]
+
+
+
+class FileNode:
+    __slots__ = ('entry', 'path', 'parent', 'row', 'position', 'children', 'entries', 'state', 'rows', 'next_row')
+    NOT_LOADED, LOADING, LOADED = range(3)
+
+
+    def __init__(self, entry, path, parent, row, position):
+        self.entry = entry
+        self.path = path
+        self.parent = parent
+        self.row = row  # among the parent's exposed children
+        self.position = position  # in the parent's entries
+        self.children = []  # rows already exposed to the view
+        self.entries = []  # every DavEntry received for this folder
+        self.state = FileNode.NOT_LOADED
+        self.rows = None  # iterator over the positions a filter lets through, None shows every entry
+        self.next_row = None
+
+
+    @property
+    def is_collection(self):
+        return self.entry is None or self.entry.is_collection
+
+
+
+class FileTreeModel(QAbstractItemModel):
+    fetchRequested = pyqtSignal(str)
+
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.root = FileNode(None, "", None, 0, 0)
+        self.root.state = FileNode.LOADED
+        self.folders = {"": self.root}  # loaded or exposed folders, hidden ones are kept while a filter is shown
+        self.files = {}  # file path -> exposed FileNode
+        self.metadata = {}  # file path -> probed media metadata, filled in by MediaProber
+        self.thumbnail = None  # callable returning the decoration for a node
+        self.search_texts = {}  # folder path -> FolderText of its entries
+        self.filter_words = []
+        self.filter_matched = None  # folders with matching entries, narrowed by the next keystroke
+        self.filter_forced = {}  # folder path -> positions of subfolders with matches further down
+
+
+    def node(self, index):
+        return index.internalPointer() if index.isValid() else self.root
+
+
+    def node_for_path(self, path):
+        return self.folders.get(path)
+
+
+    def index_for_node(self, node):
+        if node is self.root:
+            return QModelIndex()
+        return self.createIndex(node.row, 0, node)
+
+
+    def is_shown(self, node):
+        while node.parent is not None:
+            siblings = node.parent.children
+            if node.row >= len(siblings) or siblings[node.row] is not node:
+                return False
+            node = node.parent
+        return True
+
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.column() > 0 or not 0 <= column < len(TREE_COLUMNS):
+            return QModelIndex()
+        children = self.node(parent).children
+        if not 0 <= row < len(children):
+            return QModelIndex()
+        return self.createIndex(row, column, children[row])
+
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self.index_for_node(index.internalPointer().parent)
+
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return len(self.node(parent).children)
+
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(TREE_COLUMNS)
+
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self.node(parent)
+        if not node.is_collection:
+            return False
+        return node.state != FileNode.LOADED or bool(node.entries)
+
+
+    def canFetchMore(self, parent):
+        node = self.node(parent)
+        if not node.is_collection:
+            return False
+        return node.state == FileNode.NOT_LOADED or self.has_pending_rows(node)
+
+
+    def fetchMore(self, parent):
+        node = self.node(parent)
+        if self.has_pending_rows(node):
+            # Filtered rows come in smaller batches, each of them is sorted while the user is still typing
+            self.expose(node, TREE_FETCH_BATCH if node.rows is None else FILTER_FETCH_BATCH)
+        elif node.state == FileNode.NOT_LOADED:
+            self.set_state(node, FileNode.LOADING)
+            self.fetchRequested.emit(node.path)
+
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        if role == Qt.DisplayRole:
+            if not node.is_collection:
+                return self.column_text(node, index.column())
+            if index.column() > 0:
+                return None
+            if node.state == FileNode.LOADING:
+                return node.entry.name + '/ (загрузка...)'
+            return node.entry.name + '/'
+        if role == Qt.UserRole:
+            return node.path
+        if role == SORT_ROLE:
+            return self.sort_key(node, index.column())
+        if role == Qt.DecorationRole and index.column() == 0 and self.thumbnail:
+            return self.thumbnail(node)
+        return None
+
+
+    def column_text(self, node, column):
+        if column == 0:
+            return node.entry.name
+        return self.metadata_text(self.metadata.get(node.path), column)
+
+
+    def metadata_text(self, metadata, column):
+        if not metadata:
+            return ''
+        if column == 1:
+            seconds = max(0, metadata['duration_ms']) // 1000
+            return f'{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}'
+        if column == 2:
+            return f"{metadata['width']}x{metadata['height']}" if metadata['width'] else ''
+        if column == 3:
+            return metadata['video_codec'] or ''
+        if column == 4:
+            return ', '.join(metadata['audio'])
+        return ', '.join(metadata['subtitles'])
+
+
+    def sort_key(self, node, column):
+        # Folders always come first, files without metadata go after the probed ones
+        if column == 0 or node.is_collection:
+            return (not node.is_collection, node.entry.name.casefold())
+        metadata = self.metadata.get(node.path)
+        if not metadata:
+            return (True, True, 0, node.entry.name.casefold())
+        if column == 1:
+            value = metadata['duration_ms']
+        elif column == 2:
+            value = (metadata['width'] or 0) * (metadata['height'] or 0)
+        else:
+            value = self.column_text(node, column).casefold()
+        return (True, False, value, node.entry.name.casefold())
+
+
+    def search_text(self, name, metadata):
+        # Name and metadata stay on separate lines, so a match can't run from one into the other
+        text = fold_text(name)
+        if metadata:
+            text += '\n' + fold_text(' '.join(self.metadata_text(metadata, column) for column in range(1, len(TREE_COLUMNS))))
+        return text
+
+
+    def set_metadata(self, updates):
+        self.metadata.update(updates)
+        for path, metadata in updates.items():
+            folder, _, name = path.rpartition('/')
+            texts = self.search_texts.get(folder + '/' if folder else '')
+            if texts is not None:
+                texts.replace(name, self.search_text(name, metadata))
+        self.filter_matched = None
+        for folder in {path.rpartition('/')[0] for path in updates}:
+            node = self.folders.get(folder + '/' if folder else '')
+            if node is None or not node.children or not self.is_shown(node):
+                continue
+            # One signal per folder, the view only repaints the rows on screen
+            self.dataChanged.emit(self.createIndex(0, 1, node.children[0]),
+                                  self.createIndex(len(node.children) - 1, len(TREE_COLUMNS) - 1, node.children[-1]))
+
+
+    def update_decoration(self, path):
+        node = self.files.get(path)
+        if node is not None:
+            index = self.createIndex(node.row, 0, node)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            if section > 0:
+                return TREE_COLUMNS[section]
+            return 'Файлы (загрузка...)' if self.root.state == FileNode.LOADING else 'Файлы'
+        return None
+
+
+    def set_state(self, node, state):
+        if node.state == state:
+            return
+        node.state = state
+        if state == FileNode.LOADED and node.path in self.search_texts:
+            # Joined once the listing is complete, so the first keystroke doesn't pay for it
+            self.search_texts[node.path].build()
+        if node is self.root:
+            self.headerDataChanged.emit(Qt.Horizontal, 0, 0)
+        elif self.is_shown(node):
+            index = self.index_for_node(node)
+            self.dataChanged.emit(index, index)
+
+
+    def clear_children(self, node):
+        self.filter_matched = None
+        if node is self.root:
+            self.beginResetModel()
+            self.root.children = []
+            self.root.entries = []
+            self.root.rows = None if self.root.rows is None else iter(())
+            self.root.next_row = None
+            self.folders = {"": self.root}
+            self.files = {}
+            self.search_texts = {}
+            self.endResetModel()
+            return
+        removing = bool(node.children) and self.is_shown(node)
+        if removing:
+            self.beginRemoveRows(self.index_for_node(node), 0, len(node.children) - 1)
+        node.children = []
+        node.entries = []
+        node.rows = None if node.rows is None else iter(())
+        node.next_row = None
+        # Subfolders hidden by a filter are dropped as well, their listings belong to the old contents
+        for path in [p for p in self.folders if p.startswith(node.path) and p != node.path]:
+            del self.folders[path]
+        for path in [p for p in self.files if p.startswith(node.path)]:
+            del self.files[path]
+        for path in [p for p in self.search_texts if p.startswith(node.path)]:
+            del self.search_texts[path]
+        if removing:
+            self.endRemoveRows()
+
+
+    def append_entries(self, node, entries):
+        texts = self.search_texts.get(node.path)
+        if texts is None:
+            texts = self.search_texts[node.path] = FolderText()
+        metadata = self.metadata
+        texts.add([entry.name for entry in entries],
+                  [self.search_text(entry.name, None if entry.is_collection else metadata.get(node.path + entry.name))
+                   for entry in entries])
+        self.filter_matched = None
+        start = len(node.entries)
+        node.entries.extend(entries)
+        if node.rows is not None:
+            # A folder refreshed under a filter only has the new entries searched
+            rows = self.filtered_rows(node, start)
+            if node.next_row is None:
+                node.rows = rows
+                node.next_row = next(rows, None)
+            else:
+                node.rows = chain(node.rows, rows)
+        # Only the first screenful is materialised, the view pulls the rest through fetchMore while scrolling
+        if len(node.children) < TREE_FETCH_BATCH:
+            self.expose(node, TREE_FETCH_BATCH - len(node.children))
+
+
+    def has_pending_rows(self, node):
+        if node.rows is None:
+            return len(node.children) < len(node.entries)
+        return node.next_row is not None
+
+
+    def expose(self, node, count):
+        if not self.is_shown(node):
+            return
+        start = len(node.children)
+        if node.rows is None:
+            positions = range(start, min(len(node.entries), start + count))
+        else:
+            positions = []
+            while node.next_row is not None and len(positions) < count:
+                positions.append(node.next_row)
+                node.next_row = next(node.rows, None)
+        if not positions:
+            return
+        with metrics.span('tree.populate'):
+            self.beginInsertRows(self.index_for_node(node), start, start + len(positions) - 1)
+            for row, position in enumerate(positions, start):
+                node.children.append(self.child_node(node, row, position))
+            self.endInsertRows()
+
+
+    def child_node(self, node, row, position):
+        entry = node.entries[position]
+        if not entry.is_collection:
+            child = FileNode(entry, node.path + entry.name, node, row, position)
+            self.files[child.path] = child
+            return child
+        path = node.path + entry.name + '/'
+        child = self.folders.get(path)
+        if child is None:
+            child = self.folders[path] = FileNode(entry, path, node, row, position)
+        else:
+            # Folders come back with their listing after a filter change, only their rows are built anew
+            child.row = row
+            child.position = position
+            child.children = []
+        # A folder matching by name shows all of its contents, that is what was searched for
+        if node.rows is None or all(word in fold_text(entry.name) for word in self.filter_words):
+            child.rows = child.next_row = None
+        else:
+            child.rows = self.filtered_rows(child)
+            child.next_row = next(child.rows, None)
+        return child
+
+
+    def filtered_rows(self, node, start=0):
+        texts = self.search_texts.get(node.path)
+        matches = texts.matches(self.filter_words, start) if texts is not None else ()
+        forced = [position for position in self.filter_forced.get(node.path, ()) if position >= start]
+        previous = None
+        for position in heapq.merge(forced, matches):
+            if position != previous:
+                yield position
+                previous = position
+
+
+    def set_filter(self, text):
+        words = self.rarest_first(fold_text(text).split())
+        if words == self.filter_words:
+            return
+        # A longer query only narrows the previous one, so just the folders that matched before are searched again
+        narrowing = (self.filter_matched is not None and self.filter_words
+                     and all(any(old in word for word in words) for old in self.filter_words))
+        candidates = self.filter_matched if narrowing else list(self.search_texts)
+        self.filter_words = words
+        self.beginResetModel()
+        for node in self.folders.values():
+            node.children = []
+            node.rows = node.next_row = None
+        self.files = {}
+        if words:
+            self.filter_matched = {path for path in candidates
+                                   if path in self.search_texts and self.search_texts[path].contains(words)}
+            self.filter_forced = self.forced_rows(self.filter_matched)
+            self.root.rows = self.filtered_rows(self.root)
+            self.root.next_row = next(self.root.rows, None)
+        else:
+            self.filter_matched = None
+            self.filter_forced = {}
+        self.endResetModel()
+        self.expose(self.root, FILTER_FETCH_BATCH if words else TREE_FETCH_BATCH)
+
+
+    def rarest_first(self, words):
+        # FolderText.matches looks for the first word only, counting in a sample of the loaded text is a good enough guess
+        if len(words) < 2:
+            return words
+        sample = []
+        size = 0
+        for texts in self.search_texts.values():
+            if size >= FILTER_SAMPLE_CHARS:
+                break
+            if texts.blob:
+                sample.append(texts.blob[:FILTER_SAMPLE_CHARS - size])
+                size += len(sample[-1])
+        sample = ''.join(sample)
+        return sorted(reversed(words), key=sample.count)
+
+
+    def forced_rows(self, matched):
+        forced = {}
+        for path in matched:
+            node = self.folders.get(path)
+            while node is not None and node.parent is not None:
+                positions = forced.setdefault(node.parent.path, set())
+                if node.position in positions:
+                    break
+                positions.add(node.position)
+                node = node.parent
+        return {path: sorted(positions) for path, positions in forced.items()}
+
+
+
+class MetadataCache:
+
+
+    def __init__(self, filename=METADATA_CACHE_FILE):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS media (
+                               server TEXT, username TEXT, path TEXT, etag TEXT, metadata TEXT,
+                               PRIMARY KEY (server, username, path))''')
+        self.db.commit()
+
+
+    def get(self, server, username, path, etag):
+        with self.lock:
+            row = self.db.execute('SELECT etag, metadata FROM media WHERE server = ? AND username = ? AND path = ?',
+                                  (server, username, path)).fetchone()
+        if row is None or row[0] != etag:
+            return None
+        return json.loads(row[1])
+
+
+    def put(self, server, username, path, etag, metadata):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?)',
+                            (server, username, path, etag, json.dumps(metadata, ensure_ascii=False)))
+            self.db.commit()
+
+
+
+def import_vlc():
+    # python-vlc loads libvlc while being imported, so the import waits until something actually needs it
+    global vlc
+    if vlc is None:
+        import vlc
+    return vlc
+
+
+
+class LibVlc(QObject):
+    ready = pyqtSignal()
+
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.lock = threading.Lock()
+        self.instance = None
+        self.error = None
+
+
+    def start(self):
+        threading.Thread(target=self.load, name='libvlc-init', daemon=True).start()
+
+
+    def get(self):
+        self.load()
+        if self.instance is None:
+            raise RuntimeError(f"libvlc недоступен: {self.error}")
+        return self.instance
+
+
+    def load(self):
+        # The plugin scan takes a while on a cold cache, the first caller pays for it and later ones wait on the lock
+        with self.lock:
+            if self.instance is None and self.error is None:
+                started = time.perf_counter()
+                try:
+                    self.instance = import_vlc().Instance()
+                    if self.instance is None:
+                        raise RuntimeError("libvlc_new вернул NULL")
+                except Exception as e:
+                    self.error = str(e)
+                    logging.error(f"Не удалось инициализировать libvlc: {e}")
+                else:
+                    elapsed = time.perf_counter() - started
+                    metrics.observe('startup.libvlc', elapsed)
+                    logging.info(f"libvlc инициализирован за {elapsed * 1000:.0f} мс")
+                    self.ready.emit()
+
+
+
+class MediaProber(QObject):
+    probed = pyqtSignal(str, str, object)
+
+
+    def __init__(self, libvlc, parent=None):
+        super().__init__(parent)
+        self.libvlc = libvlc
+        self.pool = ThreadPoolExecutor(max_workers=METADATA_PROBE_THREADS, thread_name_prefix='probe')
+        self.lock = threading.Lock()
+        self.queued = {}
+
+
+    def probe(self, path, etag, url):
+        with self.lock:
+            if path in self.queued:
+                return
+            self.queued[path] = self.pool.submit(self.run, path, etag, url)
+
+
+    def cancel_under(self, path):
+        with self.lock:
+            for queued_path, future in list(self.queued.items()):
+                if queued_path.startswith(path) and future.cancel():
+                    del self.queued[queued_path]
+
+
+    def run(self, path, etag, url):
+        try:
+            self.probed.emit(path, etag, self.parse(url))
+        except Exception as e:
+            logging.debug(f"Не удалось получить сведения о {path}: {e}")
+        finally:
+            with self.lock:
+                self.queued.pop(path, None)
+
+
+    def parse(self, url):
+        media = self.libvlc.get().media_new(url)
+        parsed = threading.Event()
+        events = media.event_manager()
+        events.event_attach(vlc.EventType.MediaParsedChanged, lambda event: parsed.set())
+        try:
+            # Only the container headers are read, through the same caching proxy the player uses
+            media.parse_with_options(vlc.MediaParseFlag.network, METADATA_PROBE_TIMEOUT)
+            parsed.wait(METADATA_PROBE_TIMEOUT / 1000 + 1)
+            status = media.get_parsed_status()
+            if status != vlc.MediaParsedStatus.done:
+                raise RuntimeError(f"разбор не завершён: {status}")
+            metadata = {'duration_ms': media.get_duration(), 'width': None, 'height': None,
+                        'video_codec': None, 'audio': [], 'subtitles': []}
+            for track in media.tracks_get() or []:
+                codec = self.codec_name(track)
+                if track.type == vlc.TrackType.video and metadata['video_codec'] is None:
+                    # The per-type pointers share one union slot in libvlc_media_track_t
+                    video = ctypes.cast(track.audio, ctypes.POINTER(vlc.VideoTrack)).contents
+                    metadata.update(width=video.width, height=video.height, video_codec=codec)
+                elif track.type == vlc.TrackType.audio:
+                    audio = track.audio.contents
+                    metadata['audio'].append(f"{codec} {audio.channels}ch")
+                elif track.type == vlc.TrackType.ext:
+                    metadata['subtitles'].append(codec)
+            return metadata
+        finally:
+            events.event_detach(vlc.EventType.MediaParsedChanged)
+            media.release()
+
+
+    def codec_name(self, track):
+        description = vlc.libvlc_media_get_codec_description(track.type, track.codec)
+        if isinstance(description, bytes):
+            description = description.decode('utf-8', 'replace')
+        if description:
+            return description
+        return track.codec.to_bytes(4, 'little').decode('ascii', 'replace').strip()
+
+
+    def stop(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+
+class FileSortProxyModel(QSortFilterProxyModel):
+    # Filtering happens in FileTreeModel.set_filter, which only exposes the matching rows
+
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setDynamicSortFilter(True)
+
+
+    def lessThan(self, left, right):
+        # Called a few thousand times per inserted batch, so the keys are taken without going through data()
+        model = self.sourceModel()
+        return model.sort_key(left.internalPointer(), left.column()) < model.sort_key(right.internalPointer(), right.column())
+
+
+
+class LibraryIndex:
+
+
+    def __init__(self, server, username, directory=CACHE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        account = hashlib.sha1(f"{server}|{username}".encode('utf-8')).hexdigest()[:16]
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, f'library_{account}.sqlite3'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, parent TEXT, etag TEXT)')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, folder TEXT, name TEXT, folded TEXT,
+                                                             size INTEGER, etag TEXT, mtime INTEGER)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_folder ON files (folder)')
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(folded, tokenize='trigram')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            logging.warning("SQLite без FTS5 trigram, поиск по библиотеке будет медленнее")
+            self.fts = False
+        if self.db.execute('PRAGMA user_version').fetchone()[0] < LIBRARY_FOLD_VERSION:
+            self.refold()
+        self.db.commit()
+
+
+    def refold(self):
+        # Names folded by an older fold_text would no longer match the queries, so they are folded again
+        rows = self.db.execute('SELECT rowid, path FROM files').fetchall()
+        self.db.executemany('UPDATE files SET folded = ? WHERE rowid = ?', [(fold_text(path), rowid) for rowid, path in rows])
+        if self.fts:
+            self.db.execute('DELETE FROM files_fts')
+            self.db.execute('INSERT INTO files_fts (rowid, folded) SELECT rowid, folded FROM files')
+        self.db.execute(f'PRAGMA user_version = {LIBRARY_FOLD_VERSION}')
+
+
+    def folder_etag(self, path):
+        with self.lock:
+            row = self.db.execute('SELECT etag FROM folders WHERE path = ?', (path,)).fetchone()
+        return row[0] if row else None
+
+
+    def file_count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+
+    def store_listing(self, path, children):
+        child_folders = {path + entry.name + '/' for entry in children if entry.is_collection}
+        with self.lock, self.db:
+            known = {row[0] for row in self.db.execute('SELECT path FROM folders WHERE parent = ?', (path,))}
+            for removed in known - child_folders:
+                self.delete_subtree(removed)
+            self.db.executemany('INSERT OR IGNORE INTO folders VALUES (?, ?, NULL)', [(folder, path) for folder in child_folders])
+            self.delete_files('folder = ?', (path,))
+            for entry in children:
+                if entry.is_collection:
+                    continue
+                # The whole path is searchable, so "сериал 2 сезон" finds episodes by their folder names too
+                folded = fold_text(path + entry.name)
+                cursor = self.db.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                         (path + entry.name, path, entry.name, folded, entry.size, entry.etag, entry.mtime))
+                if self.fts:
+                    self.db.execute('INSERT INTO files_fts (rowid, folded) VALUES (?, ?)', (cursor.lastrowid, folded))
+
+
+    def commit_folder(self, path, parent, etag):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?)', (path, parent, etag))
+
+
+    def delete_subtree(self, path):
+        bounds = (path, path + '\U0010ffff')
+        self.db.execute('DELETE FROM folders WHERE path >= ? AND path < ?', bounds)
+        self.delete_files('path >= ? AND path < ?', bounds)
+
+
+    def delete_files(self, where, args):
+        if self.fts:
+            self.db.execute(f'DELETE FROM files_fts WHERE rowid IN (SELECT rowid FROM files WHERE {where})', args)
+        self.db.execute(f'DELETE FROM files WHERE {where}', args)
+
+
+    def videos(self):
+        condition = ' OR '.join('folded LIKE ?' for _ in VIDEO_EXTENSIONS)
+        with self.lock:
+            return self.db.execute(f'SELECT path, name, size FROM files WHERE {condition} ORDER BY path',
+                                   ['%' + extension for extension in VIDEO_EXTENSIONS]).fetchall()
+
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        words = fold_text(query).split()
+        if not words:
+            return []
+        long_words = [word for word in words if len(word) >= 3]
+        with self.lock:
+            if self.fts and long_words:
+                match = ' '.join('"' + word.replace('"', '""') + '"' for word in long_words)
+                rows = self.db.execute('''SELECT files.path, files.name, files.folded, files.size FROM files_fts
+                                          JOIN files ON files.rowid = files_fts.rowid
+                                          WHERE files_fts MATCH ? LIMIT ?''', (match, limit * 4)).fetchall()
+            else:
+                rows = self.db.execute('SELECT path, name, folded, size FROM files WHERE folded LIKE ? LIMIT ?',
+                                       ('%' + words[0] + '%', limit * 4)).fetchall()
+        results = [(path, name, size) for path, name, folded, size in rows if all(word in folded for word in words)]
+        return results[:limit]
+
+
+
+class SearchNotSupported(Exception):
+    pass
+
+
+
+def search_videos(session, server_url, username, page_size=VIDEO_SEARCH_PAGE, cancel_event=None):
+    url = server_url + "remote.php/dav/"
+    prefix = unquote(urlparse(server_url).path) + "remote.php/dav/files/" + username + "/"
+    offset = 0
+    while True:
+        body = VIDEO_SEARCH_BODY.format(scope=xml_escape(f"/files/{username}"), limit=page_size, offset=offset)
+        response = session.request("SEARCH", url, data=body.encode('utf-8'),
+                                   headers={'Content-Type': 'text/xml; charset=utf-8'})
+        if response.status_code in (400, 403, 404, 405, 422, 501):
+            raise SearchNotSupported(f"{response.status_code} {response.reason}")
+        if response.status_code != 207:
+            raise requests.exceptions.HTTPError(f"{response.status_code} {response.reason}")
+        entries = parse_multistatus(response.content)
+        yield [(entry.href[len(prefix):], entry) for entry in entries
+               if entry.href.startswith(prefix) and not entry.is_collection]
+        if len(entries) < page_size or (cancel_event and cancel_event.is_set()):
+            return
+        offset += page_size
+
+
+
+class VideoSearchSignals(QObject):
+    page = pyqtSignal(int, object)
+    finished = pyqtSignal(int, int)
+    unsupported = pyqtSignal(int, str)
+    failed = pyqtSignal(int, str)
+
+
+
+class VideoSearchJob(QRunnable):
+
+
+    def __init__(self, search_id, session, server_url, username):
+        super().__init__()
+        self.signals = VideoSearchSignals()
+        self.search_id = search_id
+        self.session = session
+        self.server_url = server_url
+        self.username = username
+        self.cancel_event = threading.Event()
+
+
+    def run(self):
+        count = 0
+        try:
+            for page in search_videos(self.session, self.server_url, self.username, cancel_event=self.cancel_event):
+                if self.cancel_event.is_set():
+                    return
+                count += len(page)
+                self.signals.page.emit(self.search_id, page)
+            self.signals.finished.emit(self.search_id, count)
+        except SearchNotSupported as e:
+            self.signals.unsupported.emit(self.search_id, str(e))
+        except Exception as e:
+            logging.error(f"Ошибка поиска видео: {e}")
+            self.signals.failed.emit(self.search_id, str(e))
+
+
+
+class LibraryCrawler(QObject):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(int, int, float)
+    failed = pyqtSignal(str)
+
+
+    def __init__(self, session, index, base_url, parent=None):
+        super().__init__(parent)
+        self.session = session
+        self.index = index
+        self.base_url = base_url
+        self.stop_event = threading.Event()
+        self.thread = None
+
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def start(self):
+        if self.is_running():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='library-crawler', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stop_event.set()
+
+
+    def list_folder(self, path, depth="1"):
+        return propfind_folder(self.session, self.base_url + quote(path), depth)
+
+
+    def run(self):
+        started = time.time()
+        try:
+            root_entry, _ = self.list_folder("", depth="0")
+            if root_entry.etag and self.index.folder_etag("") == root_entry.etag:
+                logging.info("Индекс библиотеки актуален")
+                self.finished.emit(0, 0, time.time() - started)
+                return
+            folders, files = self.crawl(root_entry.etag)
+            logging.info(f"Индексация завершена: каталогов {folders}, файлов {files}, {time.time() - started:.1f} с")
+            self.finished.emit(folders, files, time.time() - started)
+        except Exception as e:
+            logging.error(f"Ошибка индексации библиотеки: {e}")
+            self.failed.emit(str(e))
+
+
+    def crawl(self, root_etag):
+        # Breadth-first walk that only descends into folders whose etag differs from the indexed one.
+        # A folder's etag is committed only after its whole subtree is indexed, so an interrupted
+        # crawl is picked up again on the next refresh.
+        pending = {"": [None, root_etag, 0]}
+        folders = files = 0
+        with ThreadPoolExecutor(max_workers=CRAWL_CONCURRENCY) as executor:
+            futures = {executor.submit(self.list_folder, ""): ""}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                if self.stop_event.is_set():
+                    for future in futures:
+                        future.cancel()
+                    logging.info("Индексация остановлена")
+                    break
+                for future in done:
+                    path = futures.pop(future)
+                    try:
+                        folder_entry, children = future.result()
+                    except Exception as e:
+                        logging.warning(f"Не удалось проиндексировать {path}: {e}")
+                        pending.pop(path, None)
+                        continue
+                    self.index.store_listing(path, children)
+                    folders += 1
+                    files += sum(1 for entry in children if not entry.is_collection)
+                    changed = []
+                    for entry in children:
+                        child_path = path + entry.name + '/'
+                        if entry.is_collection and (entry.etag is None or self.index.folder_etag(child_path) != entry.etag):
+                            changed.append((child_path, entry.etag))
+                    pending[path][1] = folder_entry.etag or pending[path][1]
+                    pending[path][2] = len(changed)
+                    for child_path, etag in changed:
+                        pending[child_path] = [path, etag, 0]
+                        futures[executor.submit(self.list_folder, child_path)] = child_path
+                    if not changed:
+                        self.complete(path, pending)
+                    if folders % 20 == 0:
+                        self.progress.emit(folders, files)
+        return folders, files
+
+
+    def complete(self, path, pending):
+        while path is not None:
+            parent, etag, _ = pending.pop(path)
+            self.index.commit_folder(path, parent, etag)
+            if parent is None or parent not in pending:
+                return
+            pending[parent][2] -= 1
+            if pending[parent][2] > 0:
+                return
+            path = parent
+
+
+
+class FolderPrefetcher:
+
+
+    def __init__(self, session, cache, is_idle=None):
+        self.session = session
+        self.cache = cache
+        self.is_idle = is_idle or (lambda: True)
+        self.depth = PREFETCH_DEPTH
+        self.budget = PREFETCH_BUDGET
+        self.enabled = False
+        self.condition = threading.Condition()
+        self.pending = deque()  # (path, depth) in breadth-first order
+        self.listings = OrderedDict()  # path -> (fetched at, folder entry, children)
+        self.inflight = set()
+        self.remaining = 0
+        self.delay = 0.0
+        self.base_url = None
+        self.cache_key = None
+        self.wave = 0
+        self.stopped = False
+        self.threads = []
+
+
+    def set_limits(self, depth, budget):
+        self.depth = depth
+        self.budget = budget
+
+
+    def start(self, base_url, cache_key, path, entries):
+        if not self.enabled or self.depth < 1:
+            return
+        with self.condition:
+            # A new folder means the user moved on, whatever was queued for the previous one is dropped
+            self.base_url = base_url
+            self.cache_key = cache_key
+            self.wave += 1
+            self.pending.clear()
+            self.remaining = self.budget
+            for entry in entries:
+                if entry.is_collection:
+                    self.pending.append((path + entry.name + '/', 1))
+            if not self.threads:
+                self.threads = [threading.Thread(target=self.run, name='prefetch', daemon=True) for _ in range(PREFETCH_THREADS)]
+                for thread in self.threads:
+                    thread.start()
+            self.condition.notify_all()
+
+
+    def take(self, path):
+        with self.condition:
+            listing = self.listings.pop(path, None)
+        if listing is None or time.monotonic() - listing[0] > PREFETCH_TTL:
+            return None
+        metrics.count('prefetch.hits')
+        return listing[1], listing[2]
+
+
+    def cancel(self):
+        with self.condition:
+            self.pending.clear()
+            self.listings.clear()
+
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.pending.clear()
+            self.condition.notify_all()
+
+
+    def next_folder(self):
+        with self.condition:
+            while not self.stopped:
+                if self.pending and self.remaining > 0:
+                    path, depth = self.pending.popleft()
+                    if path in self.listings or path in self.inflight:
+                        continue
+                    self.remaining -= 1
+                    self.inflight.add(path)
+                    return path, depth, self.base_url, self.cache_key, self.wave
+                self.condition.wait()
+        return None
+
+
+    def run(self):
+        while True:
+            task = self.next_folder()
+            if task is None:
+                return
+            path, depth, base_url, cache_key, wave = task
+            try:
+                # Folders the user asked for always go first, prefetching only uses otherwise idle time
+                while not self.is_idle() and not self.stopped:
+                    time.sleep(0.1)
+                if self.delay:
+                    time.sleep(self.delay)
+                started = time.monotonic()
+                folder_entry, children = propfind_folder(self.session, base_url + quote(path))
+                self.adjust(time.monotonic() - started)
+            except Exception as e:
+                logging.debug(f"Предзагрузка {path} не удалась: {e}")
+                self.adjust(None)
+                continue
+            finally:
+                with self.condition:
+                    self.inflight.discard(path)
+            metrics.count('prefetch.requests')
+            if folder_entry.etag:
+                self.cache.put(*cache_key, path, folder_entry.etag, children)
+            with self.condition:
+                self.listings[path] = (time.monotonic(), folder_entry, children)
+                while len(self.listings) > PREFETCH_MAX_FOLDERS:
+                    self.listings.popitem(last=False)
+                if depth < self.depth and wave == self.wave:
+                    self.pending.extend((path + entry.name + '/', depth + 1) for entry in children if entry.is_collection)
+                    self.condition.notify_all()
+
+
+    def adjust(self, elapsed):
+        # Slow answers or errors double the pause between prefetches, quick ones halve it again
+        with self.condition:
+            if elapsed is None or elapsed > PREFETCH_SLOW_RESPONSE:
+                self.delay = min(PREFETCH_MAX_DELAY, max(self.delay * 2, PREFETCH_MIN_DELAY))
+                logging.debug(f"Предзагрузка замедлена: пауза {self.delay:.1f} с")
+            elif self.delay:
+                self.delay = self.delay / 2 if self.delay > PREFETCH_MIN_DELAY else 0.0
+
+
+
+class ChunkCache:
+
+
+    def __init__(self, directory=STREAM_CACHE_DIR, max_bytes=STREAM_CACHE_MAX_BYTES, flat=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Caches of many small one-piece entries such as thumbnails keep them as "<key>.<index>" files in one directory
+        self.flat = flat
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (key, index) -> size, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Walking tens of thousands of files takes a noticeable time, it is done off the GUI thread while the window opens
+        self.loaded = threading.Event()
+        threading.Thread(target=self.scan, name='cache-scan', daemon=True).start()
+
+
+    def scan(self):
+        found = []
+        try:
+            # Listed up front, entries moved out of old-layout directories must not show up a second time
+            for item in list(os.scandir(self.directory)):
+                if self.flat:
+                    key, _, index = item.name.rpartition('.')
+                    if item.is_dir():
+                        found.extend(self.flatten(item))
+                    elif key and index.isdigit():
+                        stat = item.stat()
+                        found.append((stat.st_mtime, key, int(index), stat.st_size))
+                elif item.is_dir():
+                    chunks = [(chunk.name, chunk.stat()) for chunk in os.scandir(item.path) if chunk.name.isdigit()]
+                    if not chunks:
+                        self.remove_dir(item.path)
+                    found.extend((stat.st_mtime, item.name, int(name), stat.st_size) for name, stat in chunks)
+        except OSError as e:
+            logging.warning(f"Не удалось прочитать кэш {self.directory}: {e}")
+        with self.lock:
+            for mtime, key, index, size in sorted(found):
+                self.entries[(key, index)] = size
+                self.total_bytes += size
+            self.evict()
+        self.loaded.set()
+
+
+    def flatten(self, item):
+        # Entries kept in the older layout with a directory per key are moved next to the others
+        moved = []
+        for chunk in os.scandir(item.path):
+            if chunk.name.isdigit():
+                stat = chunk.stat()
+                os.replace(chunk.path, self.chunk_file(item.name, int(chunk.name)))
+                moved.append((stat.st_mtime, item.name, int(chunk.name), stat.st_size))
+        shutil.rmtree(item.path, ignore_errors=True)
+        return moved
+
+
+    def chunk_file(self, key, index):
+        if self.flat:
+            return os.path.join(self.directory, f'{key}.{index}')
+        return os.path.join(self.directory, key, str(index))
+
+
+    def remove_dir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError:
+            # Still holds other chunks of the same file
+            pass
+
+
+    def contains(self, key, index):
+        self.loaded.wait()
+        with self.lock:
+            return (key, index) in self.entries
+
+
+    def get(self, key, index):
+        self.loaded.wait()
+        with self.lock:
+            if (key, index) not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((key, index))
+            self.hits += 1
+        try:
+            with open(self.chunk_file(key, index), 'rb') as chunk_file:
+                return chunk_file.read()
+        except OSError:
+            with self.lock:
+                self.total_bytes -= self.entries.pop((key, index), 0)
+            return None
+
+
+    def put(self, key, index, data):
+        self.loaded.wait()
+        filename = self.chunk_file(key, index)
+        temp_filename = f'{filename}.{threading.get_ident()}.tmp'
+        with self.lock:
+            # Eviction removes emptied directories under the same lock, so the directory stays until the file is in
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            chunk_file = open(temp_filename, 'wb')
+        with chunk_file:
+            chunk_file.write(data)
+        os.replace(temp_filename, filename)
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop((key, index), 0)
+            self.entries[(key, index)] = len(data)
+            self.evict()
+
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            (key, index), size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.chunk_file(key, index))
+            except OSError:
+                pass
+            if not self.flat:
+                self.remove_dir(os.path.dirname(self.chunk_file(key, index)))
+
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'chunks': len(self.entries), 'bytes': self.total_bytes}
+
+
+
+class PixmapCache:
+
+
+    def __init__(self, max_bytes=THUMBNAIL_MEMORY_BYTES):
+        self.max_bytes = max_bytes
+        self.pixmaps = OrderedDict()  # key -> QPixmap, least recently used first
+        self.total_bytes = 0
+
+
+    def get(self, key):
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(key)
+        return pixmap
+
+
+    def __contains__(self, key):
+        return key in self.pixmaps
+
+
+    def put(self, key, pixmap):
+        self.total_bytes -= self.pixmap_bytes(self.pixmaps.pop(key, None))
+        self.pixmaps[key] = pixmap
+        self.total_bytes += self.pixmap_bytes(pixmap)
+        while self.total_bytes > self.max_bytes and len(self.pixmaps) > 1:
+            _, oldest = self.pixmaps.popitem(last=False)
+            self.total_bytes -= self.pixmap_bytes(oldest)
+
+
+    def pixmap_bytes(self, pixmap):
+        return pixmap.width() * pixmap.height() * 4 if pixmap is not None else 0
+
+
+
+class ThumbnailLoader(QObject):
+    loaded = pyqtSignal(str, str, object)
+
+
+    def __init__(self, session, cache=None, parent=None):
+        super().__init__(parent)
+        self.session = session
+        self.cache = cache or ChunkCache(THUMBNAIL_CACHE_DIR, THUMBNAIL_DISK_MAX_BYTES, flat=True)
+        self.base_url = None
+        self.condition = threading.Condition()
+        self.wanted = OrderedDict()  # key -> (path, fileid), most urgent first
+        self.inflight = set()
+        self.stopped = False
+        for number in range(THUMBNAIL_THREADS):
+            threading.Thread(target=self.work, name=f'thumbnail-{number}', daemon=True).start()
+
+
+    def request(self, items):
+        with self.condition:
+            # The queue is replaced, not extended: rows that scrolled away are dropped before a worker takes them
+            self.wanted = OrderedDict((key, (path, fileid)) for key, path, fileid in items if key not in self.inflight)
+            self.condition.notify_all()
+
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.wanted and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                key, (path, fileid) = self.wanted.popitem(last=False)
+                self.inflight.add(key)
+            try:
+                image = self.load(key, fileid)
+            except Exception as e:
+                logging.debug(f"Не удалось загрузить миниатюру {path}: {e}")
+                image = None
+            finally:
+                with self.condition:
+                    self.inflight.discard(key)
+            self.loaded.emit(path, key, image)
+
+
+    def load(self, key, fileid):
+        data = self.cache.get(key, 0)
+        if data is None:
+            response = self.session.get(self.base_url + 'index.php/core/preview',
+                                        params={'fileId': fileid, 'x': THUMBNAIL_WIDTH, 'y': THUMBNAIL_HEIGHT, 'a': 1})
+            if response.status_code not in (200, 404):
+                raise requests.exceptions.HTTPError(f"{response.status_code} {response.reason}")
+            # A file without a preview is remembered as an empty entry, so it is not asked for again
+            data = response.content if response.status_code == 200 else b''
+            metrics.count('bytes.thumbnails', len(data))
+            self.cache.put(key, 0, data)
+        if not data:
+            return None
+        # QImage can be decoded on any thread, only the QPixmap has to be made on the GUI thread
+        image = QImage()
+        if not image.loadFromData(data):
+            return None
+        if image.width() > THUMBNAIL_WIDTH or image.height() > THUMBNAIL_HEIGHT:
+            image = image.scaled(THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        return image
+
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.wanted.clear()
+            self.condition.notify_all()
+
+
+
+StreamInfo = namedtuple('StreamInfo', ['path', 'url', 'size', 'etag', 'key', 'content_type'])
+
+
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+class StreamProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
 
-CONFIG_FILE = 'config.json'
 
+    def log_message(self, format, *args):
+        pass
 
 
-class BasicAuthWithUnicode(requests.auth.AuthBase):
+    def do_HEAD(self):
+        self.serve(False)
 
 
-    def __init__(self, username, password):
+    def do_GET(self):
+        self.serve(True)
+
+
+    def serve(self, send_body):
+        proxy = self.server.proxy
+        resolved = proxy.resolve(self.path)
+        if resolved is None:
+            self.send_error(404)
+            return
+        path, mode = resolved
+        try:
+            info = proxy.stream_info(path)
+        except Exception as e:
+            logging.error(f"Прокси: не удалось открыть {path}: {e}")
+            self.send_error(502)
+            return
+        start, end = 0, info.size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            # Only a single well-formed range is served, anything else is answered like an unsatisfiable one
+            first, _, last = range_header[6:].strip().partition('-')
+            try:
+                if first:
+                    start = int(first)
+                    end = min(int(last), info.size - 1) if last else info.size - 1
+                else:
+                    start = max(0, info.size - int(last))
+            except ValueError:
+                start = info.size
+            if start >= info.size or start > end:
+                self.send_unsatisfiable(info.size)
+                return
+            status = 206
+        if mode == 'probe':
+            # Headers sit at the start and indexes at the start or the end, the middle of the file is never fetched
+            head_end = min(METADATA_PROBE_CHUNKS * STREAM_CHUNK_SIZE, info.size) - 1
+            tail_start = max(0, info.size - METADATA_PROBE_CHUNKS * STREAM_CHUNK_SIZE)
+            if head_end < start < tail_start:
+                self.send_unsatisfiable(info.size)
+                return
+            if start < tail_start and end > head_end:
+                end = head_end
+                status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', info.content_type)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{info.size}')
+        self.end_headers()
+        if not send_body:
+            return
+        try:
+            proxy.copy_range(info, start, end, self.wfile, mode)
+        except (BrokenPipeError, ConnectionResetError):
+            # VLC drops the connection on every seek
+            self.close_connection = True
+        except Exception as e:
+            logging.error(f"Прокси: ошибка чтения {path}: {e}")
+            self.close_connection = True
+
+
+    def send_unsatisfiable(self, size):
+        self.send_response(416)
+        self.send_header('Content-Range', f'bytes */{size}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+
+class StreamProxy:
+
+
+    def __init__(self, session, cache):
+        self.session = session
+        self.cache = cache
+        self.base_url = None
+        self.token = secrets.token_urlsafe(16)
+        # Background readers such as the seek preview generator get their own token, no readahead and a rate cap
+        self.background_token = secrets.token_urlsafe(16)
+        self.background_bucket = TokenBucket(PREVIEW_MAX_RATE)
+        # Metadata probes only read the ends of the file and never start a readahead
+        self.probe_token = secrets.token_urlsafe(16)
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.inflight = {}
+        self.queued = set()
+        self.readahead = ThreadPoolExecutor(max_workers=STREAM_READAHEAD_THREADS, thread_name_prefix='stream-readahead')
+        self.server = None
+
+
+    def start(self):
+        if self.server:
+            return
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StreamProxyHandler)
+        self.server.daemon_threads = True
+        self.server.proxy = self
+        threading.Thread(target=self.server.serve_forever, name='stream-proxy', daemon=True).start()
+        logging.info(f"Локальный прокси видео запущен на порту {self.server.server_address[1]}")
+
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.readahead.shutdown(wait=False)
+
+
+    def url_for(self, path, background=False, probe=False):
+        self.start()
+        if probe:
+            return f"http://127.0.0.1:{self.server.server_address[1]}/{self.probe_token}/{quote(path)}"
+        if background:
+            return f"http://127.0.0.1:{self.server.server_address[1]}/{self.background_token}/{quote(path)}"
+        with self.lock:
+            # Look the file up again on every play so a changed etag never serves stale chunks
+            self.streams.pop(path, None)
+        return f"http://127.0.0.1:{self.server.server_address[1]}/{self.token}/{quote(path)}"
+
+
+    def known_info(self, path):
+        with self.lock:
+            return self.streams.get(path)
+
+
+    def resolve(self, request_path):
+        for token, mode in ((self.token, 'play'), (self.background_token, 'background'), (self.probe_token, 'probe')):
+            prefix = f"/{token}/"
+            if request_path.startswith(prefix):
+                return unquote(request_path[len(prefix):]), mode
+        return None
+
+
+    def stream_info(self, path):
+        with self.lock:
+            info = self.streams.get(path)
+        if info:
+            return info
+        url = self.base_url + quote(path)
+        response = self.session.head(url, allow_redirects=True)
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(f"{response.status_code} {response.reason}")
+        size = int(response.headers.get('Content-Length', 0))
+        etag = response.headers.get('ETag', '').strip('"')
+        key = hashlib.sha1(f"{url}|{etag}|{size}".encode('utf-8')).hexdigest()
+        info = StreamInfo(path, url, size, etag, key, response.headers.get('Content-Type', 'application/octet-stream'))
+        with self.lock:
+            self.streams[path] = info
+        return info
+
+
+    def chunk_count(self, info):
+        return (info.size + STREAM_CHUNK_SIZE - 1) // STREAM_CHUNK_SIZE
+
+
+    def warm_up(self, path):
+        self.readahead.submit(self.warm, path)
+
+
+    def warm(self, path):
+        try:
+            info = self.stream_info(path)
+        except Exception as e:
+            logging.debug(f"Прокси: не удалось подготовить {path}: {e}")
+            return
+        self.schedule_readahead(info, 0)
+        # Containers such as mp4 often keep their index at the end, VLC reads it before the first frame
+        last_index = self.chunk_count(info) - 1
+        if last_index >= STREAM_READAHEAD_CHUNKS:
+            self.schedule_readahead(info, last_index)
+
+
+    def copy_range(self, info, start, end, output, mode='play'):
+        if mode == 'probe':
+            self.copy_through(info, start, end, output)
+            return
+        for index in range(start // STREAM_CHUNK_SIZE, end // STREAM_CHUNK_SIZE + 1):
+            if mode == 'background':
+                if not self.cache.contains(info.key, index):
+                    self.background_bucket.consume(STREAM_CHUNK_SIZE)
+                data = self.get_chunk(info, index)
+            else:
+                data = self.get_chunk(info, index)
+                self.schedule_readahead(info, index + 1)
+            chunk_start = index * STREAM_CHUNK_SIZE
+            output.write(data[max(start, chunk_start) - chunk_start:min(end, chunk_start + len(data) - 1) - chunk_start + 1])
+
+
+    def copy_through(self, info, start, end, output):
+        # Probes read a few kilobytes of headers, streaming them past the cache keeps the playback chunks in place
+        # and stops the download as soon as VLC closes the connection
+        response = self.session.get(info.url, headers={'Range': f'bytes={start}-{end}'}, stream=True)
+        with response:
+            if response.status_code != 206:
+                raise requests.exceptions.HTTPError(f"{response.status_code} {response.reason}")
+            for data in response.iter_content(64 * 1024):
+                metrics.count('bytes.probe', len(data))
+                output.write(data)
+
+
+    def get_chunk(self, info, index):
+        data = self.cache.get(info.key, index)
+        if data is not None:
+            return data
+        with self.lock:
+            future = self.inflight.get((info.key, index))
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight[(info.key, index)] = future
+        if not owner:
+            return future.result()
+        try:
+            data = self.fetch_chunk(info, index)
+            self.cache.put(info.key, index, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop((info.key, index), None)
+
+
+    def fetch_chunk(self, info, index):
+        start = index * STREAM_CHUNK_SIZE
+        end = min(info.size, start + STREAM_CHUNK_SIZE) - 1
+        started = time.monotonic()
+        response = self.session.get(info.url, headers={'Range': f'bytes={start}-{end}'})
+        if response.status_code != 206:
+            raise requests.exceptions.HTTPError(f"{response.status_code} {response.reason}")
+        self.session.estimator.observe_transfer(len(response.content), time.monotonic() - started)
+        metrics.count('bytes.stream', len(response.content))
+        metrics.observe('stream.chunk', time.monotonic() - started)
+        etag = response.headers.get('ETag', '').strip('"')
+        if etag and info.etag and etag != info.etag:
+            with self.lock:
+                self.streams.pop(info.path, None)
+            raise requests.exceptions.HTTPError(f"Файл изменился во время воспроизведения: {info.path}")
+        return response.content
+
+
+    def schedule_readahead(self, info, first_index):
+        last_index = min(first_index + STREAM_READAHEAD_CHUNKS, self.chunk_count(info))
+        for index in range(first_index, last_index):
+            with self.lock:
+                if (info.key, index) in self.inflight or (info.key, index) in self.queued:
+                    continue
+                if self.cache.contains(info.key, index):
+                    continue
+                self.queued.add((info.key, index))
+            self.readahead.submit(self.prefetch, info, index)
+
+
+    def prefetch(self, info, index):
+        try:
+            if not self.cache.contains(info.key, index):
+                self.get_chunk(info, index)
+        except Exception as e:
+            logging.debug(f"Прокси: упреждающая загрузка не удалась: {e}")
+        finally:
+            with self.lock:
+                self.queued.discard((info.key, index))
+
+
+
+class TokenBucket:
+
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.allowance = rate
+
+
+    def consume(self, amount):
+        while True:
+            with self.lock:
+                if self.rate <= 0:
+                    return
+                now = time.monotonic()
+                self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+                self.last = now
+                if self.allowance > 0:
+                    self.allowance -= amount
+                    return
+                delay = -self.allowance / self.rate
+            time.sleep(min(delay, 0.5))
+
+
+
+class ConnectionLimiter:
+
+
+    def __init__(self, limit):
+        self.condition = threading.Condition()
+        self.limit = limit
+        self.active = 0
+
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+
+class DownloadManager(QObject):
+    progress = pyqtSignal(str, object, object)
+    finished = pyqtSignal(str, str)
+    failed = pyqtSignal(str, str)
+
+
+    def __init__(self, session, directory=DOWNLOAD_DIR, parent=None):
+        super().__init__(parent)
+        self.session = session
+        self.directory = directory
+        self.base_url = None
+        self.bucket = TokenBucket()
+        self.limiter = ConnectionLimiter(DOWNLOAD_CONNECTIONS)
+        self.file_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_FILES_PARALLEL, thread_name_prefix='download-file')
+        self.segment_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_CONNECTIONS, thread_name_prefix='download-segment')
+        self.lock = threading.Lock()
+        self.active = set()
+        self.stop_event = threading.Event()
+
+
+    def local_path(self, path):
+        return os.path.join(self.directory, *path.split('/'))
+
+
+    def local_copy(self, path):
+        target = self.local_path(path)
+        if os.path.isfile(target) and not os.path.exists(target + '.part.json'):
+            return target
+        return None
+
+
+    def download(self, path):
+        if path.endswith('/'):
+            self.file_pool.submit(self.download_folder, path)
+        else:
+            self.file_pool.submit(self.download_file, path)
+
+
+    def resume_pending(self):
+        if not os.path.isdir(self.directory):
+            return
+        for folder, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.part.json'):
+                    continue
+                try:
+                    with open(os.path.join(folder, name), 'r', encoding='utf-8') as state_file:
+                        path = json.load(state_file)['path']
+                except (OSError, ValueError, KeyError):
+                    continue
+                logging.info(f"Возобновление загрузки: {path}")
+                self.download(path)
+
+
+    def download_folder(self, path):
+        folders = [path]
+        try:
+            while folders and not self.stop_event.is_set():
+                folder = folders.pop(0)
+                _, children = propfind_folder(self.session, self.base_url + quote(folder))
+                for entry in children:
+                    if entry.is_collection:
+                        folders.append(folder + entry.name + '/')
+                    else:
+                        self.file_pool.submit(self.download_file, folder + entry.name)
+        except Exception as e:
+            logging.error(f"Ошибка загрузки каталога {path}: {e}")
+            self.failed.emit(path, str(e))
+
+
+    def download_file(self, path):
+        with self.lock:
+            if path in self.active:
+                return
+            self.active.add(path)
+        try:
+            target = self.fetch_file(path)
+            if target:
+                logging.info(f"Загрузка завершена: {path}")
+                self.finished.emit(path, target)
+        except Exception as e:
+            logging.error(f"Ошибка загрузки {path}: {e}")
+            self.failed.emit(path, str(e))
+        finally:
+            with self.lock:
+                self.active.discard(path)
+
+
+    def fetch_file(self, path):
+        url = self.base_url + quote(path)
+        response = self.session.head(url, allow_redirects=True)
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(f"{response.status_code} {response.reason}")
+        size = int(response.headers.get('Content-Length', 0))
+        etag = response.headers.get('ETag', '').strip('"')
+        target = self.local_path(path)
+        part = target + '.part'
+        state_filename = part + '.json'
+        if os.path.isfile(target) and not os.path.exists(state_filename) and os.path.getsize(target) == size:
+            return target
+
+        state = None
+        if os.path.exists(state_filename) and os.path.exists(part):
+            try:
+                with open(state_filename, 'r', encoding='utf-8') as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                state = None
+        if not state or state.get('etag') != etag or state.get('size') != size or state.get('segment_size') != DOWNLOAD_SEGMENT_SIZE:
+            # Nothing usable to resume from, the file is preallocated once and filled in place
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(part, 'wb') as part_file:
+                part_file.truncate(size)
+            state = {'path': path, 'etag': etag, 'size': size, 'segment_size': DOWNLOAD_SEGMENT_SIZE, 'done': []}
+            self.save_state(state_filename, state)
+
+        segments = (size + DOWNLOAD_SEGMENT_SIZE - 1) // DOWNLOAD_SEGMENT_SIZE
+        done = set(state['done'])
+        progress = [sum(min(DOWNLOAD_SEGMENT_SIZE, size - index * DOWNLOAD_SEGMENT_SIZE) for index in done), 0.0]
+        progress_lock = threading.Lock()
+
+        def on_bytes(count):
+            with progress_lock:
+                progress[0] += count
+                now = time.monotonic()
+                if now - progress[1] < 0.5:
+                    return
+                progress[1] = now
+            self.progress.emit(path, progress[0], size)
+
+        futures = {self.segment_pool.submit(self.fetch_segment, url, part, index, size, etag, on_bytes): index
+                   for index in range(segments) if index not in done}
+        for future in as_completed(futures):
+            future.result()
+            done.add(futures[future])
+            state['done'] = sorted(done)
+            self.save_state(state_filename, state)
+        if self.stop_event.is_set():
+            return None
+        os.replace(part, target)
+        os.remove(state_filename)
+        self.progress.emit(path, size, size)
+        return target
+
+
+    def fetch_segment(self, url, part, index, size, etag, on_bytes):
+        with self.limiter:
+            if self.stop_event.is_set():
+                raise RuntimeError("Загрузка остановлена")
+            start = index * DOWNLOAD_SEGMENT_SIZE
+            end = min(size, start + DOWNLOAD_SEGMENT_SIZE) - 1
+            response = self.session.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True)
+            with response:
+                if response.status_code != 206:
+                    raise requests.exceptions.HTTPError(f"{response.status_code} {response.reason}")
+                if etag and response.headers.get('ETag', '').strip('"') not in ('', etag):
+                    raise requests.exceptions.HTTPError("Файл изменился во время загрузки")
+                written = 0
+                with open(part, 'r+b') as part_file:
+                    part_file.seek(start)
+                    for chunk in response.iter_content(64 * 1024):
+                        if self.stop_event.is_set():
+                            raise RuntimeError("Загрузка остановлена")
+                        self.bucket.consume(len(chunk))
+                        part_file.write(chunk)
+                        written += len(chunk)
+                        metrics.count('bytes.download', len(chunk))
+                        on_bytes(len(chunk))
+            if written != end - start + 1:
+                raise requests.exceptions.ConnectionError(f"Сегмент {index} получен не полностью")
+
+
+    def save_state(self, state_filename, state):
+        temp_filename = state_filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as state_file:
+            json.dump(state, state_file, ensure_ascii=False)
+        os.replace(temp_filename, state_filename)
+
+
+    def stop(self):
+        self.stop_event.set()
+        self.file_pool.shutdown(wait=False)
+        self.segment_pool.shutdown(wait=False)
+
+
+
+class SidecarFetcher(QObject):
+    fetched = pyqtSignal(str, str, str, str)  # video path, kind, sidecar path, uri for libvlc
+
+
+    def __init__(self, session, stream_proxy, directory=SIDECAR_CACHE_DIR, max_bytes=SIDECAR_CACHE_MAX_BYTES, parent=None):
+        super().__init__(parent)
+        os.makedirs(directory, exist_ok=True)
+        self.session = session
+        self.stream_proxy = stream_proxy
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.base_url = None
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=SIDECAR_THREADS, thread_name_prefix='sidecar')
+
+
+    def cache_file(self, path, etag):
+        # The extension is kept, libvlc looks at it when guessing the subtitle format
+        key = hashlib.sha1(f"{self.base_url}|{path}|{etag}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + os.path.splitext(path)[1].lower())
+
+
+    def cached(self, path, etag):
+        filename = self.cache_file(path, etag)
+        if not etag or not os.path.exists(filename):
+            return None
+        os.utime(filename)  # trim() drops the least recently used first
+        return filename
+
+
+    def fetch(self, video_path, kind, path, etag, uri=None):
+        self.pool.submit(self.run, video_path, kind, path, etag, uri)
+
+
+    def run(self, video_path, kind, path, etag, uri):
+        try:
+            if kind == 'audio':
+                # Audio tracks can be as large as the video, they go through the stream proxy and only the head is read now
+                info = self.stream_proxy.stream_info(path)
+                self.stream_proxy.schedule_readahead(info, 1)
+                self.stream_proxy.get_chunk(info, 0)
+            else:
+                filename = self.cached(path, etag)
+                if filename is None:
+                    filename = self.download(path, etag)
+                uri = Path(filename).as_uri()
+            self.fetched.emit(video_path, kind, path, uri)
+        except Exception as e:
+            logging.warning(f"Не удалось загрузить {path}: {e}")
+
+
+    def download(self, path, etag):
+        started = time.monotonic()
+        response = self.session.get(self.base_url + quote(path), timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        metrics.count('bytes.sidecars', len(response.content))
+        metrics.observe('sidecar.fetch', time.monotonic() - started)
+        filename = self.cache_file(path, etag)
+        temp_filename = f'{filename}.{threading.get_ident()}.tmp'
+        with open(temp_filename, 'wb') as sidecar_file:
+            sidecar_file.write(response.content)
+        os.replace(temp_filename, filename)
+        self.trim()
+        return filename
+
+
+    def trim(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.tmp'):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    files.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in files)
+            for _, size, name in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    total -= size
+                except OSError:
+                    pass
+
+
+    def stop(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+
+class SeekPreviewGenerator(QObject):
+    sheetUpdated = pyqtSignal(str, object, object)
+
+
+    def __init__(self, cache=None, parent=None):
+        super().__init__(parent)
+        self.cache = cache or ChunkCache(PREVIEW_CACHE_DIR, PREVIEW_CACHE_MAX_BYTES, flat=True)
+        self.vlc_instance = None
+        self.cancel_event = None
+        # Cleared while the main player is buffering, generation waits instead of competing for bandwidth
+        self.allowed = threading.Event()
+        self.allowed.set()
+
+
+    def start(self, key, url, duration_ms, tile_width, tile_height):
+        self.cancel()
+        data, info = self.cache.get(key, 0), self.cache.get(key, 1)
+        if data and info:
+            self.sheetUpdated.emit(key, QImage.fromData(data), json.loads(info))
+            return
+        self.allowed.set()
+        if self.vlc_instance is None:
+            self.vlc_instance = import_vlc().Instance('--no-audio', '--no-spu', '--no-osd', '--quiet')
+        self.cancel_event = threading.Event()
+        threading.Thread(target=self.run, args=(key, url, duration_ms, tile_width, tile_height, self.cancel_event),
+                         name='seek-preview', daemon=True).start()
+
+
+    def cancel(self):
+        if self.cancel_event:
+            self.cancel_event.set()
+            self.cancel_event = None
+
+
+    def pause(self):
+        self.allowed.clear()
+
+
+    def resume(self):
+        self.allowed.set()
+
+
+    def run(self, key, url, duration_ms, tile_width, tile_height, cancel_event):
+        try:
+            self.generate(key, url, duration_ms, tile_width, tile_height, cancel_event)
+        except Exception as e:
+            logging.debug(f"Не удалось построить превью перемотки: {e}")
+
+
+    def generate(self, key, url, duration_ms, tile_width, tile_height, cancel_event):
+        count = max(1, min(PREVIEW_MAX_FRAMES, duration_ms // PREVIEW_MIN_INTERVAL))
+        interval = duration_ms // count
+        info = {'count': 0, 'interval': interval, 'columns': PREVIEW_COLUMNS,
+                'tile_width': tile_width, 'tile_height': tile_height}
+        sheet = QImage(tile_width * PREVIEW_COLUMNS, tile_height * ((count + PREVIEW_COLUMNS - 1) // PREVIEW_COLUMNS),
+                       QImage.Format_RGB32)
+        sheet.fill(Qt.black)
+
+        # Frames are rendered into our own buffer through the vmem callbacks, no window is ever created
+        frame = ctypes.create_string_buffer(tile_width * tile_height * 4)
+        shown = threading.Event()
+
+        @vlc.CallbackDecorators.VideoLockCb
+        def lock(opaque, planes):
+            planes[0] = ctypes.addressof(frame)
+            return None
+
+        @vlc.CallbackDecorators.VideoUnlockCb
+        def unlock(opaque, picture, planes):
+            pass
+
+        @vlc.CallbackDecorators.VideoDisplayCb
+        def display(opaque, picture):
+            shown.set()
+
+        player = self.vlc_instance.media_player_new()
+        media = self.vlc_instance.media_new(url, ':no-audio', ':input-fast-seek')
+        player.set_media(media)
+        player.video_set_callbacks(lock, unlock, display, None)
+        player.video_set_format('RV32', tile_width, tile_height, tile_width * 4)
+        try:
+            player.play()
+            for number in range(count):
+                while not self.allowed.wait(0.5):
+                    if cancel_event.is_set():
+                        return
+                if cancel_event.is_set():
+                    return
+                shown.clear()
+                player.set_pause(0)
+                player.set_time(number * interval + interval // 2)
+                if shown.wait(PREVIEW_FRAME_TIMEOUT):
+                    player.set_pause(1)
+                    image = QImage(frame.raw, tile_width, tile_height, tile_width * 4, QImage.Format_RGB32).copy()
+                    painter = QPainter(sheet)
+                    painter.drawImage((number % PREVIEW_COLUMNS) * tile_width, (number // PREVIEW_COLUMNS) * tile_height, image)
+                    painter.end()
+                info['count'] = number + 1
+                if info['count'] % PREVIEW_COLUMNS == 0 or info['count'] == count:
+                    self.sheetUpdated.emit(key, sheet.copy(), dict(info))
+                cancel_event.wait(PREVIEW_STEP_DELAY)
+        finally:
+            player.stop()
+            player.release()
+            media.release()
+        buffer = QBuffer()
+        buffer.open(QIODevice.WriteOnly)
+        sheet.save(buffer, 'JPG', 85)
+        self.cache.put(key, 0, bytes(buffer.data()))
+        self.cache.put(key, 1, json.dumps(info).encode('utf-8'))
+
+
+
+class LoginCheckSignals(QObject):
+    finished = pyqtSignal(object)
+
+
+
+class LoginCheckJob(QRunnable):
+
+
+    def __init__(self, check, server_url, username, password):
+        super().__init__()
+        self.signals = LoginCheckSignals()
+        self.check = check
+        self.server_url = server_url
         self.username = username
         self.password = password
 
-    def __call__(self, r):
-        import base64
-        auth_str = f'{self.username}:{self.password}'
-        b64_auth_str = base64.b64encode(auth_str.encode('utf-8')).decode('utf-8')
-        r.headers['Authorization'] = f'Basic {b64_auth_str}'
-        return r
+
+    def run(self):
+        self.signals.finished.emit(self.check(self.server_url, self.username, self.password))
 
 
 
 class LoginDialog(QDialog):
 
 
-    def __init__(self, parent=None, server_url='', username='', password=''):
+    def __init__(self, session, parent=None, server_url='', username='', password=''):
         super().__init__(parent)
         self.setWindowTitle('Войти')
+        self.session = session
 
         self.server_url_input = QLineEdit(self)
         self.server_url_input.setPlaceholderText('URL сервера')
@@ -51,6 +3049,10 @@ class LoginDialog(QDialog):
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         button_box.accepted.connect(self.validate_credentials)
         button_box.rejected.connect(self.reject)
+        self.ok_button = button_box.button(QDialogButtonBox.Ok)
+        self.status_label = QLabel('', self)
+        self.login_job = None
+        self.root_listing = None
         
         layout = QVBoxLayout()
         layout.addWidget(QLabel('URL сервера:'))
@@ -59,6 +3061,7 @@ class LoginDialog(QDialog):
         layout.addWidget(self.username_input)
         layout.addWidget(QLabel('Пароль:'))
         layout.addWidget(self.password_input)
+        layout.addWidget(self.status_label)
         layout.addWidget(button_box)
         
         self.setLayout(layout)
@@ -72,8 +3075,22 @@ class LoginDialog(QDialog):
 
 
     def validate_credentials(self):
+        if self.login_job:
+            return
         server_url, username, password = self.get_credentials()
-        if self.check_credentials(server_url, username, password):
+        self.ok_button.setEnabled(False)
+        self.status_label.setText('Проверка учётных данных...')
+        self.login_job = LoginCheckJob(self.check_credentials, server_url, username, password)
+        self.login_job.signals.finished.connect(self.on_credentials_checked, Qt.QueuedConnection)
+        QThreadPool.globalInstance().start(self.login_job)
+
+
+    def on_credentials_checked(self, listing):
+        self.login_job = None
+        self.ok_button.setEnabled(True)
+        self.status_label.setText('')
+        if listing is not None:
+            self.root_listing = listing
             self.accept()
         else:
             QMessageBox.critical(self, "Вход не выполнен!", "Ошибка входа. Пожалуйста, проверьте URL-адрес вашего сервера, имя пользователя и пароль.")
@@ -82,27 +3099,29 @@ class LoginDialog(QDialog):
 
 
     def check_credentials(self, server_url, username, password):
-        full_url = server_url + "remote.php/dav/files/" + quote(username, safe='') + "/"
-        try:
-            response = requests.request("PROPFIND", full_url, auth=BasicAuthWithUnicode(username, password), headers={"Depth": "1"})
-            logging.debug(f"Статус ответа: {response.status_code}")
-            logging.debug(f"Содержимое ответа: {response.content}")
-            return response.status_code == 207
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Запрос не выполнен: {e}")
-            return False
+        return check_login(self.session, server_url, username, password)
+
+
+
+class PlayerSignals(QObject):
+    timeChanged = pyqtSignal(object)
+    lengthChanged = pyqtSignal(object)
+    tracksChanged = pyqtSignal()
+    buffering = pyqtSignal(float)
+    endReached = pyqtSignal()
 
 
 
 class VideoPlayerWindow(QMainWindow):
     closed = pyqtSignal()
+    nearEnd = pyqtSignal()
+    finished = pyqtSignal()
 
 
-    def __init__(self, vlc_instance, media, parent=None):
+    def __init__(self, vlc_instance, parent=None):
         super().__init__(parent)
         self.vlc_instance = vlc_instance
         self.media_player = self.vlc_instance.media_player_new()
-        self.media_player.set_media(media)
 
         self.setWindowTitle("Видео проигрыватель")
         self.setGeometry(100, 100, 800, 600)
@@ -119,7 +3138,9 @@ class VideoPlayerWindow(QMainWindow):
         self.volume_icon = QLabel('🔊', self)
         self.volume_slider = QSlider(Qt.Horizontal, self)
         self.audio_track_box = QComboBox(self)
+        self.subtitle_box = QComboBox(self)
         self.time_label = QLabel('00:00 / 00:00', self)
+        self.buffering_label = QLabel('', self)
 
         self.play_button.setFixedSize(90, 30)
         self.pause_button.setFixedSize(50, 30)
@@ -136,10 +3157,12 @@ class VideoPlayerWindow(QMainWindow):
         self.control_layout.addWidget(self.pause_button)
         self.control_layout.addWidget(self.stop_button)
         self.control_layout.addWidget(self.time_label)
+        self.control_layout.addWidget(self.buffering_label)
         self.control_layout.addWidget(self.slider)
         self.control_layout.addWidget(self.volume_icon)
         self.control_layout.addWidget(self.volume_slider)
         self.control_layout.addWidget(self.audio_track_box)
+        self.control_layout.addWidget(self.subtitle_box)
         self.control_bar.setLayout(self.control_layout)
 
         self.main_layout = QVBoxLayout()
@@ -154,13 +3177,54 @@ class VideoPlayerWindow(QMainWindow):
         self.pause_button.clicked.connect(self.pause_video)
         self.stop_button.clicked.connect(self.stop_video)
         self.slider.sliderMoved.connect(self.set_position)
+        self.slider.setMouseTracking(True)
+        self.slider.installEventFilter(self)
+        self.preview_key = None
+        self.preview_sheet = None
+        self.preview_info = None
+        self.preview_popup = QLabel(self, Qt.ToolTip)
         self.volume_slider.sliderMoved.connect(self.set_volume)
         self.audio_track_box.currentIndexChanged.connect(self.change_audio_track)
+        self.subtitle_box.currentIndexChanged.connect(self.change_subtitle_track)
+
+        self.current_time = 0
+        self.length = 0
+        self.buffer_level = 100.0
+        self.near_end_sent = False
+        self.started = time.monotonic()
+        self.startup_ms = None
+        self.stalls = 0
+        self.seeked = 0.0
+
+        # libvlc fires TimeChanged several times per second, the slider is repainted at most once per interval
+        self.repaint_timer = QTimer(self)
+        self.repaint_timer.setSingleShot(True)
+        self.repaint_timer.setInterval(PLAYER_REPAINT_INTERVAL)
+        self.repaint_timer.timeout.connect(self.update_ui)
+        # ESAdded/ESDeleted come in bursts when a file opens, the track list is rebuilt once they settle
+        self.tracks_timer = QTimer(self)
+        self.tracks_timer.setSingleShot(True)
+        self.tracks_timer.setInterval(PLAYER_TRACKS_DELAY)
+        self.tracks_timer.timeout.connect(self.update_tracks)
 
-        self.timer = QTimer(self)
-        self.timer.setInterval(1000)
-        self.timer.timeout.connect(self.update_ui)
-        self.timer.start()
+        # Event callbacks run on a libvlc thread, so they only emit signals queued to the GUI thread
+        self.signals = PlayerSignals(self)
+        self.signals.timeChanged.connect(self.on_time_changed, Qt.QueuedConnection)
+        self.signals.lengthChanged.connect(self.on_length_changed, Qt.QueuedConnection)
+        self.signals.tracksChanged.connect(self.tracks_timer.start, Qt.QueuedConnection)
+        self.signals.buffering.connect(self.on_buffering, Qt.QueuedConnection)
+        self.signals.endReached.connect(self.finished, Qt.QueuedConnection)
+        self.event_manager = self.media_player.event_manager()
+        self.vlc_events = {
+            vlc.EventType.MediaPlayerTimeChanged: lambda event: self.signals.timeChanged.emit(event.u.new_time),
+            vlc.EventType.MediaPlayerLengthChanged: lambda event: self.signals.lengthChanged.emit(event.u.new_length),
+            vlc.EventType.MediaPlayerESAdded: lambda event: self.signals.tracksChanged.emit(),
+            vlc.EventType.MediaPlayerESDeleted: lambda event: self.signals.tracksChanged.emit(),
+            vlc.EventType.MediaPlayerBuffering: lambda event: self.signals.buffering.emit(event.u.new_cache),
+            vlc.EventType.MediaPlayerEndReached: lambda event: self.signals.endReached.emit(),
+        }
+        for event_type, callback in self.vlc_events.items():
+            self.event_manager.event_attach(event_type, callback)
 
         if sys.platform.startswith('linux'):
             self.media_player.set_xwindow(self.video_frame.winId())
@@ -169,9 +3233,74 @@ class VideoPlayerWindow(QMainWindow):
         elif sys.platform == "darwin":
             self.media_player.set_nsobject(int(self.video_frame.winId()))
 
+
+    def play_media(self, media, title):
+        # The window and its media player are reused, only the media is swapped
+        self.repaint_timer.stop()
+        self.current_time = 0
+        self.length = 0
+        self.buffer_level = 100.0
+        self.near_end_sent = False
+        self.started = time.monotonic()
+        self.startup_ms = None
+        self.stalls = 0
+        self.slider.setRange(0, 0)
+        self.update_ui()
+        self.setWindowTitle(f"Видео проигрыватель - {title}")
+        self.preview_key = None
+        self.preview_sheet = None
+        self.preview_info = None
+        self.preview_popup.hide()
+        self.media_player.set_media(media)
         self.media_player.play()
 
 
+    def add_sidecar(self, kind, uri):
+        # Fetched after playback started: audio stays on the current track, subtitles show unless some are already on
+        select = kind == 'subtitle' and self.media_player.video_get_spu() == -1
+        if self.media_player.add_slave(getattr(vlc.MediaSlaveType, kind), uri, select) != 0:
+            logging.warning(f"libvlc не принял дорожку: {uri}")
+
+
+    def set_preview_sheet(self, key, sheet, info):
+        if key == self.preview_key:
+            self.preview_sheet = sheet
+            self.preview_info = info
+
+
+    def eventFilter(self, watched, event):
+        if watched is self.slider:
+            if event.type() == QEvent.MouseMove:
+                self.show_preview(event.pos().x())
+            elif event.type() == QEvent.Leave:
+                self.preview_popup.hide()
+        return super().eventFilter(watched, event)
+
+
+    def show_preview(self, x):
+        if not self.length:
+            return
+        position = QStyle.sliderValueFromPosition(self.slider.minimum(), self.slider.maximum(), x, self.slider.width())
+        text = self.format_time(position // 1000)
+        info = self.preview_info
+        if info and info['count']:
+            number = min(position // info['interval'], info['count'] - 1)
+            width, height = info['tile_width'], info['tile_height']
+            tile = self.preview_sheet.copy((number % info['columns']) * width, (number // info['columns']) * height, width, height)
+            pixmap = QPixmap.fromImage(tile)
+            painter = QPainter(pixmap)
+            painter.setPen(Qt.white)
+            painter.drawText(pixmap.rect().adjusted(0, 0, 0, -2), Qt.AlignHCenter | Qt.AlignBottom, text)
+            painter.end()
+            self.preview_popup.setPixmap(pixmap)
+        else:
+            self.preview_popup.setText(text)
+        self.preview_popup.adjustSize()
+        self.preview_popup.move(self.slider.mapToGlobal(QPoint(x - self.preview_popup.width() // 2,
+                                                               -self.preview_popup.height() - 4)))
+        self.preview_popup.show()
+
+
     def play_video(self):
         self.media_player.play()
 
@@ -185,20 +3314,56 @@ class VideoPlayerWindow(QMainWindow):
 
 
     def set_position(self, position):
-        self.media_player.set_position(position / 100.0)
+        # The slider works in milliseconds, so seeking is not limited to 1% steps on long films
+        self.media_player.set_time(position)
+        self.current_time = position
+        self.seeked = time.monotonic()
+        self.update_time_label()
 
 
     def set_volume(self, volume):
         self.media_player.audio_set_volume(volume)
 
 
+    def on_time_changed(self, new_time):
+        self.current_time = new_time
+        if self.startup_ms is None and new_time > 0:
+            self.startup_ms = int((time.monotonic() - self.started) * 1000)
+        if not self.near_end_sent and self.length and self.length - new_time < PLAYLIST_PREBUFFER_MS:
+            self.near_end_sent = True
+            self.nearEnd.emit()
+        if not self.repaint_timer.isActive():
+            self.repaint_timer.start()
+
+
+    def on_length_changed(self, length):
+        self.length = length
+        self.slider.setRange(0, length)
+        self.update_ui()
+
+
+    def on_buffering(self, level):
+        # Buffering after the first frame is a stall, unless the user has just seeked
+        if (self.startup_ms is not None and level < 100 <= self.buffer_level
+                and time.monotonic() - self.seeked > STALL_GRACE_AFTER_SEEK):
+            self.stalls += 1
+        self.buffer_level = level
+        if not self.repaint_timer.isActive():
+            self.repaint_timer.start()
+
+
     def update_ui(self):
-        media_pos = self.media_player.get_position()
-        self.slider.setValue(int(media_pos * 100))
-        self.update_audio_tracks()
+        if not self.slider.isSliderDown():
+            self.slider.setValue(self.current_time)
+        self.buffering_label.setText(f'Буферизация {int(self.buffer_level)}%' if self.buffer_level < 100 else '')
         self.update_time_label()
 
 
+    def update_tracks(self):
+        self.update_audio_tracks()
+        self.update_subtitle_tracks()
+
+
     def update_audio_tracks(self):
         audio_tracks = self.media_player.audio_get_track_description()
         current_track = self.media_player.audio_get_track()
@@ -217,9 +3382,26 @@ class VideoPlayerWindow(QMainWindow):
         self.media_player.audio_set_track(track_id)
 
 
+    def update_subtitle_tracks(self):
+        subtitle_tracks = self.media_player.video_get_spu_description()
+        current_track = self.media_player.video_get_spu()
+        self.subtitle_box.blockSignals(True)
+        self.subtitle_box.clear()
+        for track_id, track_name in subtitle_tracks:
+            if isinstance(track_name, bytes):
+                track_name = track_name.decode('utf-8')
+            self.subtitle_box.addItem('Без субтитров' if track_id == -1 else track_name, track_id)
+        self.subtitle_box.setCurrentIndex(self.subtitle_box.findData(current_track))
+        self.subtitle_box.blockSignals(False)
+
+
+    def change_subtitle_track(self, index):
+        self.media_player.video_set_spu(self.subtitle_box.itemData(index))
+
+
     def update_time_label(self):
-        current_time = self.media_player.get_time() // 1000
-        total_time = self.media_player.get_length() // 1000
+        current_time = self.current_time // 1000
+        total_time = self.length // 1000
         current_time_str = self.format_time(current_time)
         total_time_str = self.format_time(total_time)
         self.time_label.setText(f'{current_time_str} / {total_time_str}')
@@ -232,12 +3414,21 @@ class VideoPlayerWindow(QMainWindow):
 
 
     def closeEvent(self, event):
+        self.preview_popup.hide()
         self.media_player.stop()
-        self.timer.stop()
+        self.repaint_timer.stop()
+        self.tracks_timer.stop()
         self.closed.emit()
         event.accept()
 
 
+    def release(self):
+        for event_type in self.vlc_events:
+            self.event_manager.event_detach(event_type)
+        self.media_player.stop()
+        self.media_player.release()
+
+
 
 class NextcloudVideoPlayer(QMainWindow):
     loggedIn = pyqtSignal()
@@ -252,12 +3443,83 @@ class NextcloudVideoPlayer(QMainWindow):
         self.username = None
         self.password = None
 
-        self.tree_widget = QTreeWidget(self)
-        self.tree_widget.setHeaderLabel('Файлы')
-        self.tree_widget.itemDoubleClicked.connect(self.on_item_double_clicked)
+        self.tree_model = FileTreeModel(self)
+        self.tree_model.fetchRequested.connect(self.populate_file_tree, Qt.QueuedConnection)
+        self.tree_proxy = FileSortProxyModel(self)
+        self.tree_proxy.setSourceModel(self.tree_model)
+        self.tree_view = QTreeView(self)
+        self.tree_view.setModel(self.tree_proxy)
+        self.tree_view.setUniformRowHeights(True)
+        self.tree_view.setSortingEnabled(True)
+        self.tree_view.sortByColumn(0, Qt.AscendingOrder)
+        self.tree_view.setExpandsOnDoubleClick(False)
+        self.tree_view.doubleClicked.connect(self.on_item_double_clicked)
+        self.tree_view.collapsed.connect(self.on_item_collapsed)
+        self.tree_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.tree_view.customContextMenuRequested.connect(self.show_tree_context_menu)
+
+        self.http_session = WebDavSession()
+        self.thumbnail_cache = PixmapCache()
+        self.thumbnail_placeholder = QPixmap(THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT)
+        self.thumbnail_placeholder.fill(Qt.transparent)
+        self.thumbnail_missing = set()
+        self.thumbnail_loader = ThumbnailLoader(self.http_session, parent=self)
+        self.thumbnail_loader.loaded.connect(self.on_thumbnail_loaded, Qt.QueuedConnection)
+        self.thumbnail_timer = QTimer(self)
+        self.thumbnail_timer.setSingleShot(True)
+        self.thumbnail_timer.setInterval(THUMBNAIL_SCHEDULE_DELAY)
+        self.thumbnail_timer.timeout.connect(self.request_visible_thumbnails)
+        self.tree_view.verticalScrollBar().valueChanged.connect(self.thumbnail_timer.start)
+        self.tree_view.expanded.connect(self.thumbnail_timer.start)
+        self.tree_view.collapsed.connect(self.thumbnail_timer.start)
+        self.tree_proxy.rowsInserted.connect(self.thumbnail_timer.start)
+        self.tree_proxy.layoutChanged.connect(self.thumbnail_timer.start)
+        self.tree_proxy.modelReset.connect(self.thumbnail_timer.start)
+        self.stream_proxy = StreamProxy(self.http_session, ChunkCache())
+        self.download_manager = DownloadManager(self.http_session, parent=self)
+        self.download_manager.progress.connect(self.on_download_progress, Qt.QueuedConnection)
+        self.download_manager.finished.connect(self.on_download_finished, Qt.QueuedConnection)
+        self.download_manager.failed.connect(self.on_download_failed, Qt.QueuedConnection)
+        self.downloads = {}
+        self.listing_cache = ListingCache()
+        self.listing_service = ListingService(self.http_session, self.listing_cache, self)
+        self.listing_service.listingStale.connect(self.on_listing_stale)
+        self.listing_service.listingBatch.connect(self.on_listing_batch)
+        self.listing_service.listingReady.connect(self.on_listing_ready)
+        self.listing_service.listingFailed.connect(self.on_listing_failed)
+        self.prefetcher = FolderPrefetcher(self.http_session, self.listing_cache, lambda: not self.listing_service.jobs)
+        self.expand_targets = {}  # folder path -> levels still to expand below it
+        self.listing_error_shown = False
         
+        self.library_index = None
+        self.library_crawler = None
+        self.search_input = QLineEdit(self)
+        self.search_input.setPlaceholderText('Поиск по библиотеке...')
+        self.search_input.setClearButtonEnabled(True)
+        self.search_input.setEnabled(False)
+        self.search_input.textChanged.connect(self.search_library)
+        self.search_results = QListWidget(self)
+        self.search_results.itemActivated.connect(self.on_search_result_activated)
+        self.search_results.hide()
+        self.index_status_label = QLabel('', self)
+        self.download_status_label = QLabel('', self)
+        self.tree_filter_input = QLineEdit(self)
+        self.tree_filter_input.setPlaceholderText('Фильтр по имени, длительности, разрешению, кодекам...')
+        self.tree_filter_input.setClearButtonEnabled(True)
+        self.tree_filter_input.textChanged.connect(self.filter_tree)
+        self.filter_expand_queue = deque()
+        self.filter_expand_timer = QTimer(self)
+        self.filter_expand_timer.setSingleShot(True)
+        self.filter_expand_timer.timeout.connect(self.expand_filter_step)
+        self.filter_saved_expansion = None  # folders expanded before the filter was typed
+
         layout = QVBoxLayout()
-        layout.addWidget(self.tree_widget)
+        layout.addWidget(self.search_input)
+        layout.addWidget(self.search_results)
+        layout.addWidget(self.tree_filter_input)
+        layout.addWidget(self.tree_view)
+        layout.addWidget(self.index_status_label)
+        layout.addWidget(self.download_status_label)
         
         container = QWidget()
         container.setLayout(layout)
@@ -273,16 +3535,34 @@ class NextcloudVideoPlayer(QMainWindow):
 
         self.create_menu()
 
-        self.log_window = QTextEdit(self)
+        self.log_sink = None
+        self.log_file = None
+        self.log_levels = dict(LOG_VIEW_LEVELS)
+        self.log_window = QPlainTextEdit(self)
         self.log_window.setReadOnly(True)
         self.log_window.setMinimumHeight(100)
+        self.log_window.setMaximumBlockCount(LOG_VIEW_MAX_LINES)
+        self.log_timer = QTimer(self)
+        self.log_timer.setInterval(LOG_FLUSH_INTERVAL)
+        self.log_timer.timeout.connect(self.flush_log)
+
+        self.log_level_box = QComboBox(self)
+        for name in ('DEBUG', 'INFO', 'WARNING', 'ERROR'):
+            self.log_level_box.addItem(name, getattr(logging, name))
+        self.log_level_box.currentIndexChanged.connect(self.change_log_level)
 
         self.save_log_button = QPushButton("Сохранить лог")
         self.save_log_button.clicked.connect(self.save_log)
 
+        log_buttons = QHBoxLayout()
+        log_buttons.addWidget(QLabel('Уровень:', self))
+        log_buttons.addWidget(self.log_level_box)
+        log_buttons.addStretch()
+        log_buttons.addWidget(self.save_log_button)
+
         log_layout = QVBoxLayout()
         log_layout.addWidget(self.log_window)
-        log_layout.addWidget(self.save_log_button)
+        log_layout.addLayout(log_buttons)
         
         log_container = QWidget()
         log_container.setLayout(log_layout)
@@ -294,26 +3574,165 @@ class NextcloudVideoPlayer(QMainWindow):
         self.toggle_log_action = QAction("Открыть лог", self)
         self.toggle_log_action.triggered.connect(self.toggle_log_window)
         self.menuBar().addAction(self.toggle_log_action)
+
+        self.diagnostics_view = QPlainTextEdit(self)
+        self.diagnostics_view.setReadOnly(True)
+        self.diagnostics_view.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.diagnostics_view.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.diagnostics_timer = QTimer(self)
+        self.diagnostics_timer.setInterval(METRICS_REFRESH_INTERVAL)
+        self.diagnostics_timer.timeout.connect(self.refresh_diagnostics)
+        self.diagnostics_timer.start()
+        self.tracing_box = QCheckBox("Трассировка", self)
+        self.tracing_box.toggled.connect(self.set_tracing)
+        self.tracing_box.clicked.connect(self.save_settings)
+        export_jsonl_button = QPushButton("Экспорт JSONL")
+        export_jsonl_button.clicked.connect(lambda: self.export_metrics(prometheus=False))
+        export_prometheus_button = QPushButton("Экспорт Prometheus")
+        export_prometheus_button.clicked.connect(lambda: self.export_metrics(prometheus=True))
+        reset_metrics_button = QPushButton("Сбросить")
+        reset_metrics_button.clicked.connect(self.reset_metrics)
+
+        diagnostics_buttons = QHBoxLayout()
+        diagnostics_buttons.addWidget(self.tracing_box)
+        diagnostics_buttons.addStretch()
+        diagnostics_buttons.addWidget(reset_metrics_button)
+        diagnostics_buttons.addWidget(export_jsonl_button)
+        diagnostics_buttons.addWidget(export_prometheus_button)
+
+        diagnostics_layout = QVBoxLayout()
+        diagnostics_layout.addWidget(self.diagnostics_view)
+        diagnostics_layout.addLayout(diagnostics_buttons)
+        diagnostics_container = QWidget()
+        diagnostics_container.setLayout(diagnostics_layout)
+
+        self.diagnostics_dock = QDockWidget("Диагностика", self)
+        self.diagnostics_dock.setWidget(diagnostics_container)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.diagnostics_dock)
+        self.tabifyDockWidget(self.dock_widget, self.diagnostics_dock)
+        self.diagnostics_dock.hide()
+        self.diagnostics_action = QAction("Диагностика", self)
+        self.diagnostics_action.triggered.connect(self.toggle_diagnostics)
+        self.menuBar().addAction(self.diagnostics_action)
+        self.profiler = None
+
+        self.videos_list = QListWidget(self)
+        self.videos_list.itemActivated.connect(self.on_search_result_activated)
+        self.videos_status_label = QLabel('', self)
+        videos_layout = QVBoxLayout()
+        videos_layout.addWidget(self.videos_status_label)
+        videos_layout.addWidget(self.videos_list)
+        videos_container = QWidget()
+        videos_container.setLayout(videos_layout)
+        self.videos_dock = QDockWidget("Все видео", self)
+        self.videos_dock.setWidget(videos_container)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.videos_dock)
+        self.videos_dock.hide()
+        self.video_search_job = None
+        self.video_search_id = 0
+        self.videos_from_index = False
+        self.all_videos_action = QAction("Все видео", self)
+        self.all_videos_action.triggered.connect(self.show_all_videos)
+        self.menuBar().addAction(self.all_videos_action)
         
-        self.vlc_instance = vlc.Instance()
+        self.libvlc = LibVlc(self)
+        # The player window is created ahead of time so the first play does not pay for its setup
+        self.libvlc.ready.connect(self.ensure_video_player, Qt.QueuedConnection)
+        self.sidecar_fetcher = SidecarFetcher(self.http_session, self.stream_proxy, parent=self)
+        self.sidecar_fetcher.fetched.connect(self.on_sidecar_fetched, Qt.QueuedConnection)
+        self.seek_preview = SeekPreviewGenerator(parent=self)
+        self.seek_preview.sheetUpdated.connect(self.on_preview_sheet, Qt.QueuedConnection)
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_START_DELAY)
+        self.preview_timer.timeout.connect(self.start_seek_previews)
+        self.metadata_cache = MetadataCache()
+        self.metadata_updates = {}
+        self.metadata_timer = QTimer(self)
+        self.metadata_timer.setSingleShot(True)
+        self.metadata_timer.setInterval(METADATA_FLUSH_INTERVAL)
+        self.metadata_timer.timeout.connect(self.flush_metadata)
+        self.media_prober = MediaProber(self.libvlc, self)
+        self.media_prober.probed.connect(self.on_media_probed, Qt.QueuedConnection)
+        self.video_player_window = None
+        self.media_caching = {}
+        metrics.add_source('http', self.http_session.stats.snapshot)
+        metrics.add_source('network', self.http_session.estimator.snapshot)
+        metrics.add_source('listing_cache', self.listing_cache.stats)
+        metrics.add_source('stream_cache', self.stream_proxy.cache.stats)
+        metrics.add_source('thumbnail_cache', self.thumbnail_loader.cache.stats)
+        self.playing_path = None
+        self.next_media = None
+
+        self.login_job = None
+        self.root_listing = None
+        self.snapshot_etag = None
+
+        self.load_settings()
+    
+
+    def create_menu(self):
+        self.menu = self.menuBar().addMenu('Настройки')
+
+        self.theme_action = QAction('Тёмная тема', self)
+        self.theme_action.setCheckable(True)
+        self.theme_action.toggled.connect(self.toggle_theme)
+        self.menu.addAction(self.theme_action)
+
+        self.reindex_action = QAction('Обновить индекс библиотеки', self)
+        self.reindex_action.triggered.connect(self.start_library_crawl)
+        self.menu.addAction(self.reindex_action)
+
+        self.stream_cache_action = QAction('Размер кэша видео...', self)
+        self.stream_cache_action.triggered.connect(self.change_stream_cache_size)
+        self.menu.addAction(self.stream_cache_action)
+
+        self.download_dir_action = QAction('Папка загрузок...', self)
+        self.download_dir_action.triggered.connect(self.change_download_dir)
+        self.menu.addAction(self.download_dir_action)
+
+        self.download_limits_action = QAction('Ограничения загрузок...', self)
+        self.download_limits_action.triggered.connect(self.change_download_limits)
+        self.menu.addAction(self.download_limits_action)
+
+        self.thumbnails_action = QAction('Миниатюры', self)
+        self.thumbnails_action.setCheckable(True)
+        self.thumbnails_action.toggled.connect(self.toggle_thumbnails)
+        self.thumbnails_action.triggered.connect(self.save_settings)
+        self.thumbnails_action.setChecked(True)
+        self.menu.addAction(self.thumbnails_action)
+
+        self.prefetch_action = QAction('Предзагрузка подкаталогов', self)
+        self.prefetch_action.setCheckable(True)
+        self.prefetch_action.toggled.connect(self.toggle_prefetch)
+        self.prefetch_action.triggered.connect(self.save_settings)
+        self.menu.addAction(self.prefetch_action)
+
+        self.prefetch_limits_action = QAction('Параметры предзагрузки...', self)
+        self.prefetch_limits_action.triggered.connect(self.change_prefetch_limits)
+        self.menu.addAction(self.prefetch_limits_action)
 
-        self.load_settings()
-        self.show_login_dialog()
-    
+        self.playlist_action = QAction('Воспроизводить каталог подряд', self)
+        self.playlist_action.setCheckable(True)
+        self.playlist_action.triggered.connect(self.save_settings)
+        self.menu.addAction(self.playlist_action)
 
-    def create_menu(self):
-        self.menu = self.menuBar().addMenu('Настройки')
+        self.connection_stats_action = QAction('Статистика соединений', self)
+        self.connection_stats_action.triggered.connect(self.show_connection_stats)
+        self.menu.addAction(self.connection_stats_action)
 
-        self.theme_action = QAction('Тёмная тема', self)
-        self.theme_action.setCheckable(True)
-        self.theme_action.toggled.connect(self.toggle_theme)
-        self.menu.addAction(self.theme_action)
+        self.profiling_action = QAction('Профилирование (cProfile)', self)
+        self.profiling_action.setCheckable(True)
+        self.profiling_action.toggled.connect(self.toggle_profiling)
+        self.menu.addAction(self.profiling_action)
 
 
     def show_login_dialog(self):
-        dialog = LoginDialog(self, self.server_url, self.username, self.password)
+        dialog = LoginDialog(self.http_session, self, self.server_url, self.username, self.password)
         if dialog.exec_() == QDialog.Accepted:
             self.server_url, self.username, self.password = dialog.get_credentials()
+            self.http_session.set_credentials(self.username, self.password)
+            self.root_listing = dialog.root_listing
             logging.info(f"Выполнен вход, имя пользователя: {self.username}")
             self.save_settings()
             self.loggedIn.emit()
@@ -321,6 +3740,41 @@ class NextcloudVideoPlayer(QMainWindow):
             sys.exit()
 
 
+    def start(self):
+        self.libvlc.start()
+        if not (self.server_url and self.username and self.password):
+            self.show_login_dialog()
+            return
+        # Stored credentials are trusted for showing the last session's tree, and checked while it is already on screen
+        self.http_session.set_credentials(self.username, self.password)
+        self.show_snapshot()
+        self.index_status_label.setText('Проверка учётных данных...')
+        self.login_job = LoginCheckJob(functools.partial(check_login, self.http_session), self.server_url, self.username, self.password)
+        self.login_job.signals.finished.connect(self.on_stored_login_checked, Qt.QueuedConnection)
+        QThreadPool.globalInstance().start(self.login_job)
+
+
+    def show_snapshot(self):
+        cached = self.listing_cache.get(self.server_url, self.username, "")
+        if not cached:
+            return
+        etag, entries = cached
+        self.tree_model.append_entries(self.tree_model.root, entries)
+        self.snapshot_etag = etag
+        logging.debug(f"Показан сохранённый список корневого каталога: {len(entries)} элементов")
+
+
+    def on_stored_login_checked(self, listing):
+        self.login_job = None
+        self.index_status_label.setText('')
+        if listing is None:
+            self.show_login_dialog()
+            return
+        self.root_listing = listing
+        logging.info(f"Выполнен вход, имя пользователя: {self.username}")
+        self.loggedIn.emit()
+
+
     def toggle_theme(self, checked):
         if checked:
             self.set_dark_theme()
@@ -334,7 +3788,7 @@ class NextcloudVideoPlayer(QMainWindow):
         QMainWindow {
             background-color: #2e2e2e;
         }
-        QTreeWidget, QDialog, QDockWidget, QTextEdit, QPushButton {
+        QTreeView, QDialog, QDockWidget, QPlainTextEdit, QPushButton {
             background-color: #3e3e3e;
             color: #ffffff;
         }
@@ -383,6 +3837,133 @@ class NextcloudVideoPlayer(QMainWindow):
         except Exception as e:
             logging.error(f"Ошибка получения списка файлов: {e}")
             print(f"Ошибка: {e}")
+        self.open_library_index()
+        self.download_manager.base_url = self.dav_url()
+        self.download_manager.resume_pending()
+
+
+    def dav_url(self, path=""):
+        return self.server_url + "remote.php/dav/files/" + quote(self.username, safe='') + "/" + quote(path)
+
+
+    def open_library_index(self):
+        if self.library_crawler:
+            self.library_crawler.stop()
+        self.library_index = LibraryIndex(self.server_url, self.username)
+        self.library_crawler = LibraryCrawler(self.http_session, self.library_index, self.dav_url(), self)
+        self.library_crawler.progress.connect(self.on_crawl_progress)
+        self.library_crawler.finished.connect(self.on_crawl_finished)
+        self.library_crawler.failed.connect(self.on_crawl_failed)
+        self.search_input.setEnabled(True)
+        self.start_library_crawl()
+
+
+    def start_library_crawl(self):
+        if not self.library_crawler:
+            self.show_login_error()
+            return
+        self.index_status_label.setText('Индексация библиотеки...')
+        self.library_crawler.start()
+
+
+    def on_crawl_progress(self, folders, files):
+        self.index_status_label.setText(f'Индексация библиотеки: каталогов {folders}, файлов {files}...')
+
+
+    def on_crawl_finished(self, folders, files, elapsed):
+        self.index_status_label.setText(f'В индексе файлов: {self.library_index.file_count()}')
+        if self.videos_from_index:
+            self.fill_videos_from_index()
+
+
+    def show_all_videos(self):
+        if not self.username or not self.password:
+            self.show_login_error()
+            return
+        if self.video_search_job:
+            self.video_search_job.cancel_event.set()
+        self.videos_dock.show()
+        self.videos_list.clear()
+        self.videos_status_label.setText('Поиск видео на сервере...')
+        self.video_search_id += 1
+        self.video_search_job = VideoSearchJob(self.video_search_id, self.http_session, self.server_url, self.username)
+        self.video_search_job.signals.page.connect(self.on_video_page, Qt.QueuedConnection)
+        self.video_search_job.signals.finished.connect(self.on_video_search_finished, Qt.QueuedConnection)
+        self.video_search_job.signals.unsupported.connect(self.on_video_search_unsupported, Qt.QueuedConnection)
+        self.video_search_job.signals.failed.connect(self.on_video_search_failed, Qt.QueuedConnection)
+        QThreadPool.globalInstance().start(self.video_search_job)
+
+
+    def add_video_items(self, videos):
+        self.videos_list.setUpdatesEnabled(False)
+        for path, name in videos:
+            item = QListWidgetItem(path)
+            item.setData(Qt.UserRole, path)
+            self.videos_list.addItem(item)
+        self.videos_list.setUpdatesEnabled(True)
+
+
+    def on_video_page(self, search_id, page):
+        if search_id != self.video_search_id:
+            return
+        self.add_video_items([(path, entry.name) for path, entry in page])
+        self.videos_status_label.setText(f'Найдено видео: {self.videos_list.count()}...')
+
+
+    def on_video_search_finished(self, search_id, count):
+        if search_id == self.video_search_id:
+            self.videos_status_label.setText(f'Найдено видео: {count}')
+
+
+    def on_video_search_unsupported(self, search_id, message):
+        if search_id != self.video_search_id:
+            return
+        logging.info(f"Сервер не поддерживает SEARCH ({message}), используется индекс библиотеки")
+        self.videos_from_index = True
+        self.fill_videos_from_index()
+
+
+    def on_video_search_failed(self, search_id, message):
+        if search_id == self.video_search_id:
+            self.videos_status_label.setText('Ошибка поиска видео')
+
+
+    def fill_videos_from_index(self):
+        if not self.library_index:
+            self.videos_status_label.setText('Поиск недоступен, используйте дерево файлов')
+            return
+        self.videos_list.clear()
+        self.add_video_items([(path, name) for path, name, size in self.library_index.videos()])
+        if self.library_crawler and self.library_crawler.is_running():
+            self.videos_status_label.setText(f'Найдено видео: {self.videos_list.count()} (индексация продолжается...)')
+        else:
+            self.videos_status_label.setText(f'Найдено видео: {self.videos_list.count()}')
+
+
+    def on_crawl_failed(self, message):
+        self.index_status_label.setText('Ошибка индексации библиотеки')
+
+
+    def search_library(self, text):
+        if not text.strip() or not self.library_index:
+            self.search_results.hide()
+            self.tree_view.show()
+            return
+        started = time.perf_counter()
+        results = self.library_index.search(text)
+        logging.debug(f"Поиск '{text}': {len(results)} результатов за {(time.perf_counter() - started) * 1000:.1f} мс")
+        self.search_results.clear()
+        for path, name, size in results:
+            folder = path[:-len(name)] or '/'
+            item = QListWidgetItem(f'{name}    ({folder})')
+            item.setData(Qt.UserRole, path)
+            self.search_results.addItem(item)
+        self.tree_view.hide()
+        self.search_results.show()
+
+
+    def on_search_result_activated(self, item):
+        self.play_file(item.data(Qt.UserRole))
     
 
     def show_login_error(self):
@@ -396,106 +3977,770 @@ class NextcloudVideoPlayer(QMainWindow):
 
 
     def populate_file_tree(self, path=""):
-        full_url = self.server_url + "remote.php/dav/files/" + quote(self.username, safe='') + "/" + path
+        node = self.tree_model.node_for_path(path)
+        if node is None:
+            return
+        if not path and self.root_listing:
+            self.seed_root_listing(node)
+            return
+        prefetched = self.prefetcher.take(path)
+        if prefetched:
+            # Listed in the background a moment ago, so it is shown as is without another round trip
+            self.cancel_loading(path)
+            self.tree_model.clear_children(node)
+            self.tree_model.append_entries(node, prefetched[1])
+            self.tree_model.set_state(node, FileNode.LOADED)
+            self.probe_folder(node)
+            self.on_folder_loaded(node)
+            return
+        full_url = self.dav_url(path)
         logging.debug(f"Запрос списка файлов из: {full_url}")
-        try:
-            response = requests.request("PROPFIND", full_url, auth=BasicAuthWithUnicode(self.username, self.password), headers={"Depth": "1"})
-            if response.status_code == 207:
-                current_item = self.tree_widget.currentItem() if path else None
-                if current_item:
-                    current_item.takeChildren()
-                else:
-                    self.tree_widget.clear()
-                items = self.extract_links(response.content)
-                if items:
-                    existing_items = set()  # To keep track of existing items
-                    for item in items:
-                        decoded_item = requests.utils.unquote(item)
-                        if decoded_item != path and decoded_item not in existing_items:
-                            tree_item = QTreeWidgetItem([decoded_item])
-                            tree_item.setData(0, Qt.UserRole, path + item)
-                            if item.endswith('/'):
-                                tree_item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
-                            if current_item:
-                                current_item.addChild(tree_item)
-                            else:
-                                self.tree_widget.addTopLevelItem(tree_item)
-                            existing_items.add(decoded_item)  # Add the item to the set of existing items
-                    logging.info("Список файлов успешно получен.")
-                else:
-                    logging.info("Файлы не найдены.")
-            else:
-                logging.error(f"Не удалось получить список файлов: {response.status_code} {response.reason}")
-                self.show_login_failed_error()
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Запрос не выполнен: {e}")
+        self.cancel_loading(path)
+        cached = self.listing_cache.get(self.server_url, self.username, path)
+        self.tree_model.clear_children(node)
+        if cached:
+            # Show the cached listing right away and only revalidate its etag in the background
+            etag, entries = cached
+            self.tree_model.append_entries(node, entries)
+            self.tree_model.set_state(node, FileNode.LOADED)
+            self.probe_folder(node)
+        else:
+            etag = None
+            self.tree_model.set_state(node, FileNode.LOADING)
+        self.listing_service.request(full_url, path, (self.server_url, self.username), etag)
+
+
+    def seed_root_listing(self, node):
+        # The login PROPFIND already returned the root listing, asking for it again would only repeat the same request
+        folder_entry, entries = self.root_listing
+        self.root_listing = None
+        self.cancel_loading("")
+        if not (self.snapshot_etag and self.snapshot_etag == folder_entry.etag and node.entries):
+            self.tree_model.clear_children(node)
+            self.tree_model.append_entries(node, entries)
+        self.snapshot_etag = None
+        self.tree_model.set_state(node, FileNode.LOADED)
+        if folder_entry.etag:
+            self.listing_cache.put(self.server_url, self.username, "", folder_entry.etag, entries)
+        self.probe_folder(node)
+        self.on_folder_loaded(node)
+
+
+    def on_listing_stale(self, path):
+        node = self.tree_model.node_for_path(path)
+        if node:
+            self.cancel_loading(path, include_self=False)
+            self.drop_expand_targets(path, include_self=False)
+            self.tree_model.clear_children(node)
+            self.tree_model.set_state(node, FileNode.LOADING)
+
+
+    def on_listing_batch(self, path, entries):
+        node = self.tree_model.node_for_path(path)
+        if node:
+            self.tree_model.append_entries(node, entries)
+
+
+    def on_listing_ready(self, path, folder_entry):
+        node = self.tree_model.node_for_path(path)
+        if node is None:
+            return
+        self.tree_model.set_state(node, FileNode.LOADED)
+        self.listing_error_shown = False
+        self.probe_folder(node)
+        self.on_folder_loaded(node)
+        if node.entries:
+            logging.info("Список файлов успешно получен.")
+        else:
+            logging.info("Файлы не найдены.")
+        self.log_connection_stats()
+
+
+    def on_listing_failed(self, path, message):
+        expanding = self.expand_targets.pop(path, None) is not None
+        node = self.tree_model.node_for_path(path)
+        if node is None:
+            return
+        if node.state == FileNode.LOADED:
+            logging.warning(f"Не удалось обновить список файлов, показан кэш: {message}")
+            return
+        self.tree_model.clear_children(node)
+        self.tree_model.set_state(node, FileNode.NOT_LOADED)
+        logging.error(f"Не удалось получить список файлов {path or '/'}: {message}")
+        # Folders listed in parallel fail together, one dialog is enough until a listing succeeds again
+        if expanding or self.listing_error_shown:
+            return
+        self.listing_error_shown = True
+        if message.startswith(('401', '403')):
             self.show_login_failed_error()
+        else:
+            QMessageBox.warning(self, "Ошибка сети", f"Не удалось получить список файлов: {message}")
+
+
+    def probe_folder(self, node):
+        cached = {}
+        for entry in node.entries:
+            if entry.is_collection or not entry.name.lower().endswith(VIDEO_EXTENSIONS):
+                continue
+            path = node.path + entry.name
+            known = self.tree_model.metadata.get(path)
+            if known and known['etag'] == entry.etag:
+                continue
+            # A file is probed once per etag, reopening the folder only reads the cache
+            metadata = self.metadata_cache.get(self.server_url, self.username, path, entry.etag)
+            if metadata:
+                cached[path] = dict(metadata, etag=entry.etag)
+            else:
+                self.stream_proxy.base_url = self.dav_url()
+                self.media_prober.probe(path, entry.etag, self.stream_proxy.url_for(path, probe=True))
+        if cached:
+            self.tree_model.set_metadata(cached)
+
+
+    def on_media_probed(self, path, etag, metadata):
+        self.metadata_cache.put(self.server_url, self.username, path, etag, metadata)
+        self.metadata_updates[path] = dict(metadata, etag=etag)
+        if not self.metadata_timer.isActive():
+            self.metadata_timer.start()
+
+
+    def flush_metadata(self):
+        updates, self.metadata_updates = self.metadata_updates, {}
+        self.tree_model.set_metadata(updates)
+
+
+    def toggle_thumbnails(self, checked):
+        # Every row gets a decoration of the same size, so uniform row heights still hold
+        self.tree_model.thumbnail = self.thumbnail_for if checked else None
+        self.tree_view.setIconSize(QSize(THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT) if checked else QSize())
+        self.tree_view.viewport().update()
+        if checked:
+            self.thumbnail_timer.start()
+        else:
+            self.thumbnail_loader.request([])
+
+
+    def thumbnail_key(self, entry):
+        return hashlib.sha1(f"{self.server_url}|{self.username}|{entry.fileid}|{entry.etag}".encode('utf-8')).hexdigest()
 
-    
 
-    def extract_links(self, content):
-        from xml.etree import ElementTree as ET
-        tree = ET.ElementTree(ET.fromstring(content))
-        root = tree.getroot()
-        namespaces = {'d': 'DAV:'}
+    def thumbnail_for(self, node):
+        if node.is_collection or not node.entry.fileid:
+            return self.thumbnail_placeholder
+        return self.thumbnail_cache.get(self.thumbnail_key(node.entry)) or self.thumbnail_placeholder
+
+
+    def request_visible_thumbnails(self):
+        if self.tree_model.thumbnail is None or not self.server_url:
+            return
+        # Rows on screen come first, then one more screen below them
+        limit = self.tree_view.viewport().height() * 2
         items = []
+        index = self.tree_view.indexAt(QPoint(1, 1))
+        while index.isValid() and self.tree_view.visualRect(index).top() < limit:
+            node = self.tree_proxy.mapToSource(index).internalPointer()
+            if not node.is_collection and node.entry.fileid and node.entry.name.lower().endswith(VIDEO_EXTENSIONS):
+                key = self.thumbnail_key(node.entry)
+                if key not in self.thumbnail_cache and key not in self.thumbnail_missing:
+                    items.append((key, node.path, node.entry.fileid))
+            index = self.tree_view.indexBelow(index)
+        self.thumbnail_loader.base_url = self.server_url
+        self.thumbnail_loader.request(items)
+
+
+    def on_thumbnail_loaded(self, path, key, image):
+        if image is None:
+            self.thumbnail_missing.add(key)
+            return
+        self.thumbnail_cache.put(key, QPixmap.fromImage(image))
+        self.tree_model.update_decoration(path)
+
+
+    def log_connection_stats(self):
+        stats = self.http_session.stats.snapshot()
+        cache_stats = self.listing_cache.stats()
+        logging.debug(f"HTTP: запросов {stats['requests']}, новых соединений {stats['new_connections']}, "
+                      f"повторно использовано {stats['reused_connections']}; "
+                      f"кэш списков: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}")
+
+
+    def show_connection_stats(self):
+        stats = self.http_session.stats.snapshot()
+        cache_stats = self.listing_cache.stats()
+        stream_stats = self.stream_proxy.cache.stats()
+        network = self.http_session.estimator.snapshot()
+        throughput = f"{network['throughput'] / (1024 * 1024):.1f} МиБ/с" if network['throughput'] else 'нет данных'
+        QMessageBox.information(self, "Статистика соединений",
+                                f"Запросов: {stats['requests']}\n"
+                                f"Новых соединений: {stats['new_connections']}\n"
+                                f"Повторно использовано соединений: {stats['reused_connections']}\n\n"
+                                f"Кэш списков: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}\n"
+                                f"Каталогов в кэше: {cache_stats['entries']} ({cache_stats['bytes'] // 1024} КиБ)\n\n"
+                                f"Кэш видео: попаданий {stream_stats['hits']}, промахов {stream_stats['misses']}, "
+                                f"{stream_stats['bytes'] // (1024 * 1024)} МиБ\n\n"
+                                f"Сеть: задержка {network['rtt_ms']} мс, скорость {throughput}\n"
+                                f"Воспроизведений: {network['playbacks']}, остановок на буферизацию: {network['stalls']}, "
+                                f"средний старт: {network['average_startup_ms']} мс")
+
+
+    def change_stream_cache_size(self):
+        current = self.stream_proxy.cache.max_bytes // (1024 * 1024)
+        size, accepted = QInputDialog.getInt(self, "Кэш видео", "Максимальный размер кэша видео, МиБ:", current, 64, 1024 * 1024)
+        if accepted:
+            self.stream_proxy.cache.set_max_bytes(size * 1024 * 1024)
+            self.save_settings()
+
+
+    def on_item_collapsed(self, index):
+        path = index.data(Qt.UserRole)
+        if path:
+            self.cancel_loading(path)
+            self.drop_expand_targets(path)
+            self.media_prober.cancel_under(path)
+
+
+    def cancel_loading(self, path, include_self=True):
+        for pending in self.listing_service.pending_under(path):
+            if pending == path and not include_self:
+                continue
+            logging.debug(f"Отмена загрузки каталога: {pending}")
+            self.listing_service.cancel(pending)
+            node = self.tree_model.node_for_path(pending)
+            if node and node.state == FileNode.LOADING:
+                # A partially filled folder would look complete, so it is emptied until expanded again
+                self.tree_model.clear_children(node)
+                self.tree_model.set_state(node, FileNode.NOT_LOADED)
 
-        logging.debug("Анализ XML-ответа:")
-        logging.debug(ET.tostring(root, encoding='unicode'))
-        
-        for response in root.findall('d:response', namespaces):
-            href = response.find('d:href', namespaces).text
-            if not href.endswith('/'):
-                href = href.split('/')[-1]
-            else:
-                href = href.split('/')[-2] + '/'
-            items.append(href)
-            logging.debug(f"Найдена ссылка: {href}")
-        return items
     
 
-    def on_item_double_clicked(self, item, column):
+    def on_item_double_clicked(self, index):
         if not self.username or not self.password:
             self.show_login_error()
             return
         
-        selected_file = item.data(column, Qt.UserRole)
+        selected_file = index.data(Qt.UserRole)
+        if not selected_file:
+            return
         if selected_file.endswith('/'):
             logging.debug(f"Переход к каталогу: {selected_file}")
-            item.takeChildren()
             self.populate_file_tree(selected_file)
+            self.tree_view.expand(index)
         else:
-            try:
-                video_url = self.server_url + "remote.php/dav/files/" + quote(self.username, safe='') + "/" + quote(selected_file, safe='')
+            self.play_file(selected_file)
 
-                username_encoded = self.username
-                password_encoded = self.password
-                video_url_with_auth = f"{self.server_url.replace('https://', 'https://'+username_encoded+':'+password_encoded+'@')}remote.php/dav/files/{quote(self.username, safe='')}/{quote(selected_file, safe='')}"
-                logging.debug(f"URL-адрес видео с авторизацией: {video_url_with_auth}")
 
-                media = self.vlc_instance.media_new(video_url_with_auth)
-                self.open_video_player(media)
-                logging.info(f"Воспроизведение видео: {selected_file}")
-            except Exception as e:
-                logging.error(f"Ошибка воспроизведения видео: {e}")
-                print(f"Error: {e}")
+    def play_file(self, selected_file):
+        if not self.username or not self.password:
+            self.show_login_error()
+            return
+        try:
+            self.open_video_player(self.create_media(selected_file), selected_file)
+            logging.info(f"Воспроизведение видео: {selected_file}")
+        except Exception as e:
+            logging.error(f"Ошибка воспроизведения видео: {e}")
+            print(f"Error: {e}")
+
+
+    def create_media(self, path):
+        local_copy = self.download_manager.local_copy(path)
+        if local_copy:
+            logging.info(f"Воспроизведение локальной копии: {local_copy}")
+            media = self.libvlc.get().media_new_path(local_copy)
+            self.media_caching[path] = FILE_CACHING
+        else:
+            # VLC streams from the local caching proxy, so credentials never end up in the MRL
+            self.stream_proxy.base_url = self.dav_url()
+            media = self.libvlc.get().media_new(self.stream_proxy.url_for(path))
+            entry = self.entry_for(path)
+            metadata = self.tree_model.metadata.get(path)
+            self.media_caching[path] = self.http_session.estimator.caching_for(
+                entry.size if entry else None, metadata['duration_ms'] if metadata else None)
+        media.add_option(f':network-caching={self.media_caching[path]}')
+        media.add_option(f':file-caching={FILE_CACHING}')
+        self.attach_sidecars(media, path)
+        return media
+
+
+    def sidecars_for(self, path):
+        # "Film.srt", "Film.ru.srt" and "Film.eng.mka" belong to "Film.mkv" in the same folder
+        folder, _, name = path.rpartition('/')
+        node = self.tree_model.node_for_path(folder + '/' if folder else '')
+        if node is None:
+            return []
+        stem = name.rpartition('.')[0].casefold() + '.'
+        sidecars = []
+        for entry in node.entries:
+            candidate = entry.name.casefold()
+            if entry.is_collection or not candidate.startswith(stem):
+                continue
+            if candidate.endswith(SUBTITLE_EXTENSIONS):
+                sidecars.append(('subtitle', entry))
+            elif candidate.endswith(AUDIO_EXTENSIONS):
+                sidecars.append(('audio', entry))
+        return sidecars[:SIDECAR_MAX_FILES]
 
 
-    def open_video_player(self, media):
-        self.video_player_window = VideoPlayerWindow(self.vlc_instance, media)
-        self.video_player_window.closed.connect(self.on_video_player_closed)
-        self.video_player_window.show()
+    def attach_sidecars(self, media, path):
+        folder = path.rpartition('/')[0]
+        self.sidecar_fetcher.base_url = self.dav_url()
+        # An audio track goes through the proxy even when the video itself plays from a downloaded copy
+        self.stream_proxy.base_url = self.dav_url()
+        for kind, entry in self.sidecars_for(path):
+            sidecar_path = (folder + '/' if folder else '') + entry.name
+            local_copy = self.download_manager.local_copy(sidecar_path)
+            if kind == 'subtitle':
+                local_copy = local_copy or self.sidecar_fetcher.cached(sidecar_path, entry.etag)
+            if local_copy:
+                # Already on disk, so the media opens with it and it is there from the first frame
+                media.slaves_add(getattr(vlc.MediaSlaveType, kind), SIDECAR_PRIORITY, Path(local_copy).as_uri())
+            else:
+                # Fetched alongside the video's own buffering and attached to the player once it arrives
+                uri = self.stream_proxy.url_for(sidecar_path) if kind == 'audio' else None
+                self.sidecar_fetcher.fetch(path, kind, sidecar_path, entry.etag, uri)
+            logging.debug(f"Дополнительный файл для {path}: {sidecar_path}")
+
+
+    def on_sidecar_fetched(self, video_path, kind, sidecar_path, uri):
+        if self.next_media and self.next_media[0] == video_path:
+            self.next_media[1].slaves_add(getattr(vlc.MediaSlaveType, kind), SIDECAR_PRIORITY, uri)
+        elif self.playing_path == video_path and self.video_player_window is not None:
+            self.video_player_window.add_sidecar(kind, uri)
+        else:
+            return
+        logging.info(f"Подключён файл {'субтитров' if kind == 'subtitle' else 'звуковой дорожки'}: {sidecar_path}")
+
+
+    def entry_for(self, path):
+        folder, _, name = path.rpartition('/')
+        node = self.tree_model.node_for_path(folder + '/' if folder else '')
+        if node is None:
+            return None
+        for entry in node.entries:
+            if entry.name == name:
+                return entry
+        return None
+
+
+    def next_in_folder(self, path):
+        folder, _, name = path.rpartition('/')
+        node = self.tree_model.node_for_path(folder + '/' if folder else '')
+        if node is None:
+            return None
+        # The order is the one the tree shows, by the column and direction the user sorted it
+        column, order = self.tree_proxy.sortColumn(), self.tree_proxy.sortOrder()
+        videos = [FileNode(entry, node.path + entry.name, node, 0, position) for position, entry in enumerate(node.entries)
+                  if not entry.is_collection and entry.name.lower().endswith(VIDEO_EXTENSIONS)]
+        videos.sort(key=lambda video: self.tree_model.sort_key(video, max(column, 0)), reverse=order == Qt.DescendingOrder)
+        videos = [video.entry.name for video in videos]
+        if name not in videos:
+            return None
+        position = videos.index(name)
+        if position + 1 >= len(videos):
+            return None
+        return (folder + '/' if folder else '') + videos[position + 1]
+
+
+    def prepare_next(self):
+        if not self.playlist_action.isChecked() or not self.playing_path:
+            return
+        next_path = self.next_in_folder(self.playing_path)
+        if not next_path:
+            return
+        try:
+            media = self.create_media(next_path)
+            if not self.download_manager.local_copy(next_path):
+                self.stream_proxy.warm_up(next_path)
+            # Demuxers are opened while the current video is still playing
+            media.parse_with_options(vlc.MediaParseFlag.network, PLAYLIST_PARSE_TIMEOUT)
+            self.next_media = (next_path, media)
+            logging.info(f"Подготовлено следующее видео: {next_path}")
+        except Exception as e:
+            logging.error(f"Ошибка подготовки следующего видео: {e}")
+
+
+    def play_next(self):
+        if not self.playlist_action.isChecked() or not self.playing_path:
+            return
+        if self.next_media is None:
+            self.prepare_next()
+        if self.next_media is None:
+            return
+        next_path, media = self.next_media
+        self.open_video_player(media, next_path)
+        logging.info(f"Воспроизведение видео: {next_path}")
+
+
+    def show_tree_context_menu(self, position):
+        index = self.tree_view.indexAt(position)
+        path = index.data(Qt.UserRole)
+        if not path:
+            return
+        menu = QMenu(self)
+        download_action = menu.addAction('Скачать каталог' if path.endswith('/') else 'Скачать')
+        expand_all_action = expand_depth_action = None
+        if path.endswith('/'):
+            expand_all_action = menu.addAction('Развернуть всё')
+            expand_depth_action = menu.addAction('Развернуть на глубину...')
+        action = menu.exec_(self.tree_view.viewport().mapToGlobal(position))
+        if action is None:
+            return
+        if action == download_action:
+            self.download(path)
+        elif action == expand_all_action:
+            self.expand_subtree(path, EXPAND_ALL_DEPTH)
+        elif action == expand_depth_action:
+            self.expand_to_depth(path)
+
+
+    def expand_subtree(self, path, depth):
+        node = self.tree_model.node_for_path(path)
+        if node is None or depth < 1:
+            return
+        self.expand_targets[path] = depth
+        if node.state == FileNode.NOT_LOADED:
+            self.populate_file_tree(path)
+        elif node.state == FileNode.LOADED and not self.listing_service.is_loading(path):
+            self.continue_expansion(path)
+
+
+    def continue_expansion(self, path):
+        depth = self.expand_targets.pop(path, None)
+        node = self.tree_model.node_for_path(path)
+        if depth is None or node is None:
+            return
+        if path:
+            self.tree_view.expand(self.tree_proxy.mapFromSource(self.tree_model.index_for_node(node)))
+        if depth <= 1:
+            return
+        # Subfolders beyond the first batch are not rows yet, an explicit expand-all materialises them
+        if any(entry.is_collection for entry in node.entries[len(node.children):]):
+            self.tree_model.expose(node, len(node.entries))
+        # Every subfolder is requested right away, ListingService runs at most LISTING_THREADS of them at a time
+        for child in node.children:
+            if child.is_collection:
+                self.expand_subtree(child.path, depth - 1)
+
+
+    def filter_tree(self, text):
+        model = self.tree_model
+        if not model.filter_words and self.filter_saved_expansion is None:
+            self.filter_saved_expansion = [path for path, node in model.folders.items()
+                                           if path and model.is_shown(node) and self.tree_view.isExpanded(
+                                               self.tree_proxy.mapFromSource(model.index_for_node(node)))]
+        with metrics.span('tree.filter'):
+            model.set_filter(text)
+        if model.filter_words:
+            # Folders holding matches open a few at a time, so typing never waits for a deep tree to unfold
+            paths = {path for path in model.filter_matched if path} | {path for path in model.filter_forced if path}
+        else:
+            paths = self.filter_saved_expansion or []
+            self.filter_saved_expansion = None
+        self.filter_expand_queue = deque(sorted(paths, key=lambda path: (path.count('/'), path))[:FILTER_EXPAND_MAX])
+        self.filter_expand_timer.start(0)
+
+
+    def expand_filter_step(self):
+        for _ in range(min(FILTER_EXPAND_STEP, len(self.filter_expand_queue))):
+            node = self.tree_model.node_for_path(self.filter_expand_queue.popleft())
+            if node is not None and self.tree_model.is_shown(node):
+                self.tree_view.expand(self.tree_proxy.mapFromSource(self.tree_model.index_for_node(node)))
+        if self.filter_expand_queue:
+            self.filter_expand_timer.start(0)
+
+
+    def drop_expand_targets(self, path, include_self=True):
+        for target in [target for target in self.expand_targets if target.startswith(path)]:
+            if target != path or include_self:
+                del self.expand_targets[target]
+
+
+    def on_folder_loaded(self, node):
+        self.continue_expansion(node.path)
+        # An expand-all already lists everything it needs, guessing on top of it would only compete
+        if not self.expand_targets:
+            self.prefetcher.start(self.dav_url(), (self.server_url, self.username), node.path, node.entries)
+
+
+    def expand_to_depth(self, path):
+        depth, accepted = QInputDialog.getInt(self, "Развернуть каталог", "Глубина:", 2, 1, EXPAND_ALL_DEPTH)
+        if accepted:
+            self.expand_subtree(path, depth)
+
+
+    def toggle_prefetch(self, checked):
+        self.prefetcher.enabled = checked
+        if not checked:
+            self.prefetcher.cancel()
+
+
+    def change_prefetch_limits(self):
+        depth, accepted = QInputDialog.getInt(self, "Предзагрузка подкаталогов", "Глубина предзагрузки:",
+                                              self.prefetcher.depth, 1, PREFETCH_MAX_DEPTH)
+        if not accepted:
+            return
+        budget, accepted = QInputDialog.getInt(self, "Предзагрузка подкаталогов", "Не больше запросов после каждого открытого каталога:",
+                                               self.prefetcher.budget, 1, PREFETCH_MAX_BUDGET)
+        if not accepted:
+            return
+        self.prefetcher.set_limits(depth, budget)
+        self.save_settings()
+
+
+    def download(self, path):
+        if not self.username or not self.password:
+            self.show_login_error()
+            return
+        self.download_manager.base_url = self.dav_url()
+        logging.info(f"Загрузка: {path} -> {self.download_manager.local_path(path)}")
+        self.download_manager.download(path)
+
+
+    def on_download_progress(self, path, done, total):
+        self.downloads[path] = (done, total)
+        self.update_download_status()
+
+
+    def on_download_finished(self, path, local_path):
+        self.downloads.pop(path, None)
+        self.update_download_status()
+
+
+    def on_download_failed(self, path, message):
+        self.downloads.pop(path, None)
+        self.update_download_status()
+
+
+    def update_download_status(self):
+        if not self.downloads:
+            self.download_status_label.setText('')
+            return
+        done = sum(value[0] for value in self.downloads.values())
+        total = sum(value[1] for value in self.downloads.values()) or 1
+        self.download_status_label.setText(f'Загрузки: {len(self.downloads)}, {done * 100 // total}% '
+                                           f'({done // (1024 * 1024)} из {total // (1024 * 1024)} МиБ)')
+
+
+    def change_download_dir(self):
+        directory = QFileDialog.getExistingDirectory(self, "Папка загрузок", self.download_manager.directory)
+        if directory:
+            self.download_manager.directory = directory
+            self.save_settings()
+
+
+    def change_download_limits(self):
+        connections, accepted = QInputDialog.getInt(self, "Ограничения загрузок", "Одновременных соединений:",
+                                                    self.download_manager.limiter.limit, 1, DOWNLOAD_MAX_CONNECTIONS)
+        if not accepted:
+            return
+        rate, accepted = QInputDialog.getInt(self, "Ограничения загрузок", "Ограничение скорости, КиБ/с (0 - без ограничения):",
+                                             self.download_manager.bucket.rate // 1024, 0, 10 * 1024 * 1024)
+        if not accepted:
+            return
+        self.download_manager.limiter.set_limit(connections)
+        self.download_manager.bucket.set_rate(rate * 1024)
+        self.save_settings()
+
+
+    def ensure_video_player(self):
+        if self.video_player_window is None:
+            self.video_player_window = VideoPlayerWindow(self.libvlc.get())
+            self.video_player_window.closed.connect(self.on_video_player_closed)
+            self.video_player_window.nearEnd.connect(self.prepare_next)
+            self.video_player_window.finished.connect(self.play_next)
+            self.video_player_window.signals.buffering.connect(self.on_player_buffering, Qt.QueuedConnection)
+        return self.video_player_window
+
+
+    def open_video_player(self, media, path):
+        window = self.ensure_video_player()
+        self.record_playback()
+        self.playing_path = path
+        self.drop_next_media(keep=media)
+        window.play_media(media, os.path.basename(path))
+        window.show()
+        window.raise_()
+        # Preview sheets are only built once the main player has settled into playback
+        self.seek_preview.cancel()
+        self.preview_timer.start()
+
+
+    def drop_next_media(self, keep=None):
+        # A prepared media that is not going to be played would otherwise stay allocated in libvlc
+        if self.next_media is not None and self.next_media[1] is not keep:
+            self.next_media[1].release()
+        self.next_media = None
 
 
     def on_video_player_closed(self):
         logging.info("Видеоплеер закрыт")
-        self.video_player_window = None
+        self.record_playback()
+        self.playing_path = None
+        self.drop_next_media()
+        self.preview_timer.stop()
+        self.seek_preview.cancel()
+
+
+    def start_seek_previews(self):
+        window = self.video_player_window
+        path = self.playing_path
+        if window is None or not path or not window.length:
+            return
+        entry = self.entry_for(path)
+        info = self.stream_proxy.known_info(path)
+        etag = entry.etag if entry else info.etag if info else None
+        if not etag:
+            return
+        metadata = self.tree_model.metadata.get(path)
+        tile_height = PREVIEW_TILE_HEIGHT
+        if metadata and metadata['width'] and metadata['height']:
+            tile_height = max(2, PREVIEW_TILE_WIDTH * metadata['height'] // metadata['width'] // 2 * 2)
+        key = hashlib.sha1(f"{self.server_url}|{self.username}|{path}|{etag}".encode('utf-8')).hexdigest()
+        url = self.download_manager.local_copy(path) or self.stream_proxy.url_for(path, background=True)
+        window.preview_key = key
+        self.seek_preview.start(key, url, window.length, PREVIEW_TILE_WIDTH, tile_height)
+
+
+    def on_preview_sheet(self, key, sheet, info):
+        if self.video_player_window is not None:
+            self.video_player_window.set_preview_sheet(key, sheet, info)
+
+
+    def on_player_buffering(self, level):
+        if level < 100:
+            self.seek_preview.pause()
+        else:
+            self.seek_preview.resume()
+
+
+    def record_playback(self):
+        window = self.video_player_window
+        if not self.playing_path or window is None:
+            return
+        self.http_session.estimator.record_playback(window.startup_ms, window.stalls)
+        metrics.count('player.playbacks')
+        metrics.count('player.stalls', window.stalls)
+        if window.startup_ms is not None:
+            metrics.observe('player.first_frame', window.startup_ms / 1000)
+        logging.info(f"Воспроизведение {self.playing_path}: network-caching {self.media_caching.pop(self.playing_path, None)} мс, "
+                     f"старт {window.startup_ms} мс, остановок {window.stalls}")
+
+
+    def report_startup(self):
+        elapsed = time.perf_counter() - STARTUP_STARTED
+        metrics.observe('startup.window', elapsed)
+        logging.info(f"Окно показано через {elapsed * 1000:.0f} мс после запуска")
+
+
+    def release_video_player(self):
+        if self.video_player_window is not None:
+            self.video_player_window.release()
+
+
+    def attach_log(self, log_sink, log_file):
+        self.log_sink = log_sink
+        self.log_file = log_file
+        self.log_sink.set_levels(self.log_levels)
+        self.log_level_box.blockSignals(True)
+        self.log_level_box.setCurrentIndex(max(0, self.log_level_box.findData(self.log_levels.get('', logging.DEBUG))))
+        self.log_level_box.blockSignals(False)
+        self.log_timer.start()
+
+
+    def flush_log(self):
+        if not self.log_sink or not self.dock_widget.isVisible():
+            return
+        lines = self.log_sink.take_pending()
+        if lines:
+            # One append per tick instead of one per record
+            self.log_window.appendPlainText('\n'.join(lines))
+
+
+    def change_log_level(self, index):
+        self.log_levels[''] = self.log_level_box.itemData(index)
+        if self.log_sink:
+            self.log_sink.set_levels(self.log_levels)
+        self.save_settings()
+
+
+    def set_tracing(self, checked):
+        metrics.enabled = checked
+
+
+    def refresh_diagnostics(self):
+        if not self.diagnostics_dock.isVisible():
+            return
+        snapshot = metrics.snapshot()
+        lines = []
+        if snapshot['spans']:
+            lines.append(f"{'Этап':<24}{'число':>8}{'p50, мс':>10}{'p95, мс':>10}{'макс, мс':>10}{'всего, с':>10}")
+            for name, span in sorted(snapshot['spans'].items()):
+                lines.append(f"{name:<24}{span['count']:>8}{span['p50_ms']:>10.1f}{span['p95_ms']:>10.1f}"
+                             f"{span['max_ms']:>10.1f}{span['total_s']:>10.2f}")
+        elif not metrics.enabled:
+            lines.append('Трассировка выключена, замеры этапов не собираются.')
+        lines.append('')
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"{name:<40}{value:>16}")
+        scrollbar = self.diagnostics_view.verticalScrollBar()
+        position = scrollbar.value()
+        self.diagnostics_view.setPlainText('\n'.join(lines))
+        scrollbar.setValue(position)
+
+
+    def toggle_diagnostics(self):
+        if self.diagnostics_dock.isVisible():
+            self.diagnostics_dock.hide()
+        else:
+            self.diagnostics_dock.show()
+            self.diagnostics_dock.raise_()
+            self.refresh_diagnostics()
+
+
+    def export_metrics(self, prometheus=False):
+        now = datetime.now()
+        if prometheus:
+            filename, file_filter = f"metrics_{now.strftime('%Y_%m_%d_%H_%M_%S')}.prom", "Prometheus (*.prom *.txt);;All Files (*)"
+        else:
+            filename, file_filter = f"metrics_{now.strftime('%Y_%m_%d_%H_%M_%S')}.jsonl", "JSON Lines (*.jsonl);;All Files (*)"
+        file_path, _ = QFileDialog.getSaveFileName(self, "Экспорт метрик", filename, file_filter)
+        if file_path:
+            with open(file_path, 'w', encoding='utf-8') as file:
+                file.write(metrics.to_prometheus() if prometheus else metrics.to_jsonl())
+            logging.info(f"Метрики сохранены в {file_path}")
+
+
+    def reset_metrics(self):
+        metrics.reset()
+        self.refresh_diagnostics()
+
+
+    def toggle_profiling(self, checked):
+        if checked:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            logging.info("Профилирование GUI-потока включено")
+            return
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        directory = os.path.dirname(LOG_FILE)
+        os.makedirs(directory, exist_ok=True)
+        filename = os.path.join(directory, f"profile_{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}.prof")
+        self.profiler.dump_stats(filename)
+        report = io.StringIO()
+        pstats.Stats(self.profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+        self.profiler = None
+        logging.info(f"Профиль сохранён в {filename}\n{report.getvalue()}")
 
 
     def toggle_log_window(self):
         if self.dock_widget.isVisible():
             self.dock_widget.hide()
         else:
+            # The widget is not fed while hidden, it is refilled from the ring buffer instead
+            if self.log_sink:
+                self.log_window.setPlainText('\n'.join(self.log_sink.snapshot()))
+                self.log_window.moveCursor(self.log_window.textCursor().End)
             self.dock_widget.show()
 
 
@@ -505,8 +4750,11 @@ class NextcloudVideoPlayer(QMainWindow):
         options = QFileDialog.Options()
         file_path, _ = QFileDialog.getSaveFileName(self, "Сохранить журнал", log_filename, "Log Files (*.log);;All Files (*)", options=options)
         if file_path:
-            with open(file_path, 'w') as file:
-                file.write(self.log_window.toPlainText())
+            if self.log_file:
+                self.log_file.export(file_path)
+            else:
+                with open(file_path, 'w', encoding='utf-8') as file:
+                    file.write(self.log_window.toPlainText())
             logging.info(f"Журнал сохранён в {file_path}")
 
 
@@ -515,7 +4763,18 @@ class NextcloudVideoPlayer(QMainWindow):
             'server_url': self.server_url,
             'username': self.username,
             'password': self.password,
-            'theme': 'dark' if self.theme_action.isChecked() else 'light'
+            'theme': 'dark' if self.theme_action.isChecked() else 'light',
+            'stream_cache_mb': self.stream_proxy.cache.max_bytes // (1024 * 1024),
+            'download_dir': self.download_manager.directory,
+            'download_connections': self.download_manager.limiter.limit,
+            'download_limit_kbps': self.download_manager.bucket.rate // 1024,
+            'playlist_mode': self.playlist_action.isChecked(),
+            'thumbnails': self.thumbnails_action.isChecked(),
+            'prefetch': self.prefetch_action.isChecked(),
+            'prefetch_depth': self.prefetcher.depth,
+            'prefetch_budget': self.prefetcher.budget,
+            'log_levels': self.log_levels,
+            'tracing': self.tracing_box.isChecked()
         }
         with open(CONFIG_FILE, 'w') as config_file:
             json.dump(settings, config_file)
@@ -529,6 +4788,16 @@ class NextcloudVideoPlayer(QMainWindow):
                 self.server_url = settings.get('server_url', '')
                 self.username = settings.get('username', '')
                 self.password = settings.get('password', '')
+                self.stream_proxy.cache.set_max_bytes(settings.get('stream_cache_mb', STREAM_CACHE_MAX_BYTES // (1024 * 1024)) * 1024 * 1024)
+                self.download_manager.directory = settings.get('download_dir', DOWNLOAD_DIR)
+                self.download_manager.limiter.set_limit(settings.get('download_connections', DOWNLOAD_CONNECTIONS))
+                self.download_manager.bucket.set_rate(settings.get('download_limit_kbps', 0) * 1024)
+                self.playlist_action.setChecked(settings.get('playlist_mode', False))
+                self.thumbnails_action.setChecked(settings.get('thumbnails', True))
+                self.prefetch_action.setChecked(settings.get('prefetch', False))
+                self.prefetcher.set_limits(settings.get('prefetch_depth', PREFETCH_DEPTH), settings.get('prefetch_budget', PREFETCH_BUDGET))
+                self.log_levels = dict(LOG_VIEW_LEVELS, **settings.get('log_levels', {}))
+                self.tracing_box.setChecked(settings.get('tracing', False))
                 theme = settings.get('theme', 'light')
                 if theme == 'dark':
                     self.theme_action.setChecked(True)
@@ -541,23 +4810,28 @@ class NextcloudVideoPlayer(QMainWindow):
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     app.setStyle('Fusion')
-    player = NextcloudVideoPlayer()
-    
-    class QTextEditLogger(logging.Handler):
+    # Both handlers only buffer on the logging thread, the widget and the file are written elsewhere
+    log_sink = LogSink()
+    log_sink.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_file = LogFile()
+    logging.getLogger().addHandler(log_sink)
+    logging.getLogger().addHandler(log_file.handler)
 
+    player = NextcloudVideoPlayer()
+    player.attach_log(log_sink, log_file)
+    app.aboutToQuit.connect(log_file.close)
 
-        def __init__(self, parent):
-            super().__init__()
-            self.log_window = parent.log_window
-
-
-        def emit(self, record):
-            msg = self.format(record)
-            self.log_window.append(msg)
-
-    logger = QTextEditLogger(player)
-    logger.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    logging.getLogger().addHandler(logger)
+    # Segment workers are not daemon threads, interrupted downloads resume from their .part.json on the next start
+    app.aboutToQuit.connect(player.download_manager.stop)
+    app.aboutToQuit.connect(player.release_video_player)
+    app.aboutToQuit.connect(player.media_prober.stop)
+    app.aboutToQuit.connect(player.thumbnail_loader.stop)
+    app.aboutToQuit.connect(player.seek_preview.cancel)
+    app.aboutToQuit.connect(player.prefetcher.stop)
+    app.aboutToQuit.connect(player.sidecar_fetcher.stop)
 
     player.show()
+    # Everything that can wait, libvlc and the login check included, starts once the window is on screen
+    QTimer.singleShot(0, player.start)
+    QTimer.singleShot(0, player.report_startup)
     sys.exit(app.exec_())